@@ -0,0 +1,362 @@
+# A scripted stand-in for GDB's python module, so that JsDbg.py can be loaded
+# and exercised without GDB (see JsDbg_bench.py).
+#
+# Install() builds a synthetic program: a large list of objfiles, a chain of
+# deeply inherited struct types with many fields each, a few very large types
+# and enums, functions to symbolize, a call stack and readable memory. Only
+# the parts of the GDB API that JsDbg.py uses are implemented.
+import hashlib
+import sys
+
+try:
+    # Like GDB, return memory as a buffer object on Python 2.
+    memory_buffer = buffer
+except NameError:
+    memory_buffer = memoryview
+
+COMMAND_USER = 1
+COMMAND_MAINTENANCE = 2
+
+PARAM_BOOLEAN = 1
+PARAM_ZUINTEGER = 2
+PARAM_OPTIONAL_FILENAME = 3
+
+TYPE_CODE_PTR = 1
+TYPE_CODE_ARRAY = 2
+TYPE_CODE_STRUCT = 3
+TYPE_CODE_UNION = 4
+TYPE_CODE_ENUM = 5
+TYPE_CODE_FUNC = 7
+TYPE_CODE_INT = 8
+TYPE_CODE_VOID = 10
+TYPE_CODE_REF = 16
+
+SYMBOL_LOC_TYPEDEF = 8
+SYMBOL_LOC_STATIC = 4
+
+# Where the synthetic functions live, and how large each of them is.
+FUNCTIONS_START = 0x400000
+FUNCTION_SIZE = 0x100
+FUNCTION_COUNT = 4096
+
+# Where the synthetic heap lives.
+HEAP_START = 0x10000000
+HEAP_SIZE = 0x1000000
+
+
+class error(RuntimeError):
+    pass
+
+
+class GdbError(Exception):
+    pass
+
+
+class Command(object):
+    def __init__(self, name, command_class):
+        pass
+
+    def dont_repeat(self):
+        pass
+
+
+class Parameter(object):
+    def __init__(self, name, command_class, parameter_class):
+        self.value = None
+
+
+class InferiorCallPostEvent(object):
+    pass
+
+
+class Type(object):
+    def __init__(self, name, code, sizeof, fields=None, target=None):
+        self.name = name
+        self.code = code
+        self.sizeof = sizeof
+        self._fields = fields
+        self._target = target
+
+    def fields(self):
+        if self._fields is None:
+            raise TypeError("Type is not a structure, union, enum, or function type.")
+        return list(self._fields)
+
+    def strip_typedefs(self):
+        return self
+
+    def target(self):
+        return self._target
+
+    def pointer(self):
+        return Type(None, TYPE_CODE_PTR, 8, target=self)
+
+    def reference(self):
+        return Type(None, TYPE_CODE_REF, 8, target=self)
+
+    def __str__(self):
+        if self.code == TYPE_CODE_PTR:
+            return str(self._target) + " *"
+        if self.code == TYPE_CODE_REF:
+            return str(self._target) + " &"
+        if self.code == TYPE_CODE_STRUCT:
+            return "struct " + self.name
+        if self.code == TYPE_CODE_ENUM:
+            return "enum " + self.name
+        return self.name
+
+
+class Field(object):
+    def __init__(self, name, type, bitpos=None, bitsize=0,
+                 is_base_class=False, artificial=False, enumval=None):
+        self.name = name
+        self.type = type
+        self.bitsize = bitsize
+        self.is_base_class = is_base_class
+        self.artificial = artificial
+        # Like GDB, static fields have no bitpos and only enumerators have
+        # an enumval.
+        if bitpos is not None:
+            self.bitpos = bitpos
+        if enumval is not None:
+            self.enumval = enumval
+
+
+class Symbol(object):
+    def __init__(self, name, type, addr_class=SYMBOL_LOC_TYPEDEF):
+        self.name = name
+        self.type = type
+        self.addr_class = addr_class
+
+
+class Objfile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.build_id = hashlib.sha1(filename.encode("utf-8")).hexdigest()
+        self.symbols = {}
+
+    def is_valid(self):
+        return True
+
+    def lookup_static_symbol(self, name):
+        return self.symbols.get(name)
+
+    def lookup_global_symbol(self, name):
+        return None
+
+
+class Progspace(object):
+    def __init__(self, filename):
+        self.filename = filename
+
+
+class Value(object):
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+class Frame(object):
+    def __init__(self, level):
+        self.level = level
+
+    def pc(self):
+        return FUNCTIONS_START + (self.level % FUNCTION_COUNT) * FUNCTION_SIZE + 0x10
+
+    def read_register(self, name):
+        sp = 0x7ffe0000 - self.level * 0x100
+        return sp if name == "sp" else sp + 0x80
+
+    def older(self):
+        if self.level + 1 >= stack_depth:
+            return None
+        return Frame(self.level + 1)
+
+    def block(self):
+        raise RuntimeError("Cannot locate block for frame.")
+
+
+class Thread(object):
+    ptid = (1000, 1000, 0)
+
+    def switch(self):
+        pass
+
+
+class Inferior(object):
+    pid = 1000
+
+    def __init__(self):
+        self.pattern = bytearray(range(256)) * 257
+
+    def read_memory(self, address, size):
+        if address < HEAP_START or address + size > HEAP_START + HEAP_SIZE:
+            raise error("Cannot access memory at address 0x%x" % (address))
+        result = bytearray()
+        while len(result) < size:
+            offset = (address + len(result)) % 256
+            result += self.pattern[offset:offset + min(size - len(result), 65536)]
+        return memory_buffer(bytes(result))
+
+    def write_memory(self, address, data):
+        pass
+
+    def threads(self):
+        return [Thread()]
+
+
+types = {}
+objfile_list = []
+main_program = "/out/chrome"
+stack_depth = 60
+inferior = Inferior()
+int_type = Type("int", TYPE_CODE_INT, 4)
+void_type = Type("void", TYPE_CODE_VOID, 1)
+unsigned_long_long_type = Type("unsigned long long", TYPE_CODE_INT, 8)
+
+
+def AddType(objfile, t):
+    types[t.name] = t
+    objfile.symbols[t.name] = Symbol(t.name, t)
+
+
+def Install(objfiles=500, depth=20, fieldsPerType=50, largeTypeFields=5000,
+            enumerators=1000):
+    """Builds the synthetic program and installs this module as "gdb".
+
+    The main objfile, chrome, contains:
+    - blink::Node0 ... blink::Node<depth-1>, where each Node<n> derives from
+      Node<n-1> and has |fieldsPerType| fields (ints, pointers to other
+      nodes, an enum, a bitfield and an anonymous union).
+    - blink::Large with |largeTypeFields| int fields.
+    - blink::State, an enum class with |enumerators| values.
+    """
+    del objfile_list[:]
+    types.clear()
+    for i in range(objfiles):
+        objfile_list.append(Objfile("/usr/lib/x86_64-linux-gnu/libsynthetic%d.so.%d" % (i, i % 3)))
+    chrome = Objfile(main_program)
+    objfile_list.append(chrome)
+
+    enumType = Type("blink::State", TYPE_CODE_ENUM, 4, fields=[
+        Field("blink::State::kState%d" % (i), int_type, enumval=i % (enumerators // 2 or 1))
+        for i in range(enumerators)])
+    AddType(chrome, enumType)
+
+    union = Type(None, TYPE_CODE_UNION, 8, fields=[
+        Field("u_int_", int_type, bitpos=0), Field("u_ptr_", void_type.pointer(), bitpos=0)])
+
+    base = None
+    for level in range(depth):
+        name = "blink::Node%d" % (level)
+        fields = []
+        bitpos = 0
+        if base is not None:
+            fields.append(Field(base.name, base, bitpos=0, is_base_class=True))
+            bitpos = base.sizeof * 8
+        else:
+            fields.append(Field("_vptr.Node0", void_type.pointer(), bitpos=0, artificial=True))
+            bitpos = 64
+        t = Type(name, TYPE_CODE_STRUCT, 0, fields=fields)
+        for i in range(fieldsPerType):
+            kind = i % 5
+            fieldName = "field%d_%d_" % (level, i)
+            if kind == 0:
+                fields.append(Field(fieldName, (base or t).pointer(), bitpos=bitpos))
+                bitpos += 64
+            elif kind == 1:
+                fields.append(Field(fieldName, enumType, bitpos=bitpos))
+                bitpos += 32
+            elif kind == 2:
+                fields.append(Field(fieldName, int_type, bitpos=bitpos, bitsize=3))
+                bitpos += 32
+            elif kind == 3:
+                fields.append(Field(None, union, bitpos=bitpos))
+                bitpos += 64
+            else:
+                fields.append(Field(fieldName, int_type, bitpos=bitpos))
+                bitpos += 32
+        fields.append(Field("kStatic%d" % (level), int_type))
+        t.sizeof = (bitpos + 63) // 64 * 8
+        AddType(chrome, t)
+        base = t
+
+    AddType(chrome, Type("blink::Large", TYPE_CODE_STRUCT, largeTypeFields * 4, fields=[
+        Field("member%d_" % (i), int_type, bitpos=i * 32) for i in range(largeTypeFields)]))
+
+    sys.modules["gdb"] = sys.modules[__name__]
+
+
+def objfiles():
+    return objfile_list
+
+
+def lookup_symbol(name):
+    for objfile in objfile_list:
+        symbol = objfile.lookup_static_symbol(name)
+        if symbol is not None:
+            return (symbol, False)
+    return (None, False)
+
+
+def lookup_type(name):
+    if name == "void":
+        return void_type
+    if name == "unsigned long long":
+        return unsigned_long_long_type
+    if name in types:
+        return types[name]
+    raise error("No type named %s." % (name))
+
+
+def parse_and_eval(expression):
+    if expression.startswith("(void*)"):
+        pointer = int(expression[len("(void*)"):])
+        offset = pointer - FUNCTIONS_START
+        if 0 <= offset < FUNCTION_COUNT * FUNCTION_SIZE:
+            function = offset // FUNCTION_SIZE
+            displacement = offset % FUNCTION_SIZE
+            suffix = "+%d" % (displacement) if displacement else ""
+            return Value("0x%x <blink::Function%d(int)%s>" % (pointer, function, suffix))
+        return Value("0x%x" % (pointer))
+    raise error("No symbol \"%s\" in current context." % (expression))
+
+
+def block_for_pc(pc):
+    return None
+
+
+def solib_name(pointer):
+    return None
+
+
+def current_progspace():
+    return Progspace(main_program)
+
+
+def selected_inferior():
+    return inferior
+
+
+def inferiors():
+    return [inferior]
+
+
+def selected_thread():
+    return Thread()
+
+
+def newest_frame():
+    return Frame(0)
+
+
+def execute(command, from_tty=False, to_string=False):
+    if command == "show endian":
+        return "The target endianness is set automatically (currently little endian).\n"
+    raise error("Undefined command: \"%s\"." % (command))
+
+
+def post_event(callback):
+    callback()
@@ -1,12 +1,15 @@
 import gdb
+import atexit
+import hashlib
 import sys
-import binascii
+import os
 import os.path
 import re
 import webbrowser
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)) + "/../JsDbg.Stdio")
 import JsDbgBase
+import JsDbgSnapshot
 import JsDbgTypes
 
 jsdbg = None
@@ -14,9 +17,295 @@ jsdbg_url = None
 last_pid = None
 last_tid = None
 
+# The functions that the JsDbg server can call.
+commands = JsDbgBase.CommandTable()
+# Metrics for the requests the server sends.
+stats = JsDbgBase.BridgeStats()
+
+# Memoized query results. Type and symbol metadata can only change when the
+# set of loaded objfiles changes; anything that depends on frames or on the
+# state of the inferior is only valid until the inferior runs again.
+type_cache = {}
+stop_cache = {}
+
+
+def Memoize(cache):
+    """Caches the results of the decorated function in |cache|, keyed by the
+    function name and its arguments."""
+    def decorator(func):
+        name = func.__name__
+        def wrapper(*args):
+            key = (name,) + args
+            try:
+                return cache[key]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable arguments; just don't cache this call.
+                return func(*args)
+            result = func(*args)
+            cache[key] = result
+            return result
+        wrapper.__name__ = name
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def ClearTypeCache():
+    type_cache.clear()
+    symbol_index.Clear()
+    CloseDiskCaches()
+    # Frame and value results may refer to types that are now stale.
+    stop_cache.clear()
+    snapshot_recorder.Clear()
+
+
+def ClearStopCache():
+    stop_cache.clear()
+    memory_cache.Clear()
+    prefetcher.Clear()
+    snapshot_recorder.ClearStop()
+
+
+class SnapshotRecorder(object):
+    """What the server looked at, for jsdbg-snapshot: the responses to its
+    queries, by query, and the (address, size) ranges of target memory
+    successfully read since the target stopped.
+
+    Responses about the stopped target and memory are only kept until it runs
+    again (see ClearStop), all responses only until the type cache is
+    cleared. So that sessions that never take a snapshot don't grow without
+    bound, at most maxQueryBytes of queries and responses and maxMemoryRanges
+    ranges are kept; what doesn't fit is left out of the snapshot.
+    """
+    maxQueryBytes = 64 * 1024 * 1024
+    maxMemoryRanges = 200000
+
+    def __init__(self):
+        self.queries = {}
+        self.stopQueries = {}
+        self.memory = []
+        self.queryBytes = 0
+        self.stopQueryBytes = 0
+        # Whether queries were left out of |queries| and |stopQueries|.
+        self.queriesTruncated = False
+        self.stopQueriesTruncated = False
+        self.memoryTruncated = False
+
+    def Clear(self):
+        self.queries.clear()
+        self.queryBytes = 0
+        self.queriesTruncated = False
+        self.stopQueries.clear()
+        self.stopQueryBytes = 0
+        self.stopQueriesTruncated = False
+
+    def ClearStop(self):
+        self.stopQueries.clear()
+        self.stopQueryBytes = 0
+        self.stopQueriesTruncated = False
+        del self.memory[:]
+        self.memoryTruncated = False
+
+    def Truncated(self):
+        """Whether anything was left out since the last clear."""
+        return (self.queriesTruncated or self.stopQueriesTruncated or
+            self.memoryTruncated)
+
+    def RecordQuery(self, command, result, stopDependent):
+        queries = self.stopQueries if stopDependent else self.queries
+        previous = queries.get(command)
+        if previous is None:
+            growth = len(command) + len(result)
+        else:
+            growth = len(result) - len(previous)
+        if self.queryBytes + self.stopQueryBytes + growth > self.maxQueryBytes:
+            if stopDependent:
+                self.stopQueriesTruncated = True
+            else:
+                self.queriesTruncated = True
+            return
+        queries[command] = result
+        if stopDependent:
+            self.stopQueryBytes += growth
+        else:
+            self.queryBytes += growth
+
+    def RecordMemory(self, ranges):
+        if len(self.memory) + len(ranges) > self.maxMemoryRanges:
+            self.memoryTruncated = True
+            return
+        self.memory.extend(ranges)
+
+    def Queries(self):
+        queries = dict(self.queries)
+        queries.update(self.stopQueries)
+        return queries
+
+
+snapshot_recorder = SnapshotRecorder()
+
+
+def RecordForSnapshot(name, command, result):
+    if (name not in commands.functions or name in commands.sideEffects or
+            name in JsDbgSnapshot.memory_functions):
+        return
+    snapshot_recorder.RecordQuery(command, result, name in commands.stopDependent)
+
+
+def ReadSnapshotMemory(ranges):
+    # Reads the target memory in the (address, size) |ranges|. Ranges that
+    # can't be read as a whole are read page by page, leaving out the pages
+    # that are not readable. Returns (address, bytes) pairs.
+    inferior = gdb.selected_inferior()
+    pageSize = JsDbgSnapshot.pageSize
+    regions = []
+    for (start, end, _) in JsDbgBase.MergeRanges(ranges):
+        try:
+            regions.append((start, bytes(inferior.read_memory(start, end - start))))
+            continue
+        except:
+            pass
+        address = start
+        while address < end:
+            pageEnd = min(end, (address // pageSize + 1) * pageSize)
+            try:
+                data = bytes(inferior.read_memory(address, pageEnd - address))
+                if regions and regions[-1][0] + len(regions[-1][1]) == address:
+                    regions[-1] = (regions[-1][0], regions[-1][1] + data)
+                else:
+                    regions.append((address, data))
+            except:
+                pass
+            address = pageEnd
+    return regions
+
+
+def CaptureSnapshot(path):
+    """Writes the responses to the server's queries and the target memory it
+    read since the target stopped to a snapshot file at |path|; see
+    JsDbgSnapshot.py. Returns the number of responses and of bytes of memory
+    in the snapshot."""
+    queries = snapshot_recorder.Queries()
+    regions = ReadSnapshotMemory(list(snapshot_recorder.memory))
+    try:
+        pointerFormat = GetPointerFormat()
+    except:
+        pointerFormat = "<Q"
+    JsDbgSnapshot.WriteSnapshot(path, queries, regions, pointerFormat)
+    return (len(queries), sum([len(data) for (_, data) in regions]))
+
+
+# The results of type metadata queries are also kept on disk, so that later
+# sessions on the same binary don't have to ask GDB again. There is a cache
+# file per objfile, named after the objfile's build-id (or its path,
+# modification time and size) and type_cache_version, which has to be bumped
+# whenever the results of the persistent functions change.
+type_cache_version = 1
+type_cache_dir = os.path.join(
+    os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "jsdbg", "types")
+# The names of the functions whose results are cached on disk.
+persistent_functions = set()
+# Objfile filename -> DiskCache (or None if it can't be used), for the
+# objfiles we looked up types in since the last ClearTypeCache.
+disk_caches = {}
+
+
+def Persistent(func):
+    """Marks a function whose first argument is a module name, whose second
+    argument is the name of a type, and whose result only depends on the
+    debug information of that module, so that DebuggerQuery can keep its
+    results in the module's DiskCache."""
+    persistent_functions.add(func.__name__)
+    return func
+
+
+def ObjfileCacheKey(objfile):
+    build_id = getattr(objfile, "build_id", None)
+    if build_id:
+        return "build-id %s" % (build_id)
+    info = os.stat(objfile.filename)
+    return "file %s %d %d" % (objfile.filename, info.st_mtime, info.st_size)
+
+
+def DiskCacheForModule(module):
+    if not type_cache_dir:
+        return None
+    objfile = FindObjfileForName(module)
+    # Without per-objfile symbol lookups, FindGdbSymbol may find types in
+    # any objfile, so the results would not belong to this one.
+    if objfile is None or not hasattr(objfile, 'lookup_static_symbol'):
+        return None
+    try:
+        return disk_caches[objfile.filename]
+    except KeyError:
+        pass
+    cache = None
+    try:
+        key = "%s %d" % (ObjfileCacheKey(objfile), type_cache_version)
+        name = "%s-%s" % (module, hashlib.sha1(key.encode("utf-8")).hexdigest()[:16])
+        if not os.path.isdir(type_cache_dir):
+            os.makedirs(type_cache_dir)
+        cache = JsDbgBase.DiskCache(os.path.join(type_cache_dir, name))
+    except Exception as e:
+        # E.g. another GDB has the file open for writing.
+        print("JsDbg: not caching types of %s on disk: %s" % (module, e))
+    disk_caches[objfile.filename] = cache
+    return cache
+
+
+def CloseDiskCaches():
+    for cache in disk_caches.values():
+        if cache is not None:
+            cache.Close()
+    disk_caches.clear()
+
+atexit.register(CloseDiskCaches)
+
+
+def CallPersistent(name, args, command):
+    """Runs the persistent function |name|, with its result cached on disk
+    under the text of the query. Returns the result as a string."""
+    cache = DiskCacheForModule(args[0]) if args else None
+    if cache is None:
+        return JsDbgTypes.Serialize(commands.Invoke(name, args))
+    result = cache.Get(command)
+    if result is None:
+        result = JsDbgTypes.Serialize(commands.Invoke(name, args))
+        # Types that can't be found now may show up once more debug
+        # information is loaded (e.g. from a separate debug file), so only
+        # results about types that exist are kept.
+        if len(args) > 1 and FindGdbType(args[0], args[1]) is not None:
+            cache.Put(command, result)
+    return result
+
+
+def ReadInferiorMemory(pointer, size):
+    data = gdb.selected_inferior().read_memory(pointer, size)
+    snapshot_recorder.RecordMemory([(pointer, size)])
+    return data
+
+def PrefetchInferiorMemory(pointer, size):
+    # Prefetched memory only goes into snapshots once the server uses it.
+    return gdb.selected_inferior().read_memory(pointer, size)
+
+def PrefetchedMemoryUsed(page, size):
+    snapshot_recorder.RecordMemory([(page, size)])
+
+
+# Target memory read by the server, valid until the inferior runs again.
+memory_cache = JsDbgBase.MemoryCache(ReadInferiorMemory,
+    prefetchUsedFunc=PrefetchedMemoryUsed)
+# Set while we write to the inferior ourselves, so that the memory_changed
+# event doesn't throw away the cache pages we are about to update.
+writing_memory = False
+
 
 class GdbFieldResult(JsDbgTypes.SFieldResult):
     # extra_bitoffset allows handling anonymous unions correctly
+    __slots__ = ()
+
     def __init__(self, field, extra_bitoffset=0):
         if hasattr(field, 'bitpos'):
             # If this is a bitfield, we adjust offset and bitOffset to be aligned
@@ -27,7 +316,7 @@ class GdbFieldResult(JsDbgTypes.SFieldResult):
             bitsize = field.type.sizeof * 8 if field.bitsize else 8
 
             bitOffset = bitpos % bitsize
-            offset = (bitpos - bitOffset) / 8
+            offset = (bitpos - bitOffset) // 8
         else:
             bitOffset = -1
             offset = -1
@@ -37,34 +326,105 @@ class GdbFieldResult(JsDbgTypes.SFieldResult):
 
 
 class GdbStackFrame(JsDbgTypes.SStackFrame):
+    __slots__ = ()
+
     def __init__(self, frame):
         super(GdbStackFrame, self).__init__(
             frame.pc(), frame.read_register("sp"), frame.read_register("fp"))
 
 
 class GdbSymbolResult(JsDbgTypes.SSymbolResult):
-    def __init__(self, symbol, frame=None):
+    __slots__ = ()
+
+    def __init__(self, symbol, frame=None, value=None):
         type = FormatType(symbol.type)
-        if frame:
-            value = symbol.value(frame)
-        else:
-            value = symbol.value()
+        if value is None:
+            if frame:
+                value = symbol.value(frame)
+            else:
+                value = symbol.value()
         pointer = value.address.reinterpret_cast(gdb.lookup_type("unsigned long long"))
         super(GdbSymbolResult, self).__init__(type, pointer)
 
 
 class GdbNamedSymbol(JsDbgTypes.SNamedSymbol):
-    def __init__(self, symbol, frame):
+    __slots__ = ()
+
+    def __init__(self, symbol, frame, value=None, module=None):
+        if module is None:
+            module = ModuleForAddress(frame.pc())
         super(GdbNamedSymbol, self).__init__(
-            ModuleForAddress(frame.pc()), symbol.name,
-            GdbSymbolResult(symbol, frame))
+            module, symbol.name, GdbSymbolResult(symbol, frame, value))
+
+
+class FrameTable(object):
+    """The frames of the selected thread, indexed by (pc, sp).
+
+    Frames are walked lazily from the newest one, and only once per stop
+    (the table lives in the stop cache, see GetFrameTable).
+    """
+    def __init__(self):
+        self.frames = []
+        self.stackFrames = []
+        self.index = {}
+        self.nextFrame = gdb.newest_frame()
+
+    def WalkOne(self):
+        frame = self.nextFrame
+        if not frame:
+            return False
+        stackFrame = GdbStackFrame(frame)
+        self.frames.append(frame)
+        self.stackFrames.append(stackFrame)
+        self.index.setdefault(
+            (int(stackFrame.instructionAddress), int(stackFrame.stackAddress)),
+            frame)
+        self.nextFrame = frame.older()
+        return True
+
+    def GetStackFrames(self, count):
+        while len(self.frames) < count and self.WalkOne():
+            pass
+        return self.stackFrames[:count]
+
+    def Find(self, instructionAddress, stackAddress):
+        key = (instructionAddress, stackAddress)
+        while key not in self.index and self.WalkOne():
+            pass
+        return self.index.get(key)
+
+
+# Maps module names (as returned by JsDbgBase.FormatModule) to objfiles. None
+# means the index has to be rebuilt from gdb.objfiles() on the next lookup.
+objfile_index = None
+
+
+def IndexObjfile(objfile):
+    if not objfile.filename:
+        return
+    # If several objfiles map to the same name, the first one wins, just like
+    # it would when scanning gdb.objfiles() in order.
+    objfile_index.setdefault(JsDbgBase.FormatModule(objfile.filename), objfile)
+
+
+def InvalidateObjfileIndex():
+    global objfile_index
+    objfile_index = None
 
 
 def FindObjfileForName(name):
-    for objfile in gdb.objfiles():
-        if JsDbgBase.FormatModule(objfile.filename) == name:
-            return objfile
-    return None
+    global objfile_index
+    if objfile_index is None:
+        objfile_index = {}
+        for objfile in gdb.objfiles():
+            IndexObjfile(objfile)
+    objfile = objfile_index.get(name)
+    if objfile is not None and not objfile.is_valid():
+        # The objfile went away without us hearing about it (GDB before 13
+        # does not tell us); rescan.
+        InvalidateObjfileIndex()
+        return FindObjfileForName(name)
+    return objfile
 
 
 def FindGdbSymbol(module, symbol):
@@ -85,6 +445,7 @@ def FindGdbSymbol(module, symbol):
     return sym
 
 
+@Memoize(type_cache)
 def FindGdbType(module, type_name):
     # Types are also symbols, so we just look them up as symbols. This is
     # what GDB does internally.
@@ -96,14 +457,33 @@ def FindGdbType(module, type_name):
     return type_symbol.type
 
 
+@commands.Register
 def DebuggerQuery(tag, command):
-    # pi exec('print(\\'{0}~\\' + str({1}))')
+    name = None
+    start = JsDbgBase.timer()
     try:
-        result = eval(command)
-        return "%d~%s" % (tag, str(result))
+        (name, args) = JsDbgBase.ParseCall(command)
+        if name in persistent_functions:
+            result = CallPersistent(name, args, command)
+        else:
+            result = commands.Invoke(name, args)
+        response = "%d~%s" % (tag, JsDbgTypes.Serialize(result))
+        failed = False
     except:
         err = sys.exc_info()
-        return "%d!%s" % (tag, str(err[1]))
+        response = "%d!%s" % (tag, str(err[1]))
+        failed = True
+    if name is not None:
+        RecordForSnapshot(name, command, response[len(str(tag)):])
+    stats.Record(name or "(invalid)", JsDbgBase.timer() - start, len(response), failed)
+    return response
+
+
+@commands.Register
+def DebuggerBatch(queries):
+    # Runs a list of (tag, command) queries and returns all of the responses
+    # at once, one per line.
+    return "\n".join([DebuggerQuery(tag, command) for (tag, command) in queries])
 
 
 def IsFunctionPointer(t):
@@ -140,6 +520,8 @@ def ModuleForAddress(pointer):
         module = gdb.current_progspace().filename
     return JsDbgBase.FormatModule(module)
 
+@commands.Register
+@commands.SideEffects
 def ServerStarted(url):
     global jsdbg_url
     jsdbg_url = url
@@ -157,113 +539,208 @@ def ServerExited():
     print("JsDbg: server exited or crashed. To restart, type 'jsdbg'.")
     global jsdbg
     global jsdbg_url
+    if jsdbg:
+        jsdbg.StopTrace()
     jsdbg = None
     jsdbg_url = None
 
+@commands.Register
+@commands.SideEffects
 def ExecuteGdbCommand(cmd):
     gdb.execute(cmd)
 
 
-def GetAllFields(module, type, includeBaseTypes):
-    t = FindGdbType(module, type)
-    if t is None:
-        return None
-
-    resultFields = []
-
-    try:
-        fields = t.fields()
-    except:
-        # If this is a type that has no fields, return instead of throwing
-        # an exception (e.g. 'char').
-        return resultFields
-
-    for field in fields:
-        if field.is_base_class:
-            if not includeBaseTypes:
+class TypeLayout(object):
+    """The fields and base classes of a struct type, computed once (see
+    GetTypeLayout) and from the layouts of its base classes, so that the
+    fields of a base class are only looked at once however many types derive
+    from it.
+
+    Fields are kept by level: level 0 holds the type's own fields, level 1
+    those of its base classes, level 2 those of their base classes and so on,
+    which is the order GetAllFields returns them in and LookupField searches
+    them in. Like GDB, the offsets of inherited fields are relative to the
+    class that declares them."""
+
+    def __init__(self, module, t):
+        self.fieldsError = None
+        # For each level, the fields GetAllFields returns, and the fields
+        # LookupField finds by name: (fields declared at that level, fields
+        # of anonymous unions and structs at that level).
+        self.levels = []
+        self.nameLevels = []
+        # The fields GetAllFields returns without base types.
+        self.ownFields = []
+        # The base classes, depth first, with their offset in bits, or None
+        # if the type has no fields.
+        self.baseTypes = None
+        self.allFields = None
+        self.fieldsByName = None
+        try:
+            fields = t.fields()
+        except Exception as e:
+            # Not a struct, union or enum (e.g. 'char').
+            self.fieldsError = e
+            return
+
+        entries = []
+        declared = {}
+        anonymous = {}
+        bases = []
+        for field in fields:
+            isBase = field.is_base_class
+            if isBase:
+                bases.append(field)
+            if not field.name:
+                if field.type.code != gdb.TYPE_CODE_UNION and field.type.code != gdb.TYPE_CODE_STRUCT:
+                    # Don't know how to handle this
+                    continue
+                # Anonymous unions and structs: their fields belong to this
+                # type, at the offset of the container.
+                inner = [(f, GdbFieldResult(f, field.bitpos)) for f in field.type.fields()]
+                for (f, result) in inner:
+                    if f.name and f.name not in anonymous:
+                        anonymous[f.name] = result
+                if hasattr(field, 'bitpos') and not field.artificial:
+                    results = [result for (f, result) in inner if not f.is_base_class]
+                    entries.extend(results)
+                    if not isBase:
+                        self.ownFields.extend(results)
                 continue
-            fields += field.type.fields()
 
-        if not hasattr(field, 'bitpos'):
-            # Field is static
-            continue
-
-        if field.artificial:
-            # e.g. _vptr$OwnerTree
-            continue
-
-        if not field.name:
-            if field.type.code != gdb.TYPE_CODE_UNION and field.type.code != gdb.TYPE_CODE_STRUCT:
-                # Don't know how to handle this
+            result = GdbFieldResult(field)
+            if field.name not in declared:
+                declared[field.name] = result
+            if not hasattr(field, 'bitpos'):
+                # Field is static
                 continue
-
-            resultFields.extend([GdbFieldResult(f, field.bitpos)
-                for f in field.type.fields() if not f.is_base_class])
-            continue
-
-        resultFields.append(GdbFieldResult(field))
-
-    return resultFields
-
-
-# extra_bitoffset is used when we call this function recursively in multiple
-# inheritance cases.
-def GetBaseTypesFromGdbType(module, type, extra_bitoffset=0):
+            if field.artificial:
+                # e.g. _vptr$OwnerTree
+                continue
+            entries.append(result)
+            if not isBase:
+                self.ownFields.append(result)
+
+        self.levels.append(entries)
+        self.nameLevels.append((declared, anonymous))
+        self.baseTypes = []
+        baseLayouts = []
+        for base in bases:
+            layout = GetTypeLayout(module, base.type)
+            if layout.fieldsError is not None:
+                raise layout.fieldsError
+            baseLayouts.append(layout)
+            self.baseTypes.append((base.type.name, base.bitpos))
+            self.baseTypes.extend([(name, base.bitpos + bitpos)
+                for (name, bitpos) in layout.baseTypes])
+
+        if len(baseLayouts) == 1:
+            # Single inheritance: share the levels of the base class.
+            self.levels.extend(baseLayouts[0].levels)
+            self.nameLevels.extend(baseLayouts[0].nameLevels)
+            return
+        depth = max([len(layout.levels) for layout in baseLayouts] or [0])
+        for level in range(depth):
+            entries = []
+            declared = {}
+            anonymous = {}
+            for layout in baseLayouts:
+                if level >= len(layout.levels):
+                    continue
+                entries.extend(layout.levels[level])
+                (baseDeclared, baseAnonymous) = layout.nameLevels[level]
+                for (names, baseNames) in [(declared, baseDeclared), (anonymous, baseAnonymous)]:
+                    for (name, result) in baseNames.items():
+                        names.setdefault(name, result)
+            self.levels.append(entries)
+            self.nameLevels.append((declared, anonymous))
+
+    def AllFields(self):
+        if self.allFields is None:
+            self.allFields = [result for entries in self.levels for result in entries]
+        return self.allFields
+
+    def LookupField(self, name):
+        if self.fieldsError is not None:
+            raise self.fieldsError
+        if self.fieldsByName is None:
+            # The first level that has the field wins; within a level,
+            # declared fields win over those of anonymous unions and structs.
+            fieldsByName = {}
+            for (declared, anonymous) in self.nameLevels:
+                for names in (declared, anonymous):
+                    for (fieldName, result) in names.items():
+                        fieldsByName.setdefault(fieldName, result)
+            self.fieldsByName = fieldsByName
+        return self.fieldsByName.get(name)
+
+
+def GetTypeLayout(module, t):
+    """Returns the TypeLayout of the gdb.Type |t|."""
+    key = ("GetTypeLayout", module, t.name)
+    if t.name is None:
+        return TypeLayout(module, t)
     try:
-        fields = type.fields()
-    except:
-        # Type does not have fields (not a struct/class/union)
-        return [JsDbgTypes.SBaseTypeResult(module, type.name, 0)]
+        return type_cache[key]
+    except KeyError:
+        pass
+    layout = TypeLayout(module, t)
+    type_cache[key] = layout
+    return layout
 
-    resultFields = []
-    for field in fields:
-        if not field.is_base_class:
-            continue
-        resultFields.append(JsDbgTypes.SBaseTypeResult(
-            module, field.type.name, (extra_bitoffset + field.bitpos) / 8))
-        resultFields.extend(GetBaseTypesFromGdbType(
-            module, field.type, extra_bitoffset + field.bitpos))
 
-    return resultFields
+@commands.Register
+@Persistent
+@Memoize(type_cache)
+def GetAllFields(module, type, includeBaseTypes):
+    t = FindGdbType(module, type)
+    if t is None:
+        return None
 
+    layout = GetTypeLayout(module, t)
+    if includeBaseTypes:
+        return layout.AllFields()
+    return layout.ownFields
 
+
+@commands.Register
+@Persistent
+@Memoize(type_cache)
 def GetBaseTypes(module, type_name):
     t = FindGdbType(module, type_name)
     if t is None:
         # Type is a base type?
         return [JsDbgTypes.SBaseTypeResult(module, type_name, 0)]
 
-    return GetBaseTypesFromGdbType(module, t)
+    layout = GetTypeLayout(module, t)
+    if layout.baseTypes is None:
+        # Type does not have fields (not a struct/class/union)
+        return [JsDbgTypes.SBaseTypeResult(module, t.name, 0)]
+    return [JsDbgTypes.SBaseTypeResult(module, name, bitpos // 8)
+        for (name, bitpos) in layout.baseTypes]
 
+@commands.Register
+@Persistent
+@Memoize(type_cache)
 def IsTypeEnum(module, type):
     t = FindGdbType(module, type)
     if t is None:
         return False
     return t.code == gdb.TYPE_CODE_ENUM
 
+@commands.Register
+@Persistent
+@Memoize(type_cache)
 def LookupField(module, type, field):
     t = FindGdbType(module, type)
     if t is None:
         return None
 
-    fields = t.fields()
-    while fields:
-        match = list(filter(lambda x: x.name == field, fields))
-        if match:
-            return GdbFieldResult(match[0])
-
-        # Handle anonymous unions and structs. They are a bit tricky because we
-        # have to recurse into their fields but keep track of their offset.
-        containers = [c for c in fields if not c.name and
-          (c.type.code == gdb.TYPE_CODE_UNION or c.type.code == gdb.TYPE_CODE_STRUCT)]
-        for container in containers:
-            for f in container.type.fields():
-                if f.name == field:
-                    return GdbFieldResult(f, container.bitpos)
-
-        match = filter(lambda x: x.is_base_class, fields)
-        fields = [f for m in match for f in m.type.fields()]
+    return GetTypeLayout(module, t).LookupField(field)
 
+@commands.Register
+@commands.StopDependent
+@Memoize(stop_cache)
 def LookupGlobalSymbol(module, symbol):
     sym = FindGdbSymbol(module, symbol)
     if sym is None:
@@ -271,6 +748,7 @@ def LookupGlobalSymbol(module, symbol):
     return GdbSymbolResult(sym)
 
 
+@commands.Register
 def GetModuleForName(module):
     objfile = FindObjfileForName(module)
     if objfile:
@@ -280,35 +758,58 @@ def GetModuleForName(module):
     return None
 
 
+@Memoize(stop_cache)
+def GetFrameTable():
+    return FrameTable()
+
+@commands.Register
+@commands.StopDependent
+@Memoize(stop_cache)
 def GetCallStack(numFrames):
-    frame = gdb.newest_frame()
-    frames = []
-    while frame and numFrames > 0:
-        frames.append(GdbStackFrame(frame))
-        numFrames = numFrames - 1
-        frame = frame.older()
-    return frames
+    return GetFrameTable().GetStackFrames(numFrames)
 
+def GetSymbolsInFrame(frame):
+    try:
+        block = frame.block()
+    except:
+        # We are probably missing symbols for this frame.
+        return []
+    syms = []
+    while block and not block.is_global and not block.is_static:
+        syms.extend([s for s in block if s.addr_class != gdb.SYMBOL_LOC_TYPEDEF])
+        block = block.superblock
+
+    module = ModuleForAddress(frame.pc())
+    result = []
+    for s in syms:
+        value = s.value(frame)
+        if value.address is not None:
+            result.append(GdbNamedSymbol(s, frame, value, module))
+    return result
+
+@commands.Register
+@commands.StopDependent
+@Memoize(stop_cache)
 def GetSymbolsInStackFrame(instructionAddress, stackAddress, frameAddress):
-    frame = gdb.newest_frame()
-
-    while frame and not (frame.pc() == gdb.Value(instructionAddress) and frame.read_register('sp') == gdb.Value(stackAddress)):
-        frame = frame.older()
-
+    frame = GetFrameTable().Find(instructionAddress, stackAddress)
     if frame:
-        try:
-            block = frame.block()
-        except:
-            # We are probably missing symbols for this frame.
-            return []
-        syms = []
-        while block and not block.is_global and not block.is_static:
-            syms = syms + [s for s in block if s.addr_class != gdb.SYMBOL_LOC_TYPEDEF]
-            block = block.superblock
-
-        return [GdbNamedSymbol(s, frame) for s in syms if s.value(frame).address is not None]
+        return GetSymbolsInFrame(frame)
     return None
 
+@commands.Register
+@commands.StopDependent
+@Memoize(stop_cache)
+def GetCallStackWithSymbols(numFrames):
+    # GetCallStack and GetSymbolsInStackFrame for each of the frames in one
+    # go. Returns a flat list: each frame is followed by its symbols.
+    table = GetFrameTable()
+    stackFrames = table.GetStackFrames(numFrames)
+    return [JsDbgTypes.SStackFrameSymbols(stackFrame, GetSymbolsInFrame(frame))
+        for (frame, stackFrame) in zip(table.frames, stackFrames)]
+
+@commands.Register
+@Persistent
+@Memoize(type_cache)
 def LookupTypeSize(module, typename):
     typename = typename.strip()
     if (typename.endswith("*")):
@@ -320,45 +821,190 @@ def LookupTypeSize(module, typename):
     return t.sizeof
 
 
+class EnumIndex(object):
+    """Lookup tables for the constants of an enum type."""
+    def __init__(self, type):
+        self.constants = []
+        self.constantsByValue = {}
+        self.valuesByName = {}
+        try:
+            fields = type.fields()
+        except:
+            # Not a type with fields (e.g. 'int')
+            fields = []
+        for f in fields:
+            if not hasattr(f, 'enumval'):
+                continue
+            # GDB will give us "EnumType::Value", but we just want to return
+            # the "Value" part.
+            name = f.name
+            constant = JsDbgTypes.SConstantResult(name[name.rfind("::") + 2:], f.enumval)
+            self.constants.append(constant)
+            self.constantsByValue.setdefault(f.enumval, []).append(constant)
+            # Values in enum classes are stored as type::eFoo; regular enums
+            # as just eFoo. Allow looking them up by any qualified suffix.
+            self.valuesByName.setdefault(name, f.enumval)
+            index = name.find("::")
+            while index != -1:
+                self.valuesByName.setdefault(name[index + 2:], f.enumval)
+                index = name.find("::", index + 2)
+
+
+@Memoize(type_cache)
+def GetEnumIndex(module, type):
+    t = FindGdbType(module, type)
+    if t is None:
+        return None
+    return EnumIndex(t)
+
+
+@commands.Register
+@Persistent
+@Memoize(type_cache)
 def LookupConstants(module, type, value):
-    type = FindGdbType(module, type)
-    if type is None:
+    if not IsTypeEnum(module, type):
         return None
-    if type.code != gdb.TYPE_CODE_ENUM:
+    return GetEnumIndex(module, type).constantsByValue.get(value, [])
+
+
+@commands.Register
+@Persistent
+def LookupConstantsMany(module, type, values):
+    # LookupConstants for several values at once; returns all of the
+    # constants in one list, in the order of |values|.
+    if not IsTypeEnum(module, type):
         return None
-    values = []
-    for f in type.fields():
-        if f.enumval != value:
-            continue
+    constantsByValue = GetEnumIndex(module, type).constantsByValue
+    return [c for value in values for c in constantsByValue.get(value, [])]
 
-        # GDB will give us "EnumType::Value", but we just want to return the
-        # "Value" part.
-        name = f.name
-        name = name[name.rfind("::") + 2:]
-        values.append(JsDbgTypes.SConstantResult(name, f.enumval))
-    return values
+
+def GetEnumConstants(module, type):
+    # All of the constants of an enum type, in declaration order.
+    if not IsTypeEnum(module, type):
+        return []
+    return GetEnumIndex(module, type).constants
+
+
+def UnderlyingNamedType(t):
+    # Strips typedefs, pointers, references and arrays off a field type.
+    t = t.strip_typedefs()
+    while t.code in (gdb.TYPE_CODE_PTR, gdb.TYPE_CODE_ARRAY, gdb.TYPE_CODE_REF):
+        t = t.target().strip_typedefs()
+    return t
+
+
+@Memoize(type_cache)
+def GetReferencedTypes(module, type):
+    # Returns the names of the struct, union and enum types that the fields of
+    # |type| (including inherited ones) refer to, as (name, isEnum) tuples.
+    t = FindGdbType(module, type)
+    if t is None:
+        return []
+    result = []
+    seen = set()
+    pending = [t]
+    while pending:
+        try:
+            fields = pending.pop().fields()
+        except:
+            continue
+        for field in fields:
+            fieldType = UnderlyingNamedType(field.type)
+            if field.is_base_class or (not field.name and
+                    fieldType.code in (gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION)):
+                pending.append(fieldType)
+                continue
+            if not fieldType.name or fieldType.code not in (
+                    gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION, gdb.TYPE_CODE_ENUM):
+                continue
+            name = FormatType(fieldType)
+            if name not in seen:
+                seen.add(name)
+                result.append((name, fieldType.code == gdb.TYPE_CODE_ENUM))
+    return result
+
+
+@commands.Register
+@Persistent
+@Memoize(type_cache)
+def DescribeType(module, type, depth):
+    # Everything the server needs to know about a type in one go: its size,
+    # all fields (including inherited ones), base types and, for enums, the
+    # constants. Types that fields refer to are described as well, up to
+    # |depth| levels deep; enum types of fields are always included.
+    if FindGdbType(module, type) is None:
+        return None
+    result = []
+    described = set([type])
+    pending = [(type, depth)]
+    while pending:
+        (name, remainingDepth) = pending.pop(0)
+        isEnum = IsTypeEnum(module, name)
+        result.append(JsDbgTypes.STypeDescription(
+            module, name, LookupTypeSize(module, name), isEnum,
+            GetAllFields(module, name, True) or [],
+            GetBaseTypes(module, name),
+            GetEnumConstants(module, name) if isEnum else []))
+        for (referenced, referencedIsEnum) in GetReferencedTypes(module, name):
+            if referenced in described:
+                continue
+            if remainingDepth > 0 or referencedIsEnum:
+                described.add(referenced)
+                pending.append((referenced, remainingDepth - 1))
+    return result
 
 
+@commands.Register
 def LookupConstant(module, typename, constantName):
     if typename:
-        type = FindGdbType(module, typename)
-        if type is None:
-            return None
-        # Values in enum classes are stored as type::eFoo;
-        # regular enums as just eFoo.
-        matches = [f for f in type.fields() if f.name.endswith("::" + constantName) or f.name == constantName]
-        if matches and hasattr(matches[0], 'enumval'):
-            return str(matches[0].enumval)
-
-        # For non-enums, try another way
-        val = gdb.parse_and_eval("%s::%s" % (typename, constantName))
-    else:
-        val = gdb.parse_and_eval("%s" % constantName)
+        return LookupTypeConstant(module, typename, constantName)
+    return LookupGlobalConstant(constantName)
+
+@commands.Register
+def LookupConstantMany(module, typename, constantNames):
+    # LookupConstant for several names at once. Names that can't be found are
+    # left out of the result.
+    results = []
+    for name in constantNames:
+        try:
+            value = LookupConstant(module, typename, name)
+        except:
+            continue
+        if value is not None:
+            results.append(JsDbgTypes.SConstantResult(name, int(value)))
+    return results
+
+@Memoize(type_cache)
+def LookupTypeConstant(module, typename, constantName):
+    index = GetEnumIndex(module, typename)
+    if index is None:
+        return None
+    if constantName in index.valuesByName:
+        return str(index.valuesByName[constantName])
+
+    # For non-enums, try another way
+    val = gdb.parse_and_eval("%s::%s" % (typename, constantName))
+    integral_val = val.cast(gdb.lookup_type("unsigned long long"))
+    return str(integral_val)
 
+@Memoize(stop_cache)
+def LookupGlobalConstant(constantName):
+    val = gdb.parse_and_eval("%s" % constantName)
     integral_val = val.cast(gdb.lookup_type("unsigned long long"))
     return str(integral_val)
 
+# The address ranges of the symbols LookupSymbolName found so far, mapped to
+# (module, symbol name). Addresses that are not symbols are not kept; there
+# are too many of them.
+symbol_index = JsDbgBase.IntervalIndex()
+
+@commands.Register
 def LookupSymbolName(pointer):
+    found = symbol_index.Find(pointer)
+    if found is not None:
+        (start, (module, symbol)) = found
+        return JsDbgTypes.SSymbolNameAndDisplacement(module, symbol, pointer - start)
+
     module = ModuleForAddress(pointer)
     val = gdb.parse_and_eval("(void*)%d" % pointer)
     # Result looks like: '0x4004f1 <twiddle<int []>(int)+17>'
@@ -371,47 +1017,206 @@ def LookupSymbolName(pointer):
     offset = 0
     if groups[2]:
         offset = int(groups[2])
+
+    # Everything from the start of the symbol up to this address belongs to
+    # the same symbol (otherwise GDB would have named the other one). For
+    # functions, we know the whole range from the function's block.
+    start = pointer - offset
+    end = pointer + 1
+    try:
+        block = gdb.block_for_pc(pointer)
+        while block and not block.function:
+            block = block.superblock
+        if block and block.start == start:
+            end = max(end, block.end)
+    except RuntimeError:
+        pass
+    symbol_index.Add(start, end, (module, symbol))
     return JsDbgTypes.SSymbolNameAndDisplacement(module, symbol, offset)
 
-def ReadMemoryBytes(pointer, size):
-    inferior = gdb.selected_inferior()
+@commands.Register
+def LookupSymbolNames(pointers):
+    # LookupSymbolName for a list of pointers; pointers that are not symbols
+    # get an empty {} result.
+    results = []
+    for pointer in pointers:
+        result = LookupSymbolName(pointer)
+        results.append(JsDbgTypes.SNoResult() if result is None else result)
+    return results
+
+@commands.Register
+def GetBridgeFeatures():
+    # Lets the server find out which optional parts of the protocol this
+    # version of the bridge supports.
+    return " ".join(JsDbgBase.bridge_features)
+
+@commands.Register
+@commands.StopDependent
+def ReadMemoryBytes(pointer, size, encoding="hex"):
     # Note: will throw an error if this includes unmapped/ unreadable memory
-    buf = inferior.read_memory(pointer, size)
-    if (sys.version_info < (3, 0)):
-      return binascii.hexlify(bytearray(buf))
-    return buf.hex()
-
-def WriteMemoryBytes(pointer, hexString):
+    buf = ReadAndPrefetch(pointer, size)
+    return JsDbgBase.EncodeMemory(buf, encoding)
+
+@commands.Direct("ReadMemoryBytes")
+def ReadMemoryBytesDirect(read, pointer, size, encoding="hex"):
+    # ReadMemoryBytes on the reader thread, while the target is stopped; see
+    # DirectMemoryProcess. Failed reads are retried with GDB.
+    data = read(pointer, size)
+    snapshot_recorder.RecordMemory([(pointer, size)])
+    return JsDbgBase.EncodeMemory(data, encoding)
+
+@commands.Register
+@commands.StopDependent
+def ReadMemoryRanges(ranges, encoding="hex"):
+    return JsDbgBase.ReadMemoryRanges(ReadAndPrefetch, ranges, encoding)
+
+@commands.Direct("ReadMemoryRanges")
+def ReadMemoryRangesDirect(read, ranges, encoding="hex"):
+    # ReadMemoryRanges on the reader thread, like ReadMemoryBytesDirect. If
+    # any of the ranges fails, all of them are read again with GDB.
+    results = JsDbgBase.ReadMemoryRanges(read, ranges, encoding)
+    if any([result.error is not None for result in results]):
+        raise IOError("Cannot read all ranges directly")
+    snapshot_recorder.RecordMemory(ranges)
+    return results
+
+@Memoize(type_cache)
+def GetPointerFormat():
+    # Returns the struct format for reading a pointer of the target.
+    size = gdb.lookup_type("void").pointer().sizeof
+    endian = gdb.execute("show endian", to_string=True)
+    return ("<" if "little" in endian else ">") + ("Q" if size == 8 else "I")
+
+def ParseHeapMappings(mappings):
+    # Returns the (start, end) ranges of the heap mappings in the output of
+    # "info proc mappings". Only GDB 12 and above show the permissions.
+    regions = []
+    for line in mappings.splitlines():
+        fields = line.split()
+        if len(fields) < 4 or not fields[0].startswith("0x"):
+            continue
+        rest = fields[4:]
+        perms = None
+        if rest and re.match(r"^[r-][w-][x-][ps]$", rest[0]):
+            perms = rest.pop(0)
+        if JsDbgBase.IsHeapMapping(perms, " ".join(rest)):
+            regions.append((int(fields[0], 16), int(fields[1], 16)))
+    return regions
+
+def HeapRegions():
+    # Returns the (start, end) ranges of the target's heap, where the objects
+    # the server looks at mostly live.
     inferior = gdb.selected_inferior()
-    byteString = binascii.unhexlify(hexString)
-    inferior.write_memory(pointer, byteString)
-
+    try:
+        if inferior.pid and IsNativeTarget(inferior):
+            return JsDbgBase.ProcessHeapRegions(inferior.pid)
+    except:
+        pass
+    try:
+        return ParseHeapMappings(gdb.execute("info proc mappings", to_string=True))
+    except:
+        return []
+
+def PrefetchTarget():
+    return (GetPointerFormat(), HeapRegions())
+
+# Reads the targets of pointers in memory the server read while there are no
+# requests, if jsdbg-prefetch-depth is set.
+prefetcher = JsDbgBase.Prefetcher(memory_cache, PrefetchInferiorMemory,
+    PrefetchTarget)
+
+def ReadAndPrefetch(pointer, size):
+    # Reads through the memory cache, and has the pointers in the memory that
+    # was read prefetched.
+    buf = memory_cache.Read(pointer, size)
+    if prefetcher.Notice(pointer, buf) and jsdbg:
+        jsdbg.PostIdle()
+    return buf
+
+def RunIdleTask():
+    return prefetcher.Run()
+
+@commands.Register
+@commands.StopDependent
+def FollowPointers(start, nextOffset, maxHops, readSize, encoding="hex"):
+    return JsDbgBase.FollowPointers(ReadAndPrefetch, GetPointerFormat(),
+        start, nextOffset, maxHops, readSize, encoding)
+
+@commands.Register
+@commands.StopDependent
+def FollowPointerTree(root, childOffsets, maxNodes, readSize, encoding="hex"):
+    return JsDbgBase.FollowPointerTree(ReadAndPrefetch, GetPointerFormat(),
+        root, childOffsets, maxNodes, readSize, encoding)
+
+@commands.Register
+@commands.SideEffects
+def WriteMemoryBytes(pointer, data, encoding="hex"):
+    global writing_memory
+    inferior = gdb.selected_inferior()
+    byteString = JsDbgBase.DecodeMemory(data, encoding)
+    writing_memory = True
+    try:
+        inferior.write_memory(pointer, byteString)
+    finally:
+        writing_memory = False
+    memory_cache.Write(pointer, byteString)
+
+@commands.Register
+def GetBridgeStats():
+    with stats.lock:
+        return [JsDbgTypes.SFunctionStats(name, f.calls, f.errors,
+                    f.queueTime * 1000000, f.executionTime * 1000000,
+                    f.responseBytes, f.histogram)
+                for (name, f) in sorted(stats.functions.items())]
+
+@commands.Register
+def GetMemoryCacheStats():
+    return JsDbgTypes.SMemoryCacheStats(memory_cache.hits, memory_cache.misses,
+        len(memory_cache.pages), memory_cache.maxPages, memory_cache.pageSize)
+
+@commands.Register
+def GetPrefetchStats():
+    return JsDbgTypes.SPrefetchStats(prefetcher.pagesRead,
+        memory_cache.prefetchHits, prefetcher.failures, prefetcher.depth,
+        prefetcher.budget)
+
+@commands.Register
 def GetAttachedProcesses():
     processes = ', '.join(["%d" % (inferior.pid) for inferior in gdb.inferiors() if inferior.pid])
     return '[%s]' % (processes)
 
+@commands.Register
 def GetCurrentProcessThreads():
     return [thread.ptid[2] or thread.ptid[1] for thread in gdb.selected_inferior().threads()]
 
+@commands.Register
 def GetTargetProcess():
     return "%d" % (gdb.selected_inferior().pid)
 
+@commands.Register
 def GetTargetThread():
     thread = gdb.selected_thread()
     return thread.ptid[2] or thread.ptid[1]
 
+@commands.Register
+@commands.SideEffects
 def SetTargetProcess(pid):
     match = [i for i in gdb.inferiors() if i.pid == pid]
     if not match:
         raise ValueError('No such process %i' % (pid))
     # Last thread seems to be the main thread, switch to that
     threads = match[0].threads()[-1].switch()
+    ClearStopCache()
+    UpdateDirectMemory()
 
+@commands.Register
+@commands.SideEffects
 def SetTargetThread(tid):
     match = [t for t in gdb.selected_inferior().threads() if t.ptid[2] == tid or t.ptid[1] == tid]
     if not match:
         raise ValueError('No such thread %i' % (pid))
     match[0].switch()
+    ClearStopCache()
 
 def CheckForProcessAndThreadChange():
     global last_tid
@@ -426,6 +1231,8 @@ def CheckForProcessAndThreadChange():
     except:
         current_thread = None
 
+    if last_pid != current_process or last_tid != current_thread:
+        ClearStopCache()
     if last_pid != current_process and jsdbg:
         jsdbg.SendEvent('proc %s' % (current_process))
     if last_tid != current_thread and jsdbg:
@@ -433,10 +1240,43 @@ def CheckForProcessAndThreadChange():
     last_pid = current_process
     last_tid = current_thread
 
+def DirectMemoryProcess():
+    # Returns the pid of the target if its memory can be read through
+    # /proc/<pid>/mem instead of GDB: it has to be a live process on this
+    # machine (not a core file or a remote target) that is stopped in all-stop
+    # mode, without breakpoints inserted into its memory.
+    if not direct_memory_param.value:
+        return None
+    try:
+        inferior = gdb.selected_inferior()
+        thread = gdb.selected_thread()
+        if not inferior.pid or thread is None or thread.is_running():
+            return None
+        if gdb.parameter("non-stop") or gdb.parameter("breakpoint always-inserted"):
+            return None
+        return inferior.pid if IsNativeTarget(inferior) else None
+    except:
+        return None
+
+def IsNativeTarget(inferior):
+    # Whether |inferior| runs on this machine, rather than being a core file
+    # or a remote target.
+    # Inferior.connection is only supported on GDB 11 and above.
+    connection = getattr(inferior, "connection", None)
+    if connection is not None:
+        return connection.type == "native"
+    return "- native " in gdb.execute("maint print target-stack", to_string=True)
+
+def UpdateDirectMemory():
+    if jsdbg:
+        jsdbg.SetDirectMemoryProcess(DirectMemoryProcess())
+
 def StoppedHandler(ev):
     global jsdbg
+    ClearStopCache()
     if jsdbg:
         jsdbg.SendEvent('stop')
+    UpdateDirectMemory()
 
 def ContHandler(ev):
     global jsdbg
@@ -444,16 +1284,37 @@ def ContHandler(ev):
     # This may be the initial "run"; send a notification if so
     if not last_tid:
         CheckForProcessAndThreadChange()
+    ClearStopCache()
     if jsdbg:
         jsdbg.SendEvent('cont')
 
 def ExitHandler(ev):
     global jsdbg
+    ClearStopCache()
     if jsdbg:
         jsdbg.SendEvent('exit')
 
 def PromptHandler():
     CheckForProcessAndThreadChange()
+    UpdateDirectMemory()
+
+def MemoryChangedHandler(ev):
+    if not writing_memory:
+        memory_cache.Invalidate(int(ev.address), ev.length)
+
+def InferiorCallHandler(ev):
+    # The called function may have changed anything.
+    if isinstance(ev, gdb.InferiorCallPostEvent):
+        ClearStopCache()
+
+def NewObjfileHandler(ev):
+    ClearTypeCache()
+    if objfile_index is not None:
+        IndexObjfile(ev.new_objfile)
+
+def ObjfilesChangedHandler(ev):
+    ClearTypeCache()
+    InvalidateObjfileIndex()
 
 # To allow for easier unittesting, check if we have an events attribute
 if hasattr(gdb, 'events'):
@@ -463,6 +1324,17 @@ if hasattr(gdb, 'events'):
     # before_prompt is only supported on GDB 8.0 and above.
     if hasattr(gdb.events, 'before_prompt'):
       gdb.events.before_prompt.connect(PromptHandler)
+    gdb.events.memory_changed.connect(MemoryChangedHandler)
+    # inferior_call is only supported on GDB 7.12 and above.
+    if hasattr(gdb.events, 'inferior_call'):
+      gdb.events.inferior_call.connect(InferiorCallHandler)
+    gdb.events.new_objfile.connect(NewObjfileHandler)
+    # clear_objfiles is only supported on GDB 8.1 and above, free_objfile
+    # only on GDB 13 and above.
+    if hasattr(gdb.events, 'clear_objfiles'):
+      gdb.events.clear_objfiles.connect(ObjfilesChangedHandler)
+    if hasattr(gdb.events, 'free_objfile'):
+      gdb.events.free_objfile.connect(ObjfilesChangedHandler)
 
 
 class VerboseParam(gdb.Parameter):
@@ -490,6 +1362,244 @@ Only useful for debugging JsDbg itself."""
 
 verbose_param = VerboseParam()
 
+class DirectMemoryParam(gdb.Parameter):
+    """
+When enabled, JsDbg reads the memory of a stopped local process through
+/proc/<pid>/mem, next to GDB, instead of waiting for GDB to read it. Core files,
+remote targets and non-stop mode always go through GDB."""
+    set_doc = 'Sets whether JsDbg reads target memory without GDB'
+    show_doc = 'Shows the current setting for jsdbg-direct-memory'
+    def __init__(self):
+        super(DirectMemoryParam, self).__init__("jsdbg-direct-memory",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_BOOLEAN)
+        self.value = True
+
+    def get_set_string(self):
+        UpdateDirectMemory()
+        if self.value:
+            return 'Reading memory of stopped local processes without GDB'
+        else:
+            return 'Reading all memory through GDB'
+    def get_show_string(self, svalue):
+        return 'jsdbg-direct-memory is ' + svalue
+
+direct_memory_param = DirectMemoryParam()
+
+class MemoryCachePagesParam(gdb.Parameter):
+    """
+The maximum number of pages of target memory that JsDbg keeps cached while
+the target is stopped. 0 disables the cache."""
+    set_doc = 'Sets the size of the JsDbg memory cache, in pages'
+    show_doc = 'Shows the size of the JsDbg memory cache, in pages'
+    def __init__(self):
+        super(MemoryCachePagesParam, self).__init__("jsdbg-memory-cache-pages",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_ZUINTEGER)
+        self.value = memory_cache.maxPages
+
+    def get_set_string(self):
+        memory_cache.Configure(memory_cache.pageSize, self.value)
+        return 'JsDbg memory cache holds up to %d pages' % (self.value)
+    def get_show_string(self, svalue):
+        return 'jsdbg-memory-cache-pages is ' + svalue
+
+class MemoryCachePageSizeParam(gdb.Parameter):
+    """
+The size of the pages in the JsDbg memory cache, in bytes. Memory is read
+from the target in multiples of this size. 0 disables the cache."""
+    set_doc = 'Sets the page size of the JsDbg memory cache'
+    show_doc = 'Shows the page size of the JsDbg memory cache'
+    def __init__(self):
+        super(MemoryCachePageSizeParam, self).__init__("jsdbg-memory-cache-page-size",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_ZUINTEGER)
+        self.value = memory_cache.pageSize
+
+    def get_set_string(self):
+        memory_cache.Configure(self.value, memory_cache.maxPages)
+        return 'JsDbg memory cache pages are %d bytes' % (self.value)
+    def get_show_string(self, svalue):
+        return 'jsdbg-memory-cache-page-size is ' + svalue
+
+memory_cache_pages_param = MemoryCachePagesParam()
+memory_cache_page_size_param = MemoryCachePageSizeParam()
+
+class PrefetchDepthParam(gdb.Parameter):
+    """
+When set, JsDbg looks for pointers into the heap in memory the server reads,
+and reads the pages they point to into the memory cache while it has nothing
+else to do, up to this many pointers deep. 0 turns this off. Reads answered
+without GDB (see jsdbg-direct-memory) don't use the cache and are not looked
+at. jsdbg-stats shows how many prefetched pages get used."""
+    set_doc = 'Sets how many levels of pointers JsDbg prefetches'
+    show_doc = 'Shows how many levels of pointers JsDbg prefetches'
+    def __init__(self):
+        super(PrefetchDepthParam, self).__init__("jsdbg-prefetch-depth",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_ZUINTEGER)
+        self.value = prefetcher.depth
+
+    def get_set_string(self):
+        prefetcher.depth = self.value
+        if self.value:
+            return 'JsDbg prefetches pointer targets %d levels deep' % (self.value)
+        else:
+            return 'JsDbg does not prefetch pointer targets'
+    def get_show_string(self, svalue):
+        return 'jsdbg-prefetch-depth is ' + svalue
+
+class PrefetchBudgetParam(gdb.Parameter):
+    """
+The maximum number of bytes JsDbg prefetches (see jsdbg-prefetch-depth) each
+time the target stops."""
+    set_doc = 'Sets how much memory JsDbg prefetches per stop, in bytes'
+    show_doc = 'Shows how much memory JsDbg prefetches per stop, in bytes'
+    def __init__(self):
+        super(PrefetchBudgetParam, self).__init__("jsdbg-prefetch-budget",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_ZUINTEGER)
+        self.value = prefetcher.budget
+
+    def get_set_string(self):
+        prefetcher.budget = self.value
+        return 'JsDbg prefetches up to %d bytes per stop' % (self.value)
+    def get_show_string(self, svalue):
+        return 'jsdbg-prefetch-budget is ' + svalue
+
+prefetch_depth_param = PrefetchDepthParam()
+prefetch_budget_param = PrefetchBudgetParam()
+
+class TypeCacheDirParam(gdb.Parameter):
+    """
+The directory where JsDbg keeps type information of the debugged binaries
+across sessions. Unset it to not keep any."""
+    set_doc = 'Sets the directory for the JsDbg type cache'
+    show_doc = 'Shows the directory for the JsDbg type cache'
+    def __init__(self):
+        super(TypeCacheDirParam, self).__init__("jsdbg-type-cache-dir",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_OPTIONAL_FILENAME)
+        self.value = type_cache_dir
+
+    def get_set_string(self):
+        global type_cache_dir
+        type_cache_dir = self.value
+        CloseDiskCaches()
+        if self.value:
+            return 'Caching JsDbg type information in %s' % (self.value)
+        else:
+            return 'Not caching JsDbg type information on disk'
+    def get_show_string(self, svalue):
+        return 'jsdbg-type-cache-dir is ' + svalue
+
+type_cache_dir_param = TypeCacheDirParam()
+
+class TraceFileParam(gdb.Parameter):
+    """
+When set, JsDbg records all requests from the server, the responses and
+events and their timing to this file. Use JsDbgReplay.py or jsdbg-replay to
+look at or replay the trace. Unset it to stop recording."""
+    set_doc = 'Sets the file to record JsDbg traffic to'
+    show_doc = 'Shows the file JsDbg traffic is recorded to'
+    def __init__(self):
+        super(TraceFileParam, self).__init__("jsdbg-trace-file",
+            gdb.COMMAND_MAINTENANCE, gdb.PARAM_OPTIONAL_FILENAME)
+
+    def get_set_string(self):
+        if jsdbg is not None:
+            # Otherwise, recording starts when we start JsDbg.
+            UpdateTrace()
+        if self.value:
+            return 'Recording JsDbg traffic to %s' % (self.value)
+        else:
+            return 'Not recording JsDbg traffic'
+    def get_show_string(self, svalue):
+        return 'jsdbg-trace-file is ' + svalue
+
+trace_file_param = TraceFileParam()
+
+def UpdateTrace():
+    if trace_file_param.value:
+        jsdbg.StartTrace(trace_file_param.value)
+    else:
+        jsdbg.StopTrace()
+
+class StatsCmd(gdb.Command):
+  """Shows JsDbg request metrics: call counts, time spent waiting for and
+running requests, response sizes and errors, per function. Times are totals;
+p50/p99 are upper bounds from a latency histogram; one is also kept of how
+long requests waited for the debugger. Also shows how many responses are
+waiting to be written to the server, and how many prefetched pages were used
+(see jsdbg-prefetch-depth).
+Usage: jsdbg-stats [reset]"""
+
+  def __init__(self):
+    super(StatsCmd, self).__init__("jsdbg-stats", gdb.COMMAND_MAINTENANCE)
+
+  def invoke(self, arg, from_tty):
+    if arg.strip() == "reset":
+        stats.Reset()
+        memory_cache.ResetStats()
+        prefetcher.ResetStats()
+        print("JsDbg metrics reset")
+    elif arg.strip():
+        raise gdb.GdbError("Usage: jsdbg-stats [reset]")
+    else:
+        print(stats.Format())
+        print("Memory cache: %d hits, %d misses, %d/%d pages of %d bytes" % (
+            memory_cache.hits, memory_cache.misses, len(memory_cache.pages),
+            memory_cache.maxPages, memory_cache.pageSize))
+        if prefetcher.depth or prefetcher.pagesRead:
+            pages = prefetcher.pagesRead
+            print("Prefetch: %d pages read, %d used (%d%%), %d failed reads" % (
+                pages, memory_cache.prefetchHits,
+                memory_cache.prefetchHits * 100 // pages if pages else 0,
+                prefetcher.failures))
+        if jsdbg is not None:
+            writer = jsdbg.writer
+            print("Response queue: %d queued (at most %d so far), %d flushes, %d bytes" % (
+                writer.Depth(), writer.maxDepth, writer.flushes, writer.bytesWritten))
+    self.dont_repeat()
+
+StatsCmd()
+
+class ReplayCmd(gdb.Command):
+  """Runs the requests in a JsDbg trace (see jsdbg-trace-file) against the
+current target and compares the responses and run times to the recorded ones.
+Usage: jsdbg-replay TRACE"""
+
+  def __init__(self):
+    super(ReplayCmd, self).__init__("jsdbg-replay", gdb.COMMAND_MAINTENANCE)
+
+  def invoke(self, arg, from_tty):
+    if not arg.strip():
+        raise gdb.GdbError("Usage: jsdbg-replay TRACE")
+    records = JsDbgBase.ReadTrace(os.path.expanduser(arg.strip()))
+    results = JsDbgBase.ReplayTrace(sys.modules[__name__], records)
+    print(JsDbgBase.FormatReplay(results))
+    self.dont_repeat()
+
+ReplayCmd()
+
+class SnapshotCmd(gdb.Command):
+  """Writes the results of the queries the JsDbg server made and the target
+memory it read since the target stopped to a snapshot file. Run
+"python JsDbgSnapshot.py FILE" from the JsDbg.Stdio directory to look at the
+snapshot later, without GDB.
+Usage: jsdbg-snapshot FILE"""
+
+  def __init__(self):
+    super(SnapshotCmd, self).__init__("jsdbg-snapshot", gdb.COMMAND_USER)
+
+  def invoke(self, arg, from_tty):
+    if not arg.strip():
+        raise gdb.GdbError("Usage: jsdbg-snapshot FILE")
+    path = os.path.expanduser(arg.strip())
+    (queries, size) = CaptureSnapshot(path)
+    print("JsDbg: wrote %d query results and %d bytes of memory to %s" % (
+        queries, size, path))
+    if snapshot_recorder.Truncated():
+        print("JsDbg: the snapshot is incomplete; the server looked at more "
+            "than JsDbg keeps track of")
+    self.dont_repeat()
+
+SnapshotCmd()
+
 class JsDbgCmd(gdb.Command):
   """Runs JsDbg."""
 
@@ -503,6 +1613,9 @@ class JsDbgCmd(gdb.Command):
         jsdbg = JsDbgBase.JsDbg(
             sys.modules[__name__], gdb.post_event, ServerExited,
             verbose_param.value)
+        if trace_file_param.value:
+            UpdateTrace()
+        UpdateDirectMemory()
     else:
         ServerStarted(jsdbg_url)
     self.dont_repeat()
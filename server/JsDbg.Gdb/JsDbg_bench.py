@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# Benchmarks for JsDbg.py, run against the synthetic program in FakeGdb.py.
+# Use "python JsDbg_bench.py" to run, "python JsDbg_bench.py --help" for
+# options.
+#
+# A request stream is a file with one request per line, as the server sends
+# them (DebuggerQuery(1,'GetAllFields(...)')). Lines copied from the output
+# of "set jsdbg-verbose on" work too, as do traces recorded with "set
+# jsdbg-trace-file". Without a stream file, a synthetic stream that resembles
+# loading a tree of objects in an extension is used.
+#
+# "python JsDbg_bench.py --serializer" instead compares str() with
+# JsDbgTypes.Serialize on large results.
+import argparse
+import re
+import sys
+
+import FakeGdb
+FakeGdb.Install()
+
+import JsDbg
+import JsDbgBase
+import JsDbgTypes
+
+verbose_prefix = "JsDbg [received command]: "
+error_regex = re.compile(r"^[0-9]+!", re.MULTILINE)
+
+
+def SyntheticStream(depth, fieldsPerType, nodes):
+    """Returns the requests the server might send to show |nodes| objects of
+    the most derived blink::Node type."""
+    leaf = "blink::Node%d" % (depth - 1)
+    queries = [
+        "GetCallStack(50)",
+        "GetCallStackWithSymbols(50)",
+        "LookupTypeSize('chrome','blink::Large')",
+        "GetAllFields('chrome','blink::Large',True)",
+        "LookupField('chrome','blink::Large','member4999_')",
+        "IsTypeEnum('chrome','blink::State')",
+        "GetModuleForName('synthetic499')",
+        "LookupGlobalSymbol('synthetic1','missing')",
+        "DescribeType('chrome','%s',2)" % (leaf),
+    ]
+    for level in range(depth):
+        queries.append("GetBaseTypes('chrome','blink::Node%d')" % (level))
+    for node in range(nodes):
+        pointer = FakeGdb.HEAP_START + node * 0x400
+        queries.extend([
+            "ReadMemoryBytes(%d,8)" % (pointer),
+            "LookupSymbolName(%d)" % (FakeGdb.FUNCTIONS_START + (node * 0x38) % 0x10000),
+            "GetAllFields('chrome','%s',True)" % (leaf),
+            "LookupField('chrome','%s','field0_%d_')" % (leaf, node % fieldsPerType),
+            "ReadMemoryBytes(%d,%d,'base64')" % (pointer + 8, 256),
+            "ReadMemoryRanges([(%d,16),(%d,16),(%d,4)])" % (
+                pointer + 0x100, pointer + 0x110, pointer + 0x800),
+            "LookupConstants('chrome','blink::State',%d)" % (node % 500),
+            "FollowPointers(%d,8,16,32)" % (pointer),
+        ])
+    return ["DebuggerQuery(%d,%s)" % (tag, repr(query))
+        for (tag, query) in enumerate(queries)]
+
+
+def ReadStream(path):
+    if JsDbgBase.IsTrace(path):
+        return [r.data for r in JsDbgBase.ReadTrace(path) if r.kind == "q"]
+    requests = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith(verbose_prefix):
+                line = line[len(verbose_prefix):]
+            if line.startswith("DebuggerQuery(") or line.startswith("DebuggerBatch("):
+                requests.append(line)
+    return requests
+
+
+def Percentile(sortedTimes, fraction):
+    return sortedTimes[min(len(sortedTimes) - 1, int(fraction * len(sortedTimes)))]
+
+
+def Run(requests, passes, clear):
+    """Runs |requests| |passes| times. Returns the run times of the requests
+    and the number of failed requests, per function, and the total time."""
+    names = [JsDbgBase.RequestFunctionName(request) for request in requests]
+    times = {}
+    errors = {}
+    total = 0.0
+    for _ in range(passes):
+        if clear != "none":
+            JsDbg.ClearTypeCache()
+            JsDbg.ClearStopCache()
+        for (name, line) in zip(names, requests):
+            if clear == "request":
+                JsDbg.ClearTypeCache()
+                JsDbg.ClearStopCache()
+            request = JsDbgBase.JsDbg.JsDbgRequest(JsDbg, line, False)
+            start = JsDbgBase.timer()
+            response = request()
+            elapsed = JsDbgBase.timer() - start
+            times.setdefault(name, []).append(elapsed)
+            errors[name] = errors.get(name, 0) + len(error_regex.findall(response))
+            total += elapsed
+    return (times, errors, total)
+
+
+def Report(times, errors, total):
+    lines = ["%-28s %7s %6s %10s %10s %9s %9s %9s" % (
+        "Function", "Calls", "Errors", "Total ms", "Calls/s", "p50 us",
+        "p90 us", "p99 us")]
+    for name in sorted(times):
+        t = sorted(times[name])
+        spent = sum(t)
+        lines.append("%-28s %7d %6d %10.2f %10.0f %9.1f %9.1f %9.1f" % (
+            name, len(t), errors[name], spent * 1000, len(t) / spent if spent else 0,
+            Percentile(t, 0.5) * 1000000, Percentile(t, 0.9) * 1000000,
+            Percentile(t, 0.99) * 1000000))
+    calls = sum([len(t) for t in times.values()])
+    lines.append("%-28s %7d %6d %10.2f %10.0f" % (
+        "(all)", calls, sum(errors.values()), total * 1000, calls / total if total else 0))
+    return "\n".join(lines)
+
+
+def SerializerBenchmark(depth, passes):
+    """Times str() and JsDbgTypes.Serialize on some large results, and
+    checks that they agree."""
+    leaf = "blink::Node%d" % (depth - 1)
+    results = [
+        ("GetAllFields(Large)", JsDbg.GetAllFields("chrome", "blink::Large", True)),
+        ("GetAllFields(%s)" % (leaf), JsDbg.GetAllFields("chrome", leaf, True)),
+        ("GetBaseTypes(%s)" % (leaf), JsDbg.GetBaseTypes("chrome", leaf)),
+        ("DescribeType(%s)" % (leaf), JsDbg.DescribeType("chrome", leaf, 2)),
+        ("LookupConstantsMany(State)", JsDbg.LookupConstantsMany(
+            "chrome", "blink::State", list(range(500)))),
+    ]
+    lines = ["%-28s %8s %12s %14s %8s" % (
+        "Result", "Bytes", "str() us", "Serialize us", "Speedup")]
+    for (name, result) in results:
+        text = str(result)
+        if JsDbgTypes.Serialize(result) != text:
+            raise Exception("Serialize(%s) differs from str()" % (name))
+        times = []
+        for serialize in [str, JsDbgTypes.Serialize]:
+            start = JsDbgBase.timer()
+            for _ in range(passes):
+                serialize(result)
+            times.append((JsDbgBase.timer() - start) / passes)
+        lines.append("%-28s %8d %12.1f %14.1f %7.2fx" % (
+            name, len(text), times[0] * 1000000, times[1] * 1000000,
+            times[0] / times[1] if times[1] else 0))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks JsDbg.py against a fake GDB.")
+    parser.add_argument("stream", nargs="?",
+        help="file with the requests to replay (default: a synthetic stream)")
+    parser.add_argument("--passes", type=int, default=20,
+        help="how many times to replay the stream (default: 20)")
+    parser.add_argument("--clear", choices=["none", "pass", "request"], default="pass",
+        help="when to clear the type and stop caches (default: before each pass)")
+    parser.add_argument("--objfiles", type=int, default=500,
+        help="number of shared libraries in the synthetic program (default: 500)")
+    parser.add_argument("--depth", type=int, default=20,
+        help="depth of the synthetic class hierarchy (default: 20)")
+    parser.add_argument("--fields", type=int, default=50,
+        help="fields per class in the synthetic hierarchy (default: 50)")
+    parser.add_argument("--nodes", type=int, default=200,
+        help="objects the synthetic stream looks at (default: 200)")
+    parser.add_argument("--type-cache-dir",
+        help="keep type information in this directory, like jsdbg-type-cache-dir "
+            "(default: don't)")
+    parser.add_argument("--serializer", action="store_true",
+        help="compare str() and JsDbgTypes.Serialize instead of replaying requests")
+    options = parser.parse_args()
+
+    FakeGdb.Install(objfiles=options.objfiles, depth=options.depth,
+        fieldsPerType=options.fields)
+    JsDbg.InvalidateObjfileIndex()
+    JsDbg.type_cache_dir = options.type_cache_dir
+    if options.serializer:
+        print(SerializerBenchmark(options.depth, options.passes))
+        return
+    if options.stream:
+        requests = ReadStream(options.stream)
+    else:
+        requests = SyntheticStream(options.depth, options.fields, options.nodes)
+
+    (times, errors, total) = Run(requests, options.passes, options.clear)
+    print(Report(times, errors, total))
+
+
+if __name__ == '__main__':
+    main()
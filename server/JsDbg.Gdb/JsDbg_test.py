@@ -1,7 +1,11 @@
 #!/usr/bin/python
 # Unit tests for JsDb.py
 # Use "python JsDbg_test.py" to run.
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import unittest
 
 class GdbModule(object):
@@ -9,6 +13,29 @@ class GdbModule(object):
     COMMAND_MAINTENANCE = 2
 
     PARAM_BOOLEAN = 1
+    PARAM_ZUINTEGER = 2
+    PARAM_OPTIONAL_FILENAME = 3
+
+    TYPE_CODE_PTR = 1
+    TYPE_CODE_ARRAY = 2
+    TYPE_CODE_STRUCT = 3
+    TYPE_CODE_UNION = 4
+    TYPE_CODE_ENUM = 5
+    TYPE_CODE_FUNC = 7
+    TYPE_CODE_INT = 8
+
+    SYMBOL_LOC_TYPEDEF = 8
+
+    loaded_objfiles = []
+    frames = []
+
+    @staticmethod
+    def newest_frame():
+        return GdbModule.frames[0] if GdbModule.frames else None
+
+    @staticmethod
+    def objfiles():
+        return GdbModule.loaded_objfiles
 
     class Command(object):
         def __init__(self, name, type):
@@ -21,8 +48,133 @@ class GdbModule(object):
         def __init__(self, name, cmd_class, type):
             pass
 
+class FakeObjfile(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.valid = True
+
+    def is_valid(self):
+        return self.valid
+
+class FakeEnumerator(object):
+    def __init__(self, name, enumval):
+        self.name = name
+        self.enumval = enumval
+
+class FakeEnumType(object):
+    code = GdbModule.TYPE_CODE_ENUM
+
+    def __init__(self, enumerators):
+        self.enumerators = enumerators
+        self.calls = 0
+
+    def fields(self):
+        self.calls += 1
+        return [FakeEnumerator(name, value) for (name, value) in self.enumerators]
+
+class FakeType(object):
+    def __init__(self, name, code, sizeof, fields=None):
+        self.name = name
+        self.code = code
+        self.sizeof = sizeof
+        self._fields = fields
+        self.calls = 0
+
+    def fields(self):
+        self.calls += 1
+        if self._fields is None:
+            raise TypeError('Type is not a structure, union, enum, or function type.')
+        return list(self._fields)
+
+    def strip_typedefs(self):
+        return self
+
+    def __str__(self):
+        return self.name
+
+class FakeField(object):
+    def __init__(self, name, type, bitpos=None, is_base_class=False):
+        self.name = name
+        self.type = type
+        self.bitsize = 0
+        self.is_base_class = is_base_class
+        self.artificial = False
+        # Static fields have no bitpos.
+        if bitpos is not None:
+            self.bitpos = bitpos
+
+class FakeSymbol(object):
+    def __init__(self, type):
+        self.type = type
+        self.addr_class = GdbModule.SYMBOL_LOC_TYPEDEF
+
+class FakeFrame(object):
+    def __init__(self, pc, sp, older=None):
+        self.registers = {'sp': sp, 'fp': sp + 8}
+        self._pc = pc
+        self._older = older
+        self.walked = False
+
+    def pc(self):
+        return self._pc
+
+    def read_register(self, name):
+        self.walked = True
+        return self.registers[name]
+
+    def older(self):
+        return self._older
+
+class FakeMemory(object):
+    """Readable memory from 0x1000 to 0x1100; byte values are address % 256."""
+    def __init__(self):
+        self.data = bytearray(range(256))
+        self.reads = []
+
+    def Read(self, address, size):
+        self.reads.append((address, size))
+        if address < 0x1000 or address + size > 0x1100:
+            raise Exception('Cannot access memory at address 0x%x' % (address))
+        return self.data[address - 0x1000:address - 0x1000 + size]
+
+    def WritePointer(self, address, pointer):
+        self.data[address - 0x1000:address - 0x1000 + 8] = struct.pack('<Q', pointer)
+
+class FakeWriter(object):
+    def __init__(self):
+        self.data = []
+
+    def Write(self, data):
+        self.data.append(data)
+
 sys.modules['gdb'] = GdbModule
 import JsDbg
+import JsDbgBase
+import JsDbgSnapshot
+# Don't touch the user's type cache.
+JsDbg.type_cache_dir = None
+
+class FakeJsDbg(JsDbgBase.JsDbg):
+    """A JsDbg that talks to JsDbg.py, without a server."""
+    def __init__(self):
+        self.module = JsDbg
+        self.verbose = False
+        self.requestSequence = 0
+        self.mergeableRequests = {}
+        self.writer = FakeWriter()
+        self.pendingRequests = []
+        self.pendingRequestsLock = threading.Lock()
+        self.batchPosted = False
+        self.idleWanted = False
+        self.idlePosted = False
+        self.posted = []
+        self.trace = None
+        self.generation = 0
+        self.pendingSideEffects = 0
+        self.directMemory = None
+
+    def post_event_func(self, callback):
+        self.posted.append(callback)
 
 class TestJsDbg(unittest.TestCase):
 
@@ -31,5 +183,408 @@ class TestJsDbg(unittest.TestCase):
         # We rely on the dejagnu-based tests to ensure functionality for now.
         pass
 
+    def test_Memoize(self):
+        calls = []
+        cache = {}
+
+        @JsDbg.Memoize(cache)
+        def Square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(Square(3), 9)
+        self.assertEqual(Square(3), 9)
+        self.assertEqual(Square(4), 16)
+        self.assertEqual(calls, [3, 4])
+        self.assertEqual(cache[('Square', 3)], 9)
+
+        cache.clear()
+        self.assertEqual(Square(3), 9)
+        self.assertEqual(calls, [3, 4, 3])
+
+    def test_ClearTypeCache(self):
+        JsDbg.type_cache[('FindGdbType', 'm', 't')] = None
+        JsDbg.stop_cache[('GetCallStack', 1)] = []
+        JsDbg.ClearStopCache()
+        self.assertEqual(len(JsDbg.stop_cache), 0)
+        self.assertEqual(len(JsDbg.type_cache), 1)
+        JsDbg.stop_cache[('GetCallStack', 1)] = []
+        JsDbg.ClearTypeCache()
+        self.assertEqual(len(JsDbg.stop_cache), 0)
+        self.assertEqual(len(JsDbg.type_cache), 0)
+
+    def test_FindObjfileForName(self):
+        libfoo = FakeObjfile('/lib/libfoo.so.1')
+        chrome = FakeObjfile('/out/chrome')
+        GdbModule.loaded_objfiles = [libfoo, chrome]
+        JsDbg.InvalidateObjfileIndex()
+        self.assertIs(JsDbg.FindObjfileForName('foo'), libfoo)
+        self.assertIs(JsDbg.FindObjfileForName('chrome'), chrome)
+        self.assertIsNone(JsDbg.FindObjfileForName('bar'))
+
+        # Objfiles that were freed without an event cause a rescan.
+        chrome.valid = False
+        chrome2 = FakeObjfile('/out/chrome')
+        GdbModule.loaded_objfiles = [libfoo, chrome2]
+        self.assertIs(JsDbg.FindObjfileForName('chrome'), chrome2)
+        GdbModule.loaded_objfiles = []
+        JsDbg.InvalidateObjfileIndex()
+
+    def test_DiskCache(self):
+        chrome = FakeObjfile('/out/chrome')
+        chrome.build_id = '0123abcd'
+        symbols = {'A': FakeSymbol(FakeType('A', GdbModule.TYPE_CODE_STRUCT, 4, []))}
+        chrome.lookup_static_symbol = lambda name: symbols.get(name)
+        chrome.lookup_global_symbol = lambda name: None
+        GdbModule.loaded_objfiles = [chrome, FakeObjfile('/lib/libold.so')]
+        JsDbg.InvalidateObjfileIndex()
+        calls = []
+        @JsDbg.commands.Register
+        @JsDbg.Persistent
+        def TypeQuery(module, type):
+            calls.append(type)
+            return None if type == 'Missing' else '{%s}' % (type)
+        directory = tempfile.mkdtemp()
+        JsDbg.type_cache_dir = directory
+        try:
+            self.assertEqual(JsDbg.DebuggerQuery(1, 'TypeQuery("chrome","A")'), '1~{A}')
+            self.assertEqual(JsDbg.DebuggerQuery(2, 'TypeQuery("chrome","A")'), '2~{A}')
+            self.assertEqual(calls, ['A'])
+            # The results are still there in the next session.
+            JsDbg.ClearTypeCache()
+            self.assertEqual(JsDbg.DebuggerQuery(3, 'TypeQuery("chrome","A")'), '3~{A}')
+            self.assertEqual(calls, ['A'])
+            # Types that are not found are not remembered.
+            self.assertEqual(JsDbg.DebuggerQuery(4, 'TypeQuery("chrome","Missing")'), '4~None')
+            self.assertEqual(JsDbg.DebuggerQuery(5, 'TypeQuery("chrome","Missing")'), '5~None')
+            self.assertEqual(calls, ['A', 'Missing', 'Missing'])
+            # Whatever they return, queries about missing types are not stored.
+            cache = JsDbg.DiskCacheForModule('chrome')
+            for query in ['IsTypeEnum("chrome","Missing")', 'GetBaseTypes("chrome","Missing")']:
+                JsDbg.DebuggerQuery(0, query)
+                self.assertEqual(cache.Get(query), None)
+            self.assertEqual(cache.Get('TypeQuery("chrome","A")'), '{A}')
+            # Nor are types of objfiles without per-objfile symbol lookups.
+            self.assertEqual(JsDbg.DebuggerQuery(6, 'TypeQuery("old","A")'), '6~{A}')
+            self.assertEqual(JsDbg.DebuggerQuery(7, 'TypeQuery("old","A")'), '7~{A}')
+            self.assertEqual(len(calls), 5)
+            # A new build gets a new cache.
+            chrome.build_id = '4567ef01'
+            JsDbg.ClearTypeCache()
+            self.assertEqual(JsDbg.DebuggerQuery(8, 'TypeQuery("chrome","A")'), '8~{A}')
+            self.assertEqual(len(calls), 6)
+        finally:
+            JsDbg.ClearTypeCache()
+            JsDbg.type_cache_dir = None
+            del JsDbg.commands.functions['TypeQuery']
+            JsDbg.persistent_functions.discard('TypeQuery')
+            GdbModule.loaded_objfiles = []
+            JsDbg.InvalidateObjfileIndex()
+            shutil.rmtree(directory)
+
+    def test_DebuggerQuery(self):
+        self.assertEqual(
+            JsDbg.DebuggerQuery(1, 'NotAFunction()'),
+            '1!Unknown function NotAFunction')
+        self.assertTrue(JsDbg.DebuggerQuery(2, 'print("hi")').startswith('2!'))
+        self.assertEqual(
+            JsDbg.DebuggerBatch([(3, 'A()'), (4, 'B()')]),
+            '3!Unknown function A\n4!Unknown function B')
+        self.assertEqual(JsDbg.stats.functions['NotAFunction'].errors, 1)
+        self.assertTrue(JsDbg.DebuggerQuery(5, '1 + 1').startswith('5!'))
+        self.assertEqual(JsDbg.stats.functions['(invalid)'].calls, 1)
+        self.assertEqual(
+            str(JsDbg.GetBridgeStats()[0]).split('#')[:3], ['{(invalid)', '1', '1'])
+        JsDbg.stats.Reset()
+
+    def test_ReadMemoryRanges(self):
+        memory = FakeMemory()
+        JsDbg.memory_cache = JsDbgBase.MemoryCache(memory.Read, pageSize=0)
+        results = JsDbg.ReadMemoryRanges(
+            [(0x1010, 4), (0x1000, 2), (0x1014, 2), (0x10fe, 4)])
+        self.assertEqual(
+            str(results[:3]), '[{1#10111213}, {1#0001}, {1#1415}]')
+        self.assertEqual(
+            str(results[3]), '{0#Cannot access memory at address 0x10fe}')
+        # The two adjacent ranges were read together.
+        self.assertEqual(memory.reads, [(0x1000, 2), (0x1010, 6), (0x10fe, 4), (0x10fe, 4)])
+        self.assertEqual(
+            str(JsDbg.ReadMemoryRanges([(0x1000, 3)], 'base64')), '[{1#AAEC}]')
+        JsDbg.memory_cache = JsDbgBase.MemoryCache(JsDbg.ReadInferiorMemory)
+
+    def test_Prefetch(self):
+        mappings = '''process 1234
+Mapped address spaces:
+
+          Start Addr           End Addr       Size     Offset  Perms  objfile
+      0x555555554000     0x555555555000     0x1000        0x0  r--p   /tmp/test program
+      0x555555559000     0x55555557a000    0x21000        0x0  rw-p   [heap]
+      0x7ffff7d80000     0x7ffff7d90000    0x10000        0x0  rw-p
+      0x7ffff7d90000     0x7ffff7da0000    0x10000        0x0  r--p
+      0x7ffffffde000     0x7ffffffff000    0x21000        0x0  rw-p   [stack]
+'''
+        self.assertEqual(JsDbg.ParseHeapMappings(mappings),
+            [(0x555555559000, 0x55555557a000), (0x7ffff7d80000, 0x7ffff7d90000)])
+        # Older GDBs don't show the permissions.
+        self.assertEqual(JsDbg.ParseHeapMappings(
+            '  0x400000   0x401000   0x1000   0x0 /bin/true\n'
+            '  0x601000   0x602000   0x1000   0x0 \n'), [(0x601000, 0x602000)])
+
+        memory = FakeMemory()
+        memory.WritePointer(0x1000, 0x1088)
+        JsDbg.memory_cache = JsDbgBase.MemoryCache(memory.Read, pageSize=16)
+        JsDbg.prefetcher = JsDbgBase.Prefetcher(JsDbg.memory_cache, memory.Read,
+            lambda: ('<Q', [(0x1000, 0x1100)]), depth=1)
+        posted = []
+        class FakeBridge(object):
+            def PostIdle(self):
+                posted.append(True)
+        JsDbg.jsdbg = FakeBridge()
+        try:
+            self.assertEqual(JsDbg.ReadMemoryBytes(0x1000, 8), '8810000000000000')
+            self.assertEqual(posted, [True])
+            while JsDbg.RunIdleTask():
+                pass
+            self.assertEqual(memory.reads, [(0x1000, 16), (0x1080, 16)])
+            JsDbg.ReadMemoryBytes(0x1088, 4)
+            self.assertEqual(memory.reads, [(0x1000, 16), (0x1080, 16)])
+            self.assertEqual(str(JsDbg.GetPrefetchStats()), '{1#1#0#1#1048576}')
+
+            # Reads of the server's ReadMemoryRanges requests are looked at
+            # too.
+            JsDbg.memory_cache.Clear()
+            JsDbg.prefetcher.Clear()
+            del memory.reads[:]
+            del posted[:]
+            memory.WritePointer(0x1010, 0x10c0)
+            self.assertEqual(str(JsDbg.ReadMemoryRanges([(0x1010, 8)])),
+                '[{1#c010000000000000}]')
+            self.assertEqual(posted, [True])
+            while JsDbg.RunIdleTask():
+                pass
+            self.assertEqual(memory.reads, [(0x1010, 16), (0x10c0, 16)])
+            JsDbg.ReadMemoryRanges([(0x10c0, 4)])
+            self.assertEqual(str(JsDbg.GetPrefetchStats()), '{2#2#0#1#1048576}')
+        finally:
+            JsDbg.jsdbg = None
+            JsDbg.memory_cache = JsDbgBase.MemoryCache(JsDbg.ReadInferiorMemory)
+            JsDbg.prefetcher = JsDbgBase.Prefetcher(JsDbg.memory_cache,
+                JsDbg.PrefetchInferiorMemory, JsDbg.PrefetchTarget)
+
+    def test_ReadMemoryRangesDirect(self):
+        JsDbg.ClearStopCache()
+        jsdbg = FakeJsDbg()
+        jsdbg.directMemory = FakeMemory()
+        jsdbg.PostRequest(b"DebuggerQuery(1,'ReadMemoryRanges([(4096,2),(4112,2)])')\n")
+        self.assertEqual(jsdbg.writer.data, ['1~[{1#0001}, {1#1011}]\n'])
+        self.assertEqual(jsdbg.posted, [])
+        self.assertEqual(JsDbg.snapshot_recorder.memory, [(0x1000, 2), (0x1010, 2)])
+        # If any of the ranges can't be read, GDB reads all of them.
+        jsdbg.PostRequest(b"DebuggerQuery(2,'ReadMemoryRanges([(4096,2),(0,2)])')\n")
+        self.assertEqual(len(jsdbg.writer.data), 1)
+        self.assertEqual(len(jsdbg.posted), 1)
+        JsDbg.ClearStopCache()
+
+    def test_FollowPointers(self):
+        memory = FakeMemory()
+        JsDbg.memory_cache = JsDbgBase.MemoryCache(memory.Read)
+        JsDbg.type_cache[('GetPointerFormat',)] = '<Q'
+        # Nodes are 16 bytes: an id byte and a next pointer at offset 8.
+        memory.WritePointer(0x1008, 0x1020)
+        memory.WritePointer(0x1028, 0x1040)
+        memory.WritePointer(0x1048, 0)
+        self.assertEqual(
+            str(JsDbg.FollowPointers(0x1000, 8, 10, 1)),
+            '[{4096#00}, {4128#20}, {4160#40}]')
+        self.assertEqual(
+            str(JsDbg.FollowPointers(0x1000, 8, 1, 1)), '[{4096#00}, {4128#20}]')
+
+        # Cycles and unreadable pointers end the list.
+        memory.WritePointer(0x1048, 0x1020)
+        self.assertEqual(len(JsDbg.FollowPointers(0x1000, 8, 10, 1)), 3)
+        JsDbg.memory_cache.Clear()
+        memory.WritePointer(0x1048, 0x2000)
+        self.assertEqual(len(JsDbg.FollowPointers(0x1000, 8, 10, 1)), 3)
+        self.assertRaises(Exception, JsDbg.FollowPointers, 0x2000, 8, 10, 1)
+
+        # Trees: first child at offset 8, next sibling at offset 16.
+        JsDbg.memory_cache.Clear()
+        memory.data[:] = bytearray(range(256))
+        for (node, child, sibling) in [(0x1000, 0x1020, 0), (0x1020, 0x1060, 0x1040),
+                                       (0x1040, 0, 0), (0x1060, 0, 0x1000)]:
+            memory.WritePointer(node + 8, child)
+            memory.WritePointer(node + 16, sibling)
+        nodes = JsDbg.FollowPointerTree(0x1000, [8, 16], 10, 1)
+        self.assertEqual([n.pointer for n in nodes], [0x1000, 0x1020, 0x1060, 0x1040])
+        self.assertEqual(len(JsDbg.FollowPointerTree(0x1000, [8, 16], 2, 1)), 2)
+
+        JsDbg.type_cache.clear()
+        JsDbg.memory_cache = JsDbgBase.MemoryCache(JsDbg.ReadInferiorMemory)
+
+    def test_Snapshot(self):
+        memory = FakeMemory()
+        memory.WritePointer(0x1008, 0x1020)
+        memory.WritePointer(0x1028, 0)
+        class FakeInferior(object):
+            def read_memory(self, address, size):
+                return memory.Read(address, size)
+        GdbModule.selected_inferior = staticmethod(lambda: FakeInferior())
+        JsDbg.type_cache[('GetPointerFormat',)] = '<Q'
+        @JsDbg.commands.Register
+        def TypeQuery(type):
+            if type == 'Missing':
+                raise Exception('No type named Missing')
+            return '{%s}' % (type)
+        JsDbg.ClearStopCache()
+        JsDbg.snapshot_recorder.Clear()
+        directory = tempfile.mkdtemp()
+        path = directory + '/snapshot'
+        try:
+            self.assertEqual(JsDbg.DebuggerQuery(1, 'TypeQuery("A")'), '1~{A}')
+            self.assertEqual(JsDbg.DebuggerQuery(2, 'TypeQuery("Missing")'),
+                '2!No type named Missing')
+            self.assertEqual(JsDbg.DebuggerQuery(3, 'FollowPointers(4096,8,10,1)'),
+                '3~[{4096#00}, {4128#20}]')
+            self.assertEqual(JsDbg.DebuggerQuery(4, 'ReadMemoryBytes(4352,4)'),
+                '4!Cannot access memory at address 0x1100')
+            self.assertEqual(JsDbg.CaptureSnapshot(path), (2, 32))
+
+            snapshot = JsDbgSnapshot.Snapshot(path)
+            module = JsDbgSnapshot.SnapshotModule(snapshot)
+            self.assertEqual(
+                module.commands.Call('DebuggerBatch([(1,\'TypeQuery("A")\'),'
+                    '(2,\'TypeQuery("Missing")\'),(3,\'TypeQuery("B")\')])'),
+                '1~{A}\n2!No type named Missing\n3!Not in snapshot: TypeQuery("B")')
+            self.assertEqual(module.DebuggerQuery(4, 'FollowPointers(4096,8,10,1)'),
+                '4~[{4096#00}, {4128#20}]')
+            self.assertEqual(module.DebuggerQuery(5, 'ReadMemoryBytes(4352,4)'),
+                '5!Cannot access memory at address 0x1100')
+            self.assertEqual(module.DebuggerQuery(6, 'ReadMemoryRanges([(4100,2)])'),
+                '6~[{1#0405}]')
+            snapshot.Close()
+
+            # Memory and stop-dependent results are only kept until the
+            # target runs.
+            JsDbg.ClearStopCache()
+            self.assertEqual(JsDbg.CaptureSnapshot(path), (2, 0))
+
+            # Only so much is kept, and other results only until the type
+            # cache is cleared.
+            JsDbg.snapshot_recorder.maxQueryBytes = 50
+            JsDbg.DebuggerQuery(5, 'TypeQuery("B")')
+            self.assertTrue(JsDbg.snapshot_recorder.Truncated())
+            self.assertEqual(JsDbg.CaptureSnapshot(path), (2, 0))
+            # B is still missing after the target runs.
+            JsDbg.ClearStopCache()
+            self.assertTrue(JsDbg.snapshot_recorder.Truncated())
+            JsDbg.ClearTypeCache()
+            self.assertFalse(JsDbg.snapshot_recorder.Truncated())
+            self.assertEqual(JsDbg.CaptureSnapshot(path), (0, 0))
+        finally:
+            JsDbg.snapshot_recorder.maxQueryBytes = JsDbg.SnapshotRecorder.maxQueryBytes
+            del JsDbg.commands.functions['TypeQuery']
+            del GdbModule.selected_inferior
+            JsDbg.type_cache.clear()
+            JsDbg.snapshot_recorder.Clear()
+            JsDbg.memory_cache.Clear()
+            shutil.rmtree(directory)
+
+    def test_FrameTable(self):
+        outer = FakeFrame(0x30, 0x300)
+        middle = FakeFrame(0x20, 0x200, outer)
+        GdbModule.frames = [FakeFrame(0x10, 0x100, middle)]
+        JsDbg.ClearStopCache()
+
+        self.assertEqual(str(JsDbg.GetCallStack(1)), '[{16#256#264}]')
+        self.assertFalse(middle.walked)
+        self.assertIs(JsDbg.GetFrameTable().Find(0x20, 0x200), middle)
+        self.assertFalse(outer.walked)
+        self.assertIsNone(JsDbg.GetFrameTable().Find(0x20, 0x300))
+        self.assertTrue(outer.walked)
+        self.assertEqual(
+            str(JsDbg.GetCallStack(5)), '[{16#256#264}, {32#512#520}, {48#768#776}]')
+
+        GdbModule.frames = []
+        JsDbg.ClearStopCache()
+        self.assertEqual(JsDbg.GetCallStack(5), [])
+
+    def test_EnumConstants(self):
+        enum = FakeEnumType([('ns::Color::kRed', 1), ('ns::Color::kCrimson', 1),
+                             ('ns::Color::kBlue', 2)])
+        JsDbg.type_cache[('FindGdbType', 'm', 'ns::Color')] = enum
+        self.assertEqual(
+            str(JsDbg.LookupConstants('m', 'ns::Color', 1)), '[{kRed#1}, {kCrimson#1}]')
+        self.assertEqual(str(JsDbg.LookupConstants('m', 'ns::Color', 3)), '[]')
+        self.assertEqual(
+            str(JsDbg.LookupConstantsMany('m', 'ns::Color', [2, 3, 1])),
+            '[{kBlue#2}, {kRed#1}, {kCrimson#1}]')
+        self.assertEqual(JsDbg.LookupConstant('m', 'ns::Color', 'kBlue'), '2')
+        self.assertEqual(JsDbg.LookupConstant('m', 'ns::Color', 'Color::kBlue'), '2')
+        self.assertEqual(
+            str(JsDbg.LookupConstantMany('m', 'ns::Color', ['kCrimson', 'kGreen'])),
+            '[{kCrimson#1}]')
+        # The enumerators were only read once.
+        self.assertEqual(enum.calls, 1)
+        JsDbg.ClearTypeCache()
+
+    def test_TypeLayout(self):
+        JsDbg.ClearTypeCache()
+        char = FakeType('char', GdbModule.TYPE_CODE_INT, 1)
+        base = FakeType('Base', GdbModule.TYPE_CODE_STRUCT, 8, [
+            FakeField('base_', char, 0), FakeField('kStatic', char)])
+        union = FakeType(None, GdbModule.TYPE_CODE_UNION, 1, [
+            FakeField('u_', char, 0), FakeField('v_', char, 0)])
+        left = FakeType('Left', GdbModule.TYPE_CODE_STRUCT, 16, [
+            FakeField('Base', base, 0, True), FakeField('left_', char, 64)])
+        right = FakeType('Right', GdbModule.TYPE_CODE_STRUCT, 16, [
+            FakeField('Base', base, 0, True), FakeField(None, union, 64)])
+        derived = FakeType('Derived', GdbModule.TYPE_CODE_STRUCT, 40, [
+            FakeField('Left', left, 0, True), FakeField('Right', right, 128, True),
+            FakeField('u_', char, 256)])
+        for t in [char, base, left, right, derived]:
+            JsDbg.type_cache[('FindGdbType', 'm', t.name)] = t
+
+        # Fields come level by level, with inherited offsets relative to the
+        # class that declares them.
+        self.assertEqual(str(JsDbg.GetAllFields('m', 'Derived', False)),
+            '[{32#1#0#0#u_#char}]')
+        self.assertEqual(str(JsDbg.GetAllFields('m', 'Derived', True)),
+            '[{0#16#0#0#Left#Left}, {16#16#0#0#Right#Right}, {32#1#0#0#u_#char}, '
+            '{0#8#0#0#Base#Base}, {8#1#0#0#left_#char}, {0#8#0#0#Base#Base}, '
+            '{8#1#0#0#u_#char}, {8#1#0#0#v_#char}, {0#1#0#0#base_#char}, '
+            '{0#1#0#0#base_#char}]')
+        self.assertEqual(str(JsDbg.GetAllFields('m', 'char', True)), '[]')
+        self.assertEqual(str(JsDbg.GetBaseTypes('m', 'Derived')),
+            '[{m#Left#0}, {m#Base#0}, {m#Right#16}, {m#Base#16}]')
+        self.assertEqual(str(JsDbg.GetBaseTypes('m', 'char')), '[{m#char#0}]')
+        # The most derived field wins; anonymous unions are looked into.
+        self.assertEqual(str(JsDbg.LookupField('m', 'Derived', 'u_')), '{32#1#0#0#u_#char}')
+        self.assertEqual(str(JsDbg.LookupField('m', 'Derived', 'v_')), '{8#1#0#0#v_#char}')
+        self.assertEqual(str(JsDbg.LookupField('m', 'Derived', 'kStatic')), '{-1#1#-1#0#kStatic#char}')
+        self.assertEqual(JsDbg.LookupField('m', 'Derived', 'missing'), None)
+        self.assertRaises(TypeError, JsDbg.LookupField, 'm', 'char', 'missing')
+        # Each type was only looked at once, although Base is inherited twice.
+        self.assertEqual([t.calls for t in [base, left, right, derived]], [1, 1, 1, 1])
+        JsDbg.ClearTypeCache()
+
+    def test_LookupSymbolNames(self):
+        JsDbg.ClearTypeCache()
+        JsDbg.symbol_index.Add(0x1000, 0x1100, ('chrome', 'vtable for blink::Node'))
+        evaluated = []
+        GdbModule.solib_name = staticmethod(lambda pointer: 'chrome')
+        GdbModule.parse_and_eval = staticmethod(
+            lambda expression: evaluated.append(expression) or '0x2000')
+        try:
+            self.assertEqual(
+                str(JsDbg.LookupSymbolNames([0x1010, 0x2000, 0x1000, 0x2000])),
+                '[{chrome#vtable for blink::Node#16}, {}, {chrome#vtable for blink::Node#0}, {}]')
+        finally:
+            del GdbModule.solib_name
+            del GdbModule.parse_and_eval
+        # Only symbols are cached, not every address that was looked up.
+        self.assertEqual(evaluated, ['(void*)8192', '(void*)8192'])
+        self.assertEqual(len(JsDbg.type_cache), 0)
+        JsDbg.ClearTypeCache()
+
 if __name__ == '__main__':
     unittest.main()
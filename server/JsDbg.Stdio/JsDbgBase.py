@@ -1,18 +1,49 @@
+import base64
+import binascii
+import bisect
+import collections
+import errno
+import os
 import os.path
 import re
+import select
+import struct
 import subprocess
+import sys
 import threading
+import time
+
+import JsDbgTypes
+
+try:
+    import anydbm as dbm
+except ImportError:
+    import dbm
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import selectors
+except ImportError:
+    # Python 2; PipeReader falls back to select.select.
+    selectors = None
 
 class JsDbg:
     """The debugger-independent functionality of JsDbg.
 
     It is designed to be simple to use; users only have to provide three things:
-    - A module instance that contains the functions that the webserver calls
-      (primarily DebuggerQuery)
+    - A module instance whose |commands| CommandTable contains the functions
+      that the webserver calls (primarily DebuggerQuery), and whose |stats|
+      BridgeStats collects request metrics
     - A post_event function that takes a callable class to execute on the
       main thread.
     - A function that gets called when the server crashes/exists, so any
       global state can be cleaned up and the user alerted.
+    Modules that have work to do while no requests are pending (see
+    PostIdle) also provide a RunIdleTask function.
 
     When JsDbg is instantiated, it will look for the JsDbg webserver binary
     and the extensions directory and run it, as well as manage communication
@@ -20,20 +51,204 @@ class JsDbg:
     """
 
     class JsDbgRequest:
-        def __init__(self, module, request, responseStream, verbose):
+        def __init__(self, module, request, verbose, sequence=0, generation=0):
             self.module = module
             self.request = request
-            self.responseStream = responseStream
             self.verbose = verbose
+            # Identifies the request in traces.
+            self.sequence = sequence
+            # The value of JsDbg.generation when the request arrived.
+            self.generation = generation
+            self.receivedTime = timer()
+            # Parse the request right away, on the thread that received it,
+            # so that we can tell whether it can be cancelled. Invalid
+            # requests fail when they are run.
+            try:
+                self.call = ParseCall(request)
+            except ValueError:
+                self.call = None
+            # The tags of identical queries that arrived while this one was
+            # pending; they get the same response (see JsDbg.PostRequest).
+            self.waiters = []
+            self.mergeKey = self.MergeKey()
+            self.hasSideEffects = self.HasSideEffects()
+
+        def MergeKey(self):
+            """Returns what identical DebuggerQuery requests have in common,
+            or None if the request must not be merged with others."""
+            if self.call is None or self.call[0] != "DebuggerQuery":
+                return None
+            queries = self.Queries()
+            if len(queries) != 1 or queries[0][1] in self.module.commands.sideEffects:
+                return None
+            return (self.generation, self.call[1][1])
+
+        def HasSideEffects(self):
+            """Whether running the request may change the state of the
+            debugger or the target. Requests we can't make sense of are
+            assumed to."""
+            queries = self.Queries()
+            sideEffects = self.module.commands.sideEffects
+            return len(queries) == 0 or any(
+                [name in sideEffects for (_, name) in queries])
+
+        def AnswerWaiters(self, response):
+            """Adds copies of |response| for the waiters."""
+            if not self.waiters:
+                return response
+            tag = str(self.Queries()[0][0])
+            result = response[len(tag):]
+            return response + "".join(["%d%s" % (waiter, result) for waiter in self.waiters])
+
+        def Queries(self):
+            """Returns (tag, function name) for each of the queries in a
+            DebuggerQuery or DebuggerBatch request."""
+            if self.call is None:
+                return []
+            (name, args) = self.call
+            try:
+                if name == "DebuggerQuery":
+                    queries = [args]
+                elif name == "DebuggerBatch":
+                    queries = args[0]
+                else:
+                    return []
+                return [(int(tag), call_regex.match(command).group(1))
+                    for (tag, command) in queries]
+            except (AttributeError, IndexError, TypeError, ValueError):
+                return []
+
+        def Cancellable(self):
+            """Whether all of the queries only read the state of the stopped
+            target (see CommandTable.StopDependent)."""
+            queries = self.Queries()
+            stopDependent = self.module.commands.stopDependent
+            return len(queries) > 0 and all(
+                [name in stopDependent for (_, name) in queries])
+
+        def Cancel(self):
+            """Returns the response for a request that has been cancelled."""
+            return "".join(["%d!%s\n" % (tag, cancelled_error)
+                for (tag, _) in self.Queries()])
+
+        def Count(self):
+            """The number of queries this request answers."""
+            return len(self.Queries()) + len(self.waiters)
 
         def __call__(self):
             if self.verbose:
                 print("JsDbg [received command]: " + self.request)
-            response = eval(self.request, self.module.__dict__) + "\n"
+            self.module.stats.RecordQueueTime(timer() - self.receivedTime,
+                [name for (_, name) in self.Queries()])
+            (name, args) = self.call or ParseCall(self.request)
+            response = self.module.commands.Invoke(name, args) + "\n"
             if self.verbose:
                 print("JsDbg [sending response]: " + response.strip())
-            self.responseStream.write(response.encode("utf-8"))
-            self.responseStream.flush()
+            return response
+
+    class JsDbgBatch:
+        """Runs pending requests on the main thread.
+
+        Only one batch is posted at a time; requests that arrive while it is
+        waiting to run are picked up by it, so a burst of requests costs a
+        single post_event and a single write to the response stream. Each run
+        handles at most maxBatchSize requests and then posts itself again, so
+        the debugger gets a chance to process its own events in between.
+
+        Requests that only read the state of the stopped target and arrived
+        before the target last resumed or switched threads are not run; they
+        fail with cancelled_error, and the server gets a "cancelled <count>"
+        event.
+        """
+        def __init__(self, jsdbg):
+            self.jsdbg = jsdbg
+
+        def __call__(self):
+            jsdbg = self.jsdbg
+            with jsdbg.pendingRequestsLock:
+                requests = jsdbg.pendingRequests[:jsdbg.maxBatchSize]
+                del jsdbg.pendingRequests[:jsdbg.maxBatchSize]
+                # From now on, identical requests have to wait for the next
+                # batch; they may not see the response of this one.
+                for request in requests:
+                    if jsdbg.mergeableRequests.get(request.mergeKey) is request:
+                        del jsdbg.mergeableRequests[request.mergeKey]
+
+            trace = jsdbg.trace
+            responses = []
+            cancelled = 0
+            for request in requests:
+                try:
+                    start = timer()
+                    if (request.generation != jsdbg.generation and
+                            request.Cancellable()):
+                        response = request.Cancel()
+                        count = request.Count()
+                        request.module.stats.RecordCancelled(count)
+                        cancelled += count
+                    else:
+                        response = request()
+                    if trace is not None:
+                        trace.Response(request.sequence, start, timer() - start,
+                            response[:-1])
+                    responses.append(request.AnswerWaiters(response))
+                except Exception as e:
+                    print("JsDbg: error handling %s: %s" % (request.request, e))
+            if responses:
+                jsdbg.writer.Write("".join(responses))
+            if cancelled:
+                jsdbg.SendEvent("cancelled %d" % (cancelled))
+            if trace is not None:
+                trace.Flush()
+
+            with jsdbg.pendingRequestsLock:
+                jsdbg.pendingSideEffects -= len(
+                    [request for request in requests if request.hasSideEffects])
+                jsdbg.batchPosted = len(jsdbg.pendingRequests) > 0
+                repost = jsdbg.batchPosted
+                # Idle work waits until all requests are handled.
+                idle = not repost and jsdbg.idleWanted and not jsdbg.idlePosted
+                if idle:
+                    jsdbg.idlePosted = True
+            if repost:
+                jsdbg.post_event_func(self)
+            elif idle:
+                jsdbg.post_event_func(jsdbg.JsDbgIdle(jsdbg))
+
+    class JsDbgIdle:
+        """Runs the module's RunIdleTask on the main thread while no
+        requests are pending (see PostIdle).
+
+        Each run calls it for at most idleSlice seconds, and stops as soon as
+        a request arrives, so idle work delays requests by little more than
+        one RunIdleTask call. Then it posts itself again if there is more to
+        do; if requests are pending, the batch that handles them does.
+        """
+        def __init__(self, jsdbg):
+            self.jsdbg = jsdbg
+
+        def __call__(self):
+            jsdbg = self.jsdbg
+            with jsdbg.pendingRequestsLock:
+                jsdbg.idlePosted = False
+                if jsdbg.batchPosted:
+                    return
+                jsdbg.idleWanted = False
+            deadline = timer() + jsdbg.idleSlice
+            more = True
+            try:
+                while more and not jsdbg.pendingRequests and timer() < deadline:
+                    more = jsdbg.module.RunIdleTask()
+            except Exception as e:
+                print("JsDbg: error in idle task: %s" % (e))
+                more = False
+            if more:
+                jsdbg.PostIdle()
+
+    # The maximum number of requests to handle in one main thread callback.
+    maxBatchSize = 64
+    # The maximum time to spend on idle work in one main thread callback.
+    idleSlice = 0.005
 
     def __init__(self, module, post_event_func, server_exited_func, verbose):
         self.module = module
@@ -41,6 +256,29 @@ class JsDbg:
         self.server_exited_func = server_exited_func
         self.showStderr = True
         self.verbose = verbose
+        self.pendingRequests = []
+        self.pendingRequestsLock = threading.Lock()
+        self.batchPosted = False
+        # Whether the module has idle work to do, and whether a JsDbgIdle is
+        # posted to do it.
+        self.idleWanted = False
+        self.idlePosted = False
+        # The TraceWriter recording the traffic with the server, if any.
+        self.trace = None
+        self.requestSequence = 0
+        # Incremented whenever the target resumes or switches to another
+        # process or thread (see SendEvent), which makes the results of
+        # pending stop-dependent requests useless.
+        self.generation = 0
+        # Pending requests that identical requests can wait for instead of
+        # being run again, by JsDbgRequest.mergeKey.
+        self.mergeableRequests = {}
+        # The number of posted requests with side effects that have not run
+        # yet; while there are any, memory is not read directly.
+        self.pendingSideEffects = 0
+        # The ProcessMemory of the target while its memory can be read
+        # without the debugger; see SetDirectMemoryProcess.
+        self.directMemory = None
         rootDir = os.path.dirname(os.path.abspath(__file__))
         extensionSearchPath = [
           rootDir + "/extensions", # from "make dist"
@@ -78,61 +316,1277 @@ class JsDbg:
             print('Running %s' % cmdline)
         self.proc = subprocess.Popen(cmdline, stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Responses and events go through this, so that the main thread
+        # doesn't wait for the server to read them.
+        self.writer = ResponseWriter(self.proc.stdin)
 
-        def stderrThreadProc():
-            # Echo stderr from the subprocess, if showStderr is set
-            while(self.proc.poll() == None):
-                val = self.proc.stderr.readline()
-                if not val:
-                    continue
-                val = val.strip().decode("utf-8")
-                if self.verbose:
-                    print("JsDbg [message]: " + val)
-                elif self.showStderr:
-                    print("JsDbg: " + val)
-            # If we get here, the server exited
+        def ioThreadProc():
+            # Handle the main interaction loop between jsdbg and python:
+            # requests arrive on stdout, messages on stderr. Both pipes are
+            # read on this thread, which sleeps until one of them has data.
+            reader = PipeReader()
+            reader.Add(self.proc.stdout, self.PostRequest)
+            reader.Add(self.proc.stderr, self.ShowMessage)
+            reader.Run()
+            # Both pipes are closed, so the server is exiting; reap it.
+            self.proc.wait()
+            self.writer.Close()
             self.server_exited_func()
 
-        def mainThreadProc():
-            # Handle the main interaction loop between jsdbg and python
-            while(self.proc.poll() == None):
-                request = self.proc.stdout.readline()
-                if not request:
-                    continue
+        # Mark the thread as a daemon thread so it doesn't block exiting.
+        self.ioThread = threading.Thread(target=ioThreadProc)
+        self.ioThread.daemon = True
+        self.ioThread.start()
 
-                request = request.decode("utf-8").strip()
+    def PostRequest(self, request):
+        request = request.decode("utf-8").strip()
+        if self.verbose:
+            print("JsDbg [posting command]: " + request)
+        self.requestSequence += 1
+        request = self.JsDbgRequest(self.module, request, self.verbose,
+            self.requestSequence, self.generation)
+        trace = self.trace
+        if trace is not None:
+            trace.Request(request.sequence, request.receivedTime,
+                request.request)
+        if self.directMemory is not None and self.RunDirect(request):
+            return
+        # gdb does not allow multithreaded requests
+        # Anything going to gdb from another thread must go through
+        # gdb.post_event. If a batch is already posted, it will pick
+        # up this request as well.
+        with self.pendingRequestsLock:
+            if request.hasSideEffects:
+                self.pendingSideEffects += 1
+                # Requests after this one may see what it changes, so they
+                # must not get the responses of those before it.
+                self.mergeableRequests.clear()
+            if request.mergeKey is not None:
+                # If the same query is already waiting to be run, just have
+                # it answer this one as well.
+                pending = self.mergeableRequests.get(request.mergeKey)
+                if pending is not None:
+                    pending.waiters.append(request.Queries()[0][0])
+                    self.module.stats.RecordMerged()
+                    if self.verbose:
+                        print("JsDbg [merged command]: " + request.request)
+                    return
+                self.mergeableRequests[request.mergeKey] = request
+            self.pendingRequests.append(request)
+            if self.batchPosted:
+                return
+            self.batchPosted = True
+        self.post_event_func(self.JsDbgBatch(self))
+        # The response will asynchronously be sent back on the response
+        # stream
+
+    def PostIdle(self):
+        """Has the module's RunIdleTask() called on the main thread, again
+        and again while no requests are pending, until it returns False. Only
+        call this on the main thread."""
+        with self.pendingRequestsLock:
+            self.idleWanted = True
+            if self.idlePosted or self.batchPosted:
+                return
+            self.idlePosted = True
+        self.post_event_func(self.JsDbgIdle(self))
+
+    def RunDirect(self, request):
+        """Answers |request| on the calling thread by reading the target's
+        memory directly, if it is a query with a CommandTable.Direct handler.
+        Returns whether it did; if not, the request has to go through the
+        debugger. So do requests that fail, so that the debugger reports the
+        error as usual."""
+        queries = request.Queries()
+        if len(queries) != 1 or request.call[0] != "DebuggerQuery":
+            return False
+        (tag, name) = queries[0]
+        handler = self.module.commands.direct.get(name)
+        memory = self.directMemory
+        if handler is None or memory is None:
+            return False
+        with self.pendingRequestsLock:
+            # Those may write to memory or resume the target.
+            if self.pendingSideEffects:
+                return False
+        start = timer()
+        try:
+            (_, args) = ParseCall(request.call[1][1])
+            result = handler(memory.Read, *args)
+        except Exception:
+            return False
+        if request.generation != self.generation:
+            # The target resumed while we were reading; let the request be
+            # cancelled like any other stale one.
+            return False
+        response = "%d~%s\n" % (tag, JsDbgTypes.Serialize(result))
+        elapsed = timer() - start
+        self.module.stats.Record(name, elapsed, len(response) - 1, False)
+        self.module.stats.RecordDirect()
+        if self.verbose:
+            print("JsDbg [sending direct response]: " + response.strip())
+        trace = self.trace
+        if trace is not None:
+            trace.Response(request.sequence, start, elapsed, response[:-1])
+        self.writer.Write(response)
+        return True
+
+    def SetDirectMemoryProcess(self, pid):
+        """Has memory reads of the process |pid| answered on the reader
+        thread, without the debugger, until the next event that resumes the
+        target or switches to another process or thread. The bridge must only
+        call this while the process is stopped and the debugger's view of its
+        memory is the actual memory (e.g. no breakpoints are inserted). None
+        turns direct reads off."""
+        previous = self.directMemory
+        if previous is not None and previous.pid == pid:
+            return
+        memory = None
+        if pid and direct_memory_supported:
+            try:
+                memory = ProcessMemory(pid)
+            except (IOError, OSError) as e:
                 if self.verbose:
-                    print("JsDbg [posting command]: " + request)
-                # gdb does not allow multithreaded requests
-                # Anything going to gdb from another thread must go through
-                # gdb.post_event
-                self.post_event_func(self.JsDbgRequest(
-                    self.module, request, self.proc.stdin, self.verbose))
-                # The response will asynchronously be sent back on the response
-                # stream
-
-        # Mark threads as daemon threads so they don't block exiting.
-        self.stderrThread = threading.Thread(target=stderrThreadProc)
-        self.stderrThread.daemon = True
-        self.mainThread = threading.Thread(target=mainThreadProc)
-        self.mainThread.daemon = True
-        self.stderrThread.start()
-        self.mainThread.start()
+                    print("JsDbg: can't read memory of %d directly: %s" % (pid, e))
+        self.directMemory = memory
+        if previous is not None:
+            previous.Close()
+
+    def ShowMessage(self, message):
+        # Echo stderr from the subprocess, if showStderr is set
+        message = message.strip().decode("utf-8")
+        if self.verbose:
+            print("JsDbg [message]: " + message)
+        elif self.showStderr:
+            print("JsDbg: " + message)
 
     def SendEvent(self, event):
         response = '%' + event + '\n';
         if self.verbose:
             print("JsDbg [sending event]: " + response)
-        self.proc.stdin.write(response.encode("utf-8"))
-        self.proc.stdin.flush()
+        if event.split(" ")[0] in generation_events:
+            self.generation += 1
+            self.SetDirectMemoryProcess(None)
+        trace = self.trace
+        if trace is not None:
+            trace.Event(timer(), '%' + event)
+        self.writer.Write(response)
+
+    def StartTrace(self, path):
+        """Records all requests, responses and events to the trace file at
+        |path|; see TraceWriter."""
+        self.StopTrace()
+        self.trace = TraceWriter(path)
+
+    def StopTrace(self):
+        trace = self.trace
+        self.trace = None
+        if trace is not None:
+            trace.Close()
+
+
+def Serve(module, verbose, events=()):
+    """Runs the JsDbg server with |module| answering its requests on the
+    calling thread, the way GDB runs them on its main thread, until the server
+    exits. |events| are sent to the server at startup. For serving without a
+    debugger; see JsDbgReplay.py and JsDbgSnapshot.py."""
+    mainThreadQueue = queue.Queue()
+    exited = threading.Event()
+    def ServerExited():
+        exited.set()
+        mainThreadQueue.put(None)
+
+    jsdbg = JsDbg(module, mainThreadQueue.put, ServerExited, verbose)
+    for event in events:
+        jsdbg.SendEvent(event)
+    while not exited.is_set():
+        callback = mainThreadQueue.get()
+        if callback is not None:
+            callback()
+
+
+# The events after which requests that depend on the state of the stopped
+# target are cancelled.
+generation_events = ["cont", "exit", "proc", "thread"]
+# The error for those requests; the server tells it apart from other errors.
+cancelled_error = "Cancelled: the target resumed or switched threads"
+
+
+# ProcessMemory needs os.pread, which is only available on Python 3.
+direct_memory_supported = hasattr(os, "pread")
+
+
+class ProcessMemory(object):
+    """Reads the memory of the local process |pid| through /proc/<pid>/mem.
+
+    This does not involve the debugger, so it works on any thread; it is only
+    correct while the process is stopped. Close may be called while another
+    thread is reading; it waits for the read to finish, so the file
+    descriptor is never closed (and possibly reused) underneath it. Reads
+    after Close raise.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.lock = threading.Lock()
+        self.fd = os.open("/proc/%d/mem" % (pid), os.O_RDONLY)
+
+    def Read(self, address, size):
+        """Returns |size| bytes at |address|, or raises if not all of them
+        are readable."""
+        with self.lock:
+            if self.fd is None:
+                raise IOError(errno.EBADF, "Memory of %d is no longer readable" % (self.pid))
+            data = os.pread(self.fd, size, address)
+        if len(data) != size:
+            raise IOError(errno.EIO, "Cannot access memory at address 0x%x" % (
+                address + len(data)))
+        return data
+
+    def Close(self):
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+def IsHeapMapping(perms, path):
+    """Whether a mapping of the target with permissions |perms| (e.g.
+    "rw-p", or None if not known) and file |path| is likely to hold heap
+    objects: it is writable and not backed by a file."""
+    return ((perms is None or perms[1:2] == "w") and
+        (not path or path == "[heap]" or path.startswith("[anon:")))
+
+def ProcessHeapRegions(pid):
+    """Returns the (start, end) ranges of the heap mappings (see
+    IsHeapMapping) of the local process |pid|."""
+    regions = []
+    with open("/proc/%d/maps" % (pid)) as f:
+        for line in f:
+            # start-end perms offset dev inode [path]
+            fields = line.split(None, 5)
+            (start, end) = fields[0].split("-")
+            path = fields[5].strip() if len(fields) > 5 else ""
+            if IsHeapMapping(fields[1], path):
+                regions.append((int(start, 16), int(end, 16)))
+    return regions
+
+
+class ResponseWriter(object):
+    """Writes to the server's stdin on a thread of its own.
+
+    Write only queues the data, so the main thread never blocks on the pipe
+    while the server is busy. Everything that is queued by the time the thread
+    gets to it is written and flushed at once, in the order it was queued. At
+    most maxQueued writes can be waiting; after that, Write blocks until the
+    server catches up. If the server goes away, everything is dropped.
+    """
+    maxQueued = 1024
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.writing = False
+        self.closed = False
+        # Diagnostics: the deepest the queue got, and how many flushes and
+        # bytes we wrote.
+        self.maxDepth = 0
+        self.flushes = 0
+        self.bytesWritten = 0
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Depth(self):
+        return len(self.queue)
+
+    def Write(self, data):
+        with self.condition:
+            while len(self.queue) >= self.maxQueued and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                return
+            self.queue.append(data)
+            self.maxDepth = max(self.maxDepth, len(self.queue))
+            self.condition.notify_all()
+
+    def WaitUntilWritten(self):
+        """Blocks until everything queued so far has been written."""
+        with self.condition:
+            while (self.queue or self.writing) and not self.closed:
+                self.condition.wait()
+
+    def Close(self):
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+    def Run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                data = "".join(self.queue).encode("utf-8")
+                self.queue.clear()
+                self.writing = True
+                self.condition.notify_all()
+            try:
+                self.stream.write(data)
+                self.stream.flush()
+            except (IOError, OSError, ValueError):
+                # The server exited or closed its stdin.
+                self.Close()
+                return
+            with self.condition:
+                self.writing = False
+                self.flushes += 1
+                self.bytesWritten += len(data)
+                self.condition.notify_all()
+
+
+class PipeReader(object):
+    """Reads lines from several pipes on a single thread.
+
+    Run blocks in select until one of the pipes has data, reads whatever is
+    available in one go and calls the pipe's handler for each complete line
+    (with the trailing newline, as bytes). It returns once all of the pipes
+    have been closed by the other end; a partial last line is handled too.
+    """
+    # The most to read from a pipe at once.
+    chunkSize = 65536
+
+    def __init__(self):
+        # fd -> [handler, partial line]
+        self.pipes = {}
+
+    def Add(self, pipe, handler):
+        self.pipes[pipe.fileno()] = [handler, b""]
+
+    def Run(self):
+        if selectors is not None:
+            selector = selectors.DefaultSelector()
+            for fd in self.pipes:
+                selector.register(fd, selectors.EVENT_READ)
+            try:
+                while self.pipes:
+                    for (key, _) in selector.select():
+                        if not self.Read(key.fd):
+                            selector.unregister(key.fd)
+            finally:
+                selector.close()
+        else:
+            while self.pipes:
+                try:
+                    (readable, _, _) = select.select(list(self.pipes), [], [])
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                for fd in readable:
+                    self.Read(fd)
+
+    def Read(self, fd):
+        """Handles the data available on |fd|. Returns False at EOF."""
+        entry = self.pipes[fd]
+        chunk = os.read(fd, self.chunkSize)
+        if not chunk:
+            del self.pipes[fd]
+            if entry[1]:
+                entry[0](entry[1])
+            return False
+        lines = (entry[1] + chunk).split(b"\n")
+        entry[1] = lines.pop()
+        for line in lines:
+            entry[0](line + b"\n")
+        return True
+
+
+# Optional protocol features the server can ask for with GetBridgeFeatures.
+# "base64": ReadMemoryBytes and WriteMemoryBytes accept an encoding argument
+# and support base64 in addition to hex.
+# "ranges": ReadMemoryRanges is available.
+bridge_features = ["base64", "ranges"]
+
+
+def EncodeMemory(data, encoding):
+    """Encodes a buffer of memory contents for sending to the server."""
+    if encoding == "hex":
+        return binascii.hexlify(bytearray(data)).decode("ascii")
+    elif encoding == "base64":
+        return base64.b64encode(bytes(data)).decode("ascii")
+    raise ValueError("Unknown memory encoding %s" % (encoding))
+
+
+def DecodeMemory(data, encoding):
+    """Decodes memory contents received from the server into bytes."""
+    if encoding == "hex":
+        return binascii.unhexlify(data)
+    elif encoding == "base64":
+        return base64.b64decode(data)
+    raise ValueError("Unknown memory encoding %s" % (encoding))
+
+
+def MergeRanges(ranges):
+    """Merges overlapping and adjacent (address, size) ranges.
+
+    Returns a sorted list of (start, end, [indices]) tuples, where indices are
+    the positions in |ranges| of the ranges that were merged into [start, end).
+    """
+    merged = []
+    order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+    for i in order:
+        (address, size) = ranges[i]
+        if merged and address <= merged[-1][1]:
+            last = merged[-1]
+            last[1] = max(last[1], address + size)
+            last[2].append(i)
+        else:
+            merged.append([address, address + size, [i]])
+    return [tuple(m) for m in merged]
+
+
+class IntervalIndex(object):
+    """Maps non-overlapping [start, end) address ranges to values."""
+    def __init__(self):
+        self.starts = []
+        self.entries = []
+
+    def Clear(self):
+        del self.starts[:]
+        del self.entries[:]
+
+    def Find(self, address):
+        """Returns (start, value) for the range containing |address|, or None."""
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0:
+            (start, end, value) = self.entries[i]
+            if address < end:
+                return (start, value)
+        return None
+
+    def Add(self, start, end, value):
+        """Adds a range, or grows the range that starts at |start|."""
+        i = bisect.bisect_left(self.starts, start)
+        if i < len(self.starts) and self.starts[i] == start:
+            end = max(end, self.entries[i][1])
+            self.entries[i] = (start, end, value)
+        else:
+            self.starts.insert(i, start)
+            self.entries.insert(i, (start, end, value))
+        # Keep ranges from overlapping their neighbors.
+        if i + 1 < len(self.starts) and end > self.starts[i + 1]:
+            self.entries[i] = (start, self.starts[i + 1], value)
+        if i > 0 and self.entries[i - 1][1] > start:
+            (previousStart, _, previousValue) = self.entries[i - 1]
+            self.entries[i - 1] = (previousStart, start, previousValue)
+
+
+class MemoryCache(object):
+    """A page-granular LRU cache of target memory.
+
+    |readFunc(address, size)| reads memory from the target and returns a
+    buffer of that size, or raises if the memory is not readable. Users are
+    responsible for calling Clear whenever the target may have changed its
+    memory (e.g. when it runs), and Write after they wrote to the target.
+
+    Pages can also be stored ahead of time with StorePrefetched (see
+    Prefetcher); |prefetchUsedFunc(page, size)|, if set, is called when a
+    read first uses one of them.
+    """
+    def __init__(self, readFunc, pageSize=4096, maxPages=1024, prefetchUsedFunc=None):
+        self.readFunc = readFunc
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.prefetchUsedFunc = prefetchUsedFunc
+        # Maps page addresses to page contents, least recently used first.
+        self.pages = collections.OrderedDict()
+        # Prefetched pages that no read has used yet.
+        self.prefetched = set()
+        self.hits = 0
+        self.misses = 0
+        self.prefetchHits = 0
+
+    def Configure(self, pageSize, maxPages):
+        self.pageSize = pageSize
+        self.maxPages = maxPages
+        self.Clear()
+
+    def Clear(self):
+        self.pages.clear()
+        self.prefetched.clear()
+
+    def ResetStats(self):
+        self.hits = 0
+        self.misses = 0
+        self.prefetchHits = 0
+
+    def Read(self, address, size):
+        pageSize = self.pageSize
+        end = address + size
+        first = address - address % pageSize if pageSize else address
+        if size <= 0 or not pageSize or (end - first) > self.maxPages * pageSize:
+            # Reads that would not fit into the cache (or a disabled cache)
+            # go straight to the target.
+            self.misses += 1
+            return bytes(self.readFunc(address, size))
+
+        chunks = []
+        page = first
+        while page < end:
+            data = self.pages.pop(page, None)
+            if data is not None:
+                # Move the page to the most recently used end.
+                self.pages[page] = data
+                self.hits += 1
+                if page in self.prefetched:
+                    self.prefetched.remove(page)
+                    self.prefetchHits += 1
+                    if self.prefetchUsedFunc is not None:
+                        self.prefetchUsedFunc(page, pageSize)
+                chunks.append(data)
+                page += pageSize
+                continue
+
+            # Read the whole run of missing pages at once.
+            runEnd = page + pageSize
+            while runEnd < end and runEnd not in self.pages:
+                runEnd += pageSize
+            self.misses += (runEnd - page) // pageSize
+            try:
+                data = bytes(self.readFunc(page, runEnd - page))
+            except Exception:
+                # Some of the pages are not readable, e.g. because the read is
+                # close to the end of a mapping. Read exactly what was asked
+                # for and don't cache it.
+                return bytes(self.readFunc(address, size))
+            for offset in range(0, runEnd - page, pageSize):
+                self.StorePage(page + offset, data[offset:offset + pageSize])
+            chunks.append(data)
+            page = runEnd
+
+        data = b"".join(chunks)
+        return data[address - first:end - first]
+
+    def StorePage(self, page, data):
+        self.pages[page] = data
+        while len(self.pages) > self.maxPages:
+            (evicted, _) = self.pages.popitem(last=False)
+            self.prefetched.discard(evicted)
+
+    def StorePrefetched(self, page, data):
+        """Stores the contents of |page| that were read ahead of time."""
+        self.StorePage(page, data)
+        self.prefetched.add(page)
+
+    def Write(self, address, data):
+        """Updates cached pages after |data| was written to |address|."""
+        data = bytes(data)
+        pageSize = self.pageSize
+        if not pageSize:
+            return
+        end = address + len(data)
+        page = address - address % pageSize
+        while page < end:
+            contents = self.pages.get(page)
+            if contents is not None:
+                start = max(address, page)
+                stop = min(end, page + pageSize)
+                self.pages[page] = (contents[:start - page] +
+                    data[start - address:stop - address] + contents[stop - page:])
+            page += pageSize
+
+    def Invalidate(self, address, size):
+        pageSize = self.pageSize
+        if not pageSize:
+            return
+        page = address - address % pageSize
+        while page < address + size:
+            self.pages.pop(page, None)
+            self.prefetched.discard(page)
+            page += pageSize
+
+
+class Prefetcher(object):
+    """Reads the targets of pointers into a MemoryCache ahead of time.
+
+    After the server read an object, it is likely to follow the pointers in
+    it next. Users pass memory the server read to Notice, and call Run while
+    there are no requests to handle. Run reads the pages that aligned,
+    pointer-sized values in that memory point to, if they point into the heap,
+    and stores them in the cache. Up to |depth| levels of pointers are
+    followed; 0 turns prefetching off. At most |budget| bytes are read until
+    the next Clear, which users call whenever they clear the cache.
+
+    |readFunc(address, size)| reads target memory without going through the
+    cache. |targetFunc()| returns the struct format of a pointer and the
+    (start, end) ranges of the heap; it is called once after each Clear, when
+    first needed.
+    """
+    # How much of the memory passed to Notice, and of each prefetched pointer
+    # target, is looked at for pointers.
+    maxNoticeSize = 4096
+    targetScanSize = 256
+
+    def __init__(self, cache, readFunc, targetFunc, depth=0, budget=1024 * 1024):
+        self.cache = cache
+        self.readFunc = readFunc
+        self.targetFunc = targetFunc
+        self.depth = depth
+        self.budget = budget
+        # (address, data, depth) of memory to look for pointers in.
+        self.scans = collections.deque()
+        # (pointer, depth) of pointer targets to read, and their pages.
+        self.targets = collections.deque()
+        self.queuedPages = set()
+        self.spent = 0
+        self.pointerFormat = None
+        self.heap = None
+        self.pagesRead = 0
+        self.failures = 0
+
+    def Clear(self):
+        self.scans.clear()
+        self.targets.clear()
+        self.queuedPages.clear()
+        self.spent = 0
+        self.pointerFormat = None
+        self.heap = None
+
+    def ResetStats(self):
+        self.pagesRead = 0
+        self.failures = 0
+
+    def Notice(self, address, data):
+        """Has the pointers in |data|, read from |address|, prefetched.
+        Returns whether there is anything for Run to do."""
+        if self.depth <= 0 or not self.cache.pageSize or self.spent >= self.budget:
+            return False
+        self.scans.append((address, data[:self.maxNoticeSize], 1))
+        return True
+
+    def Run(self):
+        """Does a bit of the prefetching: looks for pointers in one piece of
+        memory or reads one pointer target. Returns whether there is more to
+        do."""
+        if self.scans:
+            (address, data, depth) = self.scans.popleft()
+            self.Scan(address, data, depth)
+        elif self.targets:
+            (pointer, depth) = self.targets.popleft()
+            self.ReadTarget(pointer, depth)
+        return bool(self.scans or self.targets)
+
+    def Scan(self, address, data, depth):
+        if self.heap is None:
+            (self.pointerFormat, regions) = self.targetFunc()
+            self.heap = IntervalIndex()
+            for (start, end) in regions:
+                self.heap.Add(start, end, None)
+        fmt = self.pointerFormat
+        pointerSize = struct.calcsize(fmt)
+        skip = -address % pointerSize
+        count = max(0, (len(data) - skip) // pointerSize)
+        pointers = struct.unpack_from("%s%d%s" % (fmt[0], count, fmt[1:]), data, skip)
+        pageSize = self.cache.pageSize
+        for pointer in pointers:
+            page = pointer - pointer % pageSize
+            if (page in self.queuedPages or page in self.cache.pages or
+                    self.heap.Find(pointer) is None):
+                continue
+            self.queuedPages.add(page)
+            self.targets.append((pointer, depth))
+
+    def ReadTarget(self, pointer, depth):
+        pageSize = self.cache.pageSize
+        page = pointer - pointer % pageSize
+        self.queuedPages.discard(page)
+        data = self.cache.pages.get(page)
+        if data is None:
+            if self.spent + pageSize > self.budget:
+                # Out of budget until the next Clear.
+                self.scans.clear()
+                self.targets.clear()
+                self.queuedPages.clear()
+                return
+            self.spent += pageSize
+            try:
+                data = bytes(self.readFunc(page, pageSize))
+            except Exception:
+                self.failures += 1
+                return
+            self.pagesRead += 1
+            self.cache.StorePrefetched(page, data)
+        if depth < self.depth:
+            offset = pointer - page
+            self.scans.append((pointer, data[offset:offset + self.targetScanSize], depth + 1))
+
+
+# The functions below implement the memory requests of the protocol on top
+# of a read(address, size) function, such as MemoryCache.Read, that returns
+# a buffer or raises if the memory is not readable.
+
+def ReadMemoryRanges(read, ranges, encoding="hex"):
+    # Reads a list of (pointer, size) ranges. Overlapping and adjacent ranges
+    # are read together; if that fails, each of them is read on its own so
+    # that one bad pointer only fails its own range.
+    results = [None] * len(ranges)
+    for (start, end, indices) in MergeRanges(ranges):
+        try:
+            buf = read(start, end - start)
+        except:
+            buf = None
+        for i in indices:
+            (pointer, size) = ranges[i]
+            try:
+                if buf is not None:
+                    data = buf[pointer - start:pointer - start + size]
+                else:
+                    data = read(pointer, size)
+                results[i] = JsDbgTypes.SMemoryRangeResult(
+                    EncodeMemory(data, encoding), None)
+            except:
+                results[i] = JsDbgTypes.SMemoryRangeResult(
+                    None, str(sys.exc_info()[1]))
+    return results
+
+# Upper bound for the number of nodes FollowPointers and FollowPointerTree
+# return, regardless of what the server asks for.
+max_followed_nodes = 10000
+
+def ReadNode(read, pointerFormat, pointer, readSize, pointerOffsets):
+    # Reads |readSize| bytes at |pointer| plus whatever else is needed to get
+    # the pointers at |pointerOffsets|, which are in the struct format
+    # |pointerFormat|. Returns the bytes and the pointers.
+    pointerSize = struct.calcsize(pointerFormat)
+    size = max([readSize] + [offset + pointerSize for offset in pointerOffsets])
+    buf = read(pointer, size)
+    pointers = [struct.unpack_from(pointerFormat, buf, offset)[0]
+        for offset in pointerOffsets]
+    return (buf[:readSize], pointers)
+
+def FollowPointers(read, pointerFormat, start, nextOffset, maxHops, readSize,
+                   encoding="hex"):
+    # Walks a linked list: reads |readSize| bytes of each node, starting at
+    # |start| and following the pointer at |nextOffset| in each node, for up to
+    # |maxHops| hops. Stops at null pointers, cycles and unreadable nodes.
+    nodes = []
+    visited = set()
+    pointer = start
+    maxNodes = min(maxHops + 1, max_followed_nodes)
+    while pointer and pointer not in visited and len(nodes) < maxNodes:
+        visited.add(pointer)
+        try:
+            (buf, [nextPointer]) = ReadNode(read, pointerFormat, pointer,
+                readSize, [nextOffset])
+        except:
+            if not nodes:
+                raise
+            break
+        nodes.append(JsDbgTypes.SPointerNode(pointer, EncodeMemory(buf, encoding)))
+        pointer = nextPointer
+    return nodes
+
+def FollowPointerTree(read, pointerFormat, root, childOffsets, maxNodes,
+                      readSize, encoding="hex"):
+    # Like FollowPointers, but each node has several child pointers (e.g. a
+    # first child and a next sibling pointer). Returns the nodes in depth-first
+    # order, visiting children in the order of |childOffsets|.
+    nodes = []
+    visited = set()
+    stack = [root]
+    maxNodes = min(maxNodes, max_followed_nodes)
+    while stack and len(nodes) < maxNodes:
+        pointer = stack.pop()
+        if not pointer or pointer in visited:
+            continue
+        visited.add(pointer)
+        try:
+            (buf, children) = ReadNode(read, pointerFormat, pointer, readSize,
+                childOffsets)
+        except:
+            if pointer == root:
+                raise
+            continue
+        nodes.append(JsDbgTypes.SPointerNode(pointer, EncodeMemory(buf, encoding)))
+        stack.extend(reversed(children))
+    return nodes
+
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+class CommandTable(object):
+    """The functions that the JsDbg server is allowed to call.
+
+    Requests are of the form Function(arg, ...), where the arguments are
+    Python-style literals: integers, strings, True, False, None, and lists or
+    tuples of those. Requests are parsed with ParseCall rather than eval, so
+    the server can only ever call registered functions.
+    """
+    def __init__(self):
+        self.functions = {}
+        self.stopDependent = set()
+        self.sideEffects = set()
+        # Function name -> handler that answers requests for it without the
+        # debugger; see Direct.
+        self.direct = {}
+
+    def Register(self, func):
+        """Registers |func| under its name; can be used as a decorator."""
+        self.functions[func.__name__] = func
+        return func
+
+    def StopDependent(self, func):
+        """Marks |func| as only reading the state of the stopped target, so
+        that pending requests for it can be cancelled when that changes. Must
+        not be used for functions with side effects. Can be used as a
+        decorator."""
+        self.stopDependent.add(func.__name__)
+        return func
+
+    def SideEffects(self, func):
+        """Marks |func| as changing the state of the debugger or the target,
+        so that every request for it has to run. Can be used as a
+        decorator."""
+        self.sideEffects.add(func.__name__)
+        return func
+
+    def Direct(self, name):
+        """Returns a decorator that makes the decorated function answer
+        requests for the function |name| while the target's memory can be
+        read directly (see JsDbg.RunDirect). It gets a read(address, size)
+        function followed by the arguments of the request, and has to raise if
+        it can't answer exactly like |name| would."""
+        def decorator(func):
+            self.direct[name] = func
+            return func
+        return decorator
+
+    def Call(self, request):
+        (name, args) = ParseCall(request)
+        return self.Invoke(name, args)
+
+    def Invoke(self, name, args):
+        try:
+            func = self.functions[name]
+        except KeyError:
+            raise ValueError("Unknown function %s" % (name))
+        return func(*args)
+
+
+# time.perf_counter is only available on Python 3.3 and above.
+timer = getattr(time, "perf_counter", time.time)
+
+
+class LatencyHistogram(object):
+    # Upper bounds of the latency histogram buckets, in milliseconds. The last
+    # bucket counts everything slower.
+    bucketLimits = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000]
+
+    def __init__(self):
+        self.calls = 0
+        self.histogram = [0] * (len(self.bucketLimits) + 1)
+
+    def Add(self, seconds):
+        self.calls += 1
+        milliseconds = seconds * 1000
+        self.histogram[bisect.bisect_left(self.bucketLimits, milliseconds)] += 1
+
+    def Percentile(self, fraction):
+        """Returns the bucket limit (in ms) below which |fraction| of the
+        calls finished, or None if that is in the overflow bucket."""
+        remaining = fraction * self.calls
+        for (i, count) in enumerate(self.histogram):
+            remaining -= count
+            if remaining <= 0:
+                return self.bucketLimits[i] if i < len(self.bucketLimits) else None
+        return None
+
+
+class FunctionStats(LatencyHistogram):
+    def __init__(self):
+        super(FunctionStats, self).__init__()
+        self.errors = 0
+        self.queueTime = 0.0
+        self.executionTime = 0.0
+        self.responseBytes = 0
+
+
+class BridgeStats(object):
+    """Per-function request metrics for the bridge.
+
+    The query handlers call Record once they have run a function;
+    JsDbg.JsDbgRequest calls RecordQueueTime with how long each request
+    waited for the main thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.functions = {}
+        self.queueWait = LatencyHistogram()
+        self.queueWaitTime = 0.0
+        # Requests that were cancelled instead of run, see JsDbg.JsDbgBatch,
+        # and requests that were answered along with an identical one, see
+        # JsDbg.PostRequest, and requests that were answered without the
+        # debugger, see JsDbg.RunDirect.
+        self.cancelled = 0
+        self.merged = 0
+        self.direct = 0
+
+    def Function(self, name):
+        stats = self.functions.get(name)
+        if stats is None:
+            stats = self.functions[name] = FunctionStats()
+        return stats
+
+    def Record(self, name, executionTime, responseBytes, failed):
+        """Records a call of |name|."""
+        with self.lock:
+            stats = self.Function(name)
+            if failed:
+                stats.errors += 1
+            stats.executionTime += executionTime
+            stats.responseBytes += responseBytes
+            stats.Add(executionTime)
+
+    def RecordQueueTime(self, queueTime, names):
+        """Records that a request for the functions |names| (one per query)
+        waited |queueTime| to be run. The wait is split between the queries,
+        so the per-function queue times add up to the total."""
+        with self.lock:
+            self.queueWaitTime += queueTime
+            self.queueWait.Add(queueTime)
+            for name in names:
+                self.Function(name).queueTime += queueTime / len(names)
+
+    def RecordCancelled(self, count):
+        with self.lock:
+            self.cancelled += count
+
+    def RecordMerged(self):
+        with self.lock:
+            self.merged += 1
+
+    def RecordDirect(self):
+        with self.lock:
+            self.direct += 1
+
+    def Reset(self):
+        with self.lock:
+            self.functions = {}
+            self.queueWait = LatencyHistogram()
+            self.queueWaitTime = 0.0
+            self.cancelled = 0
+            self.merged = 0
+            self.direct = 0
+
+    def Format(self):
+        """Returns the metrics as a human-readable table."""
+        def FormatLimit(limit):
+            return "%g" % (limit) if limit is not None else ">%g" % (LatencyHistogram.bucketLimits[-1])
+        lines = ["%-28s %7s %6s %10s %10s %8s %8s %10s" % (
+            "Function", "Calls", "Errors", "Queue ms", "Exec ms", "p50 ms",
+            "p99 ms", "Bytes")]
+        with self.lock:
+            for name in sorted(self.functions):
+                stats = self.functions[name]
+                lines.append("%-28s %7d %6d %10.2f %10.2f %8s %8s %10d" % (
+                    name, stats.calls, stats.errors, stats.queueTime * 1000,
+                    stats.executionTime * 1000,
+                    FormatLimit(stats.Percentile(0.5)),
+                    FormatLimit(stats.Percentile(0.99)), stats.responseBytes))
+            if self.queueWait.calls:
+                lines.append("%d requests waited %.2f ms for the debugger, p50 %s ms, p99 %s ms" % (
+                    self.queueWait.calls, self.queueWaitTime * 1000,
+                    FormatLimit(self.queueWait.Percentile(0.5)),
+                    FormatLimit(self.queueWait.Percentile(0.99))))
+            if self.cancelled:
+                lines.append("%d stale queries cancelled" % (self.cancelled))
+            if self.merged:
+                lines.append("%d queries answered along with identical ones" % (self.merged))
+            if self.direct:
+                lines.append("%d queries answered without the debugger" % (self.direct))
+        return "\n".join(lines)
+
+
+class DiskCache(object):
+    """A string to string map that is kept in a dbm file at |path|.
+
+    Values are read from the file only when they are asked for (and then kept
+    in memory), so opening a large cache is cheap. Written values go to the
+    file right away, but may only be complete on disk once the cache is
+    closed.
+    """
+    def __init__(self, path):
+        self.db = dbm.open(path, "c")
+        self.memory = {}
+
+    def Get(self, key):
+        """Returns the value for |key|, or None."""
+        try:
+            return self.memory[key]
+        except KeyError:
+            pass
+        try:
+            value = self.db[key.encode("utf-8")].decode("utf-8")
+        except KeyError:
+            return None
+        self.memory[key] = value
+        return value
+
+    def Put(self, key, value):
+        self.memory[key] = value
+        self.db[key.encode("utf-8")] = value.encode("utf-8")
+
+    def Close(self):
+        self.db.close()
+
+
+# Traces of the traffic between the bridge and the server.
+#
+# A trace starts with a "jsdbg-trace <version> <start time>" line, followed by
+# records of the form
+#   <kind> <sequence number> <time> <duration> <length>\n<data>\n
+# where kind is "q" for a request from the server, "r" for the response to
+# the request with the same sequence number and "e" for an event. Times and
+# durations are in microseconds since the start of the trace; the duration of
+# a response is how long it took to run the request. <data> is <length> bytes
+# of UTF-8.
+trace_version = 1
+TraceRecord = collections.namedtuple("TraceRecord",
+    ["kind", "sequence", "time", "duration", "data"])
+
+
+class TraceWriter(object):
+    """Appends records to a trace file. Safe to use from several threads."""
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.start = timer()
+        self.file = open(path, "wb")
+        self.file.write(("jsdbg-trace %d %d\n" % (
+            trace_version, int(time.time()))).encode("ascii"))
+
+    def Write(self, kind, sequence, start, duration, data):
+        data = data.encode("utf-8")
+        header = "%s %d %d %d %d\n" % (kind, sequence,
+            (start - self.start) * 1000000, duration * 1000000, len(data))
+        with self.lock:
+            if self.file is not None:
+                self.file.write(header.encode("ascii") + data + b"\n")
+
+    def Request(self, sequence, start, request):
+        self.Write("q", sequence, start, 0, request)
+
+    def Response(self, sequence, start, duration, response):
+        self.Write("r", sequence, start, duration, response)
+
+    def Event(self, start, event):
+        self.Write("e", 0, start, 0, event)
+
+    def Flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def Close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def ReadTrace(path):
+    """Returns the records in the trace file at |path| as TraceRecords.
+    A truncated last record is ignored."""
+    records = []
+    with open(path, "rb") as f:
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != b"jsdbg-trace":
+            raise ValueError("%s is not a JsDbg trace" % (path))
+        if int(header[1]) != trace_version:
+            raise ValueError("Unsupported trace version %s" % (header[1].decode("ascii")))
+        while True:
+            fields = f.readline().split()
+            if len(fields) != 5:
+                break
+            length = int(fields[4])
+            data = f.read(length + 1)
+            if len(data) != length + 1:
+                break
+            records.append(TraceRecord(fields[0].decode("ascii"), int(fields[1]),
+                int(fields[2]) / 1000000.0, int(fields[3]) / 1000000.0,
+                data[:length].decode("utf-8")))
+    return records
+
+
+def RequestFunctionName(request):
+    """Returns the name of the function a DebuggerQuery request asks for
+    (for DebuggerBatch, the first one), or "(invalid)"."""
+    try:
+        (_, args) = ParseCall(request)
+        if isinstance(args[0], list):
+            args = args[0][0]
+        return ParseCall(args[1])[0]
+    except:
+        return "(invalid)"
+
+
+def ReplayTrace(module, records):
+    """Runs the requests in the trace |records| through |module|, like JsDbg
+    does, and returns (request, recorded response, recorded duration,
+    response, duration) tuples. The recorded response is None if the trace
+    ends before it. Note that events are not replayed."""
+    recorded = dict([(r.sequence, r) for r in records if r.kind == "r"])
+    results = []
+    for record in records:
+        if record.kind != "q":
+            continue
+        request = JsDbg.JsDbgRequest(module, record.data, False, record.sequence)
+        start = timer()
+        response = request()[:-1]
+        duration = timer() - start
+        original = recorded.get(record.sequence)
+        if original is None:
+            results.append((record.data, None, 0.0, response, duration))
+        else:
+            results.append((record.data, original.data, original.duration,
+                response, duration))
+    return results
+
+
+def FormatReplay(results):
+    """Returns a per-function comparison of ReplayTrace |results|."""
+    functions = {}
+    for (request, originalResponse, originalDuration, response, duration) in results:
+        name = RequestFunctionName(request)
+        f = functions.setdefault(name, [0, 0, 0.0, 0.0])
+        f[0] += 1
+        if originalResponse is not None and originalResponse != response:
+            f[1] += 1
+        f[2] += originalDuration
+        f[3] += duration
+    lines = ["%-28s %7s %7s %12s %12s" % (
+        "Function", "Calls", "Differ", "Recorded ms", "Replayed ms")]
+    for name in sorted(functions):
+        (calls, differ, originalDuration, duration) = functions[name]
+        lines.append("%-28s %7d %7d %12.2f %12.2f" % (
+            name, calls, differ, originalDuration * 1000, duration * 1000))
+    return "\n".join(lines)
+
+
+def IsTrace(path):
+    with open(path, "rb") as f:
+        return f.read(12) == b"jsdbg-trace "
+
+
+call_regex = re.compile(r"\s*([A-Za-z_][A-Za-z0-9_]*)\s*\(")
+token_regex = re.compile(r"""\s*(?:
+    (?P<hex>-?0[xX][0-9a-fA-F]+)[lL]? |
+    (?P<int>-?[0-9]+)[lL]? |
+    "(?P<dq>[^"\\]*(?:\\.[^"\\]*)*)" |
+    '(?P<sq>[^'\\]*(?:\\.[^'\\]*)*)' |
+    (?P<name>True|False|None)\b |
+    (?P<punct>[][(),]))""", re.VERBOSE | re.DOTALL)
+escape_regex = re.compile(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|.)", re.DOTALL)
+simple_escapes = {
+    "\\": "\\", "'": "'", '"': '"', "n": "\n", "r": "\r", "t": "\t",
+    "0": "\0", "\n": "",
+}
+named_values = {"True": True, "False": False, "None": None}
+closing_brackets = {"(": ")", "[": "]"}
+
+
+def ParseCall(text):
+    """Parses "Function(arg, ...)" into a (name, [args]) tuple.
+
+    Raises ValueError if |text| is not a call with literal arguments.
+    """
+    match = call_regex.match(text)
+    if match is None:
+        raise ValueError("Invalid request: %s" % (text))
+    (args, pos) = ParseSequence(text, match.end(), ")")
+    if text[pos:].strip():
+        raise ValueError("Unexpected text after request: %s" % (text[pos:]))
+    return (match.group(1), args)
+
+
+def ParseSequence(text, pos, closing):
+    values = []
+    while True:
+        match = NextToken(text, pos)
+        pos = match.end()
+        if match.group("punct") == closing:
+            return (values, pos)
+        (value, pos) = ParseValue(text, match)
+        values.append(value)
+
+        match = NextToken(text, pos)
+        pos = match.end()
+        punct = match.group("punct")
+        if punct == closing:
+            return (values, pos)
+        if punct != ",":
+            raise ValueError("Expected , or %s at offset %d" % (closing, match.start()))
+
+
+def NextToken(text, pos):
+    match = token_regex.match(text, pos)
+    if match is None:
+        raise ValueError("Invalid syntax at offset %d" % (pos))
+    return match
+
+
+def ParseValue(text, match):
+    kind = match.lastgroup
+    pos = match.end()
+    if kind == "int":
+        return (int(match.group("int")), pos)
+    elif kind == "hex":
+        return (int(match.group("hex"), 16), pos)
+    elif kind == "dq" or kind == "sq":
+        value = match.group(kind)
+        if "\\" in value:
+            value = escape_regex.sub(Unescape, value)
+        return (value, pos)
+    elif kind == "name":
+        return (named_values[match.group("name")], pos)
+    elif kind == "punct" and match.group("punct") in closing_brackets:
+        bracket = match.group("punct")
+        (values, pos) = ParseSequence(text, pos, closing_brackets[bracket])
+        if bracket == "(":
+            values = tuple(values)
+        return (values, pos)
+    raise ValueError("Unexpected %s at offset %d" % (match.group(0).strip(), match.start()))
+
+
+def Unescape(match):
+    escape = match.group(1)
+    if len(escape) > 1:
+        return unichr(int(escape[1:], 16))
+    return simple_escapes.get(escape, "\\" + escape)
+
 
+module_name_regex = re.compile(
+    "^(mmap_(pack|hardlink)_[0-9]+_)?(lib)?(.*?)(.so)?[.0-9]*$")
+formatted_modules = {}
 
 # Input is /foo/bar/libfoo.so, or /foo/bar/some_executable
 def FormatModule(module):
+    # This gets called for every objfile and address lookup, so remember the
+    # results; there are only as many distinct inputs as loaded modules.
+    try:
+        return formatted_modules[module]
+    except KeyError:
+        pass
     # First, we strip out the path to the module
-    module = module[module.rfind("/") + 1:]
+    name = module[module.rfind("/") + 1:]
     # Then, we remove the lib prefix and .so / .so.1.2 suffix, if present.
     # Also remove any prefix added my rr (mmap_pack_123_ or mmap_hardlink_123_).
-    return re.match(
-        "^(mmap_(pack|hardlink)_[0-9]+_)?(lib)?(.*?)(.so)?[.0-9]*$",
-        module).groups()[3]
+    name = module_name_regex.match(name).groups()[3]
+    formatted_modules[module] = name
+    return name
@@ -1,9 +1,64 @@
 #!/usr/bin/python
 # Unit tests for JsDbBase.py
 # Use "python JsDbgBase_test.py" to run.
+import io
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import types
 import unittest
 
 import JsDbgBase
+import JsDbgTypes
+
+class FakeWriter(object):
+    def __init__(self):
+        self.data = []
+
+    def Write(self, data):
+        self.data.append(data)
+
+class FakeJsDbg(JsDbgBase.JsDbg):
+    maxBatchSize = 2
+
+    def __init__(self, module=None):
+        self.module = module
+        self.verbose = False
+        self.requestSequence = 0
+        self.mergeableRequests = {}
+        self.writer = FakeWriter()
+        self.pendingRequests = []
+        self.pendingRequestsLock = threading.Lock()
+        self.batchPosted = True
+        self.idleWanted = False
+        self.idlePosted = False
+        self.posted = []
+        self.trace = None
+        self.generation = 0
+        self.events = []
+        self.pendingSideEffects = 0
+        self.directMemory = None
+
+    def post_event_func(self, callback):
+        self.posted.append(callback)
+
+    def SendEvent(self, event):
+        self.events.append(event)
+
+class FakeMemory(object):
+    """Up to 64 bytes of readable memory at address 0x100."""
+    def __init__(self):
+        self.data = bytearray(range(64))
+        self.limit = 0x140
+        self.reads = []
+
+    def Read(self, address, size):
+        self.reads.append((address, size))
+        if address < 0x100 or address + size > self.limit:
+            raise Exception('Cannot access memory at address 0x%x' % (address))
+        return self.data[address - 0x100:address - 0x100 + size]
 
 class TestJsDbg(unittest.TestCase):
 
@@ -14,6 +69,578 @@ class TestJsDbg(unittest.TestCase):
         self.assertEqual(JsDbgBase.FormatModule('/foo/mmap_pack_12_libFoo.so.1.2.3'), 'Foo')
         self.assertEqual(JsDbgBase.FormatModule('/foo/chrome'), 'chrome')
         self.assertEqual(JsDbgBase.FormatModule('mmap_hardlink_0_chrome'), 'chrome')
+        # Results are remembered, and stay correct when asked again.
+        self.assertEqual(JsDbgBase.formatted_modules['/foo/chrome'], 'chrome')
+        self.assertEqual(JsDbgBase.FormatModule('/foo/libFoo.so.1'), 'Foo')
+
+    def test_JsDbgBatch(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        @module.commands.Register
+        def Query(value):
+            return str(value)
+        jsdbg = FakeJsDbg()
+        for i in range(3):
+            jsdbg.pendingRequests.append(JsDbgBase.JsDbg.JsDbgRequest(
+                module, 'Query(%d)' % i, False))
+
+        batch = JsDbgBase.JsDbg.JsDbgBatch(jsdbg)
+        batch()
+        # Only maxBatchSize requests run at once; the batch reposts itself.
+        self.assertEqual(jsdbg.writer.data, ['0\n1\n'])
+        self.assertEqual(jsdbg.posted, [batch])
+        self.assertTrue(jsdbg.batchPosted)
+
+        batch()
+        self.assertEqual(jsdbg.writer.data, ['0\n1\n', '2\n'])
+        self.assertEqual(jsdbg.posted, [batch])
+        self.assertFalse(jsdbg.batchPosted)
+
+    def test_JsDbgIdle(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        @module.commands.Register
+        def Query(value):
+            return str(value)
+        work = [1, 2, 3]
+        def RunIdleTask():
+            work.pop()
+            return len(work) > 0
+        module.RunIdleTask = RunIdleTask
+        jsdbg = FakeJsDbg(module)
+        jsdbg.pendingRequests.append(JsDbgBase.JsDbg.JsDbgRequest(module, 'Query(1)', False))
+
+        # Idle work waits until the pending requests are handled.
+        jsdbg.PostIdle()
+        self.assertEqual(jsdbg.posted, [])
+        JsDbgBase.JsDbg.JsDbgBatch(jsdbg)()
+        self.assertEqual(len(jsdbg.posted), 1)
+        idle = jsdbg.posted[0]
+        self.assertTrue(isinstance(idle, JsDbgBase.JsDbg.JsDbgIdle))
+
+        # It stops as soon as a request arrives, and lets the batch post it
+        # again.
+        jsdbg.pendingRequests.append(JsDbgBase.JsDbg.JsDbgRequest(module, 'Query(2)', False))
+        jsdbg.batchPosted = True
+        idle()
+        self.assertEqual(work, [1, 2, 3])
+        jsdbg.pendingRequests = []
+        jsdbg.batchPosted = False
+        jsdbg.PostIdle()
+        self.assertEqual(len(jsdbg.posted), 2)
+        jsdbg.posted[1]()
+        self.assertEqual(work, [])
+        self.assertEqual(len(jsdbg.posted), 2)
+        self.assertFalse(jsdbg.idlePosted)
+
+    def test_JsDbgBatchCancelsStaleRequests(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        @module.commands.Register
+        def DebuggerQuery(tag, command):
+            return '%d~%s' % (tag, module.commands.Call(command))
+        @module.commands.Register
+        def DebuggerBatch(queries):
+            return '\n'.join([DebuggerQuery(tag, command) for (tag, command) in queries])
+        @module.commands.Register
+        @module.commands.StopDependent
+        def ReadMemory(pointer):
+            return pointer
+        @module.commands.Register
+        def WriteMemory(pointer):
+            return pointer
+        jsdbg = FakeJsDbg()
+        jsdbg.maxBatchSize = 64
+        for (generation, request) in [
+                (0, "DebuggerQuery(1,'ReadMemory(1)')"),
+                (0, "DebuggerQuery(2,'WriteMemory(2)')"),
+                (0, "DebuggerBatch([(3,'ReadMemory(3)'),(4,'ReadMemory(4)')])"),
+                (0, "DebuggerBatch([(5,'ReadMemory(5)'),(6,'WriteMemory(6)')])"),
+                (0, "DebuggerQuery(7,'ReadMemory(7')"),
+                (1, "DebuggerQuery(8,'ReadMemory(8)')")]:
+            jsdbg.pendingRequests.append(JsDbgBase.JsDbg.JsDbgRequest(
+                module, request, False, 0, generation))
+        jsdbg.generation = 1
+        JsDbgBase.JsDbg.JsDbgBatch(jsdbg)()
+
+        error = JsDbgBase.cancelled_error
+        self.assertEqual(jsdbg.writer.data, [
+            '1!%s\n2~2\n3!%s\n4!%s\n5~5\n6~6\n7!%s\n8~8\n' % (error, error, error, error)])
+        self.assertEqual(jsdbg.events, ['cancelled 4'])
+        self.assertEqual(module.stats.cancelled, 4)
+        self.assertIn('4 stale queries cancelled', module.stats.Format())
+
+    def test_PostRequestMergesIdenticalQueries(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        calls = []
+        @module.commands.Register
+        def DebuggerQuery(tag, command):
+            calls.append(command)
+            return '%d~%s' % (tag, module.commands.Call(command))
+        @module.commands.Register
+        def GetAllFields(module, type):
+            return type
+        @module.commands.Register
+        @module.commands.SideEffects
+        def WriteMemory(pointer):
+            return pointer
+        memory = {'x': 'old'}
+        @module.commands.Register
+        def Read(name):
+            return memory[name]
+        @module.commands.Register
+        @module.commands.SideEffects
+        def Write(name, value):
+            memory[name] = value
+            return value
+        jsdbg = FakeJsDbg(module)
+        jsdbg.maxBatchSize = 64
+        jsdbg.batchPosted = False
+        for request in [
+                "DebuggerQuery(1,'GetAllFields(\"m\",\"A\")')",
+                "DebuggerQuery(2,'GetAllFields(\"m\",\"B\")')",
+                "DebuggerQuery(3,'GetAllFields(\"m\",\"A\")')",
+                "DebuggerQuery(4,'WriteMemory(1)')",
+                "DebuggerQuery(5,'WriteMemory(1)')",
+                "DebuggerQuery(6,'GetAllFields(\"m\",\"A\")')"]:
+            jsdbg.PostRequest((request + '\n').encode('utf-8'))
+        self.assertEqual(len(jsdbg.posted), 1)
+        jsdbg.posted[0]()
+        # Requests after one with side effects are not merged with those
+        # before it.
+        self.assertEqual(calls, ['GetAllFields("m","A")', 'GetAllFields("m","B")',
+            'WriteMemory(1)', 'WriteMemory(1)', 'GetAllFields("m","A")'])
+        self.assertEqual(jsdbg.writer.data, ['1~A\n3~A\n2~B\n4~1\n5~1\n6~A\n'])
+        self.assertEqual(module.stats.merged, 1)
+        self.assertEqual(jsdbg.mergeableRequests, {})
+
+        # Once a request has run, identical ones run again, and requests
+        # from another generation are never merged.
+        jsdbg.PostRequest(b"DebuggerQuery(7,'GetAllFields(\"m\",\"A\")')\n")
+        jsdbg.generation = 1
+        jsdbg.PostRequest(b"DebuggerQuery(8,'GetAllFields(\"m\",\"A\")')\n")
+        jsdbg.posted[-1]()
+        self.assertEqual(jsdbg.writer.data[-1], '7~A\n8~A\n')
+        self.assertEqual(len(calls), 7)
+
+        # A read after a write sees what was written.
+        for request in [
+                "DebuggerQuery(1,'Read(\"x\")')",
+                "DebuggerQuery(2,'Write(\"x\",\"new\")')",
+                "DebuggerQuery(3,'Read(\"x\")')"]:
+            jsdbg.PostRequest((request + '\n').encode('utf-8'))
+        jsdbg.posted[-1]()
+        self.assertEqual(jsdbg.writer.data[-1], '1~old\n2~new\n3~new\n')
+
+    def test_PostRequestReadsMemoryDirectly(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        @module.commands.Register
+        def DebuggerQuery(tag, command):
+            return '%d~%s' % (tag, module.commands.Call(command))
+        @module.commands.Register
+        def DebuggerBatch(queries):
+            return '\n'.join([DebuggerQuery(tag, command) for (tag, command) in queries])
+        @module.commands.Register
+        def ReadMemory(pointer, size):
+            return 'debugger'
+        @module.commands.Direct('ReadMemory')
+        def ReadMemoryDirect(read, pointer, size):
+            return JsDbgBase.EncodeMemory(read(pointer, size), 'hex')
+        @module.commands.Register
+        @module.commands.SideEffects
+        def WriteMemory(pointer):
+            return pointer
+        jsdbg = FakeJsDbg(module)
+        jsdbg.maxBatchSize = 64
+        jsdbg.batchPosted = False
+
+        # Without direct memory access, everything goes to the debugger.
+        jsdbg.PostRequest(b"DebuggerQuery(1,'ReadMemory(256,2)')\n")
+        self.assertEqual(len(jsdbg.posted), 1)
+        jsdbg.posted[0]()
+        self.assertEqual(jsdbg.writer.data, ['1~debugger\n'])
+
+        jsdbg.directMemory = FakeMemory()
+        jsdbg.PostRequest(b"DebuggerQuery(2,'ReadMemory(256,2)')\n")
+        self.assertEqual(jsdbg.writer.data[-1], '2~0001\n')
+        self.assertEqual(len(jsdbg.posted), 1)
+        self.assertEqual(module.stats.direct, 1)
+        self.assertEqual(module.stats.functions['ReadMemory'].calls, 1)
+
+        # Failed reads, batches and reads behind a pending request with side
+        # effects go to the debugger.
+        for request in [
+                "DebuggerQuery(3,'ReadMemory(0,2)')",
+                "DebuggerBatch([(4,'ReadMemory(256,2)')])",
+                "DebuggerQuery(5,'WriteMemory(256)')",
+                "DebuggerQuery(6,'ReadMemory(256,2)')"]:
+            jsdbg.PostRequest((request + '\n').encode('utf-8'))
+        self.assertEqual(len(jsdbg.posted), 2)
+        self.assertEqual(jsdbg.pendingSideEffects, 1)
+        jsdbg.posted[1]()
+        self.assertEqual(jsdbg.writer.data[-1],
+            '3~debugger\n4~debugger\n5~256\n6~debugger\n')
+        self.assertEqual(jsdbg.pendingSideEffects, 0)
+        self.assertEqual(module.stats.direct, 1)
+        jsdbg.PostRequest(b"DebuggerQuery(7,'ReadMemory(257,2)')\n")
+        self.assertEqual(jsdbg.writer.data[-1], '7~0102\n')
+        self.assertEqual(module.stats.direct, 2)
+        self.assertIn('2 queries answered without the debugger', module.stats.Format())
+
+    @unittest.skipUnless(JsDbgBase.direct_memory_supported and os.path.exists('/proc/self/mem'),
+        'needs os.pread and /proc')
+    def test_ProcessMemory(self):
+        import ctypes
+        data = ctypes.create_string_buffer(b'JsDbg memory', 12)
+        memory = JsDbgBase.ProcessMemory(os.getpid())
+        try:
+            self.assertEqual(memory.Read(ctypes.addressof(data), 12), b'JsDbg memory')
+            self.assertRaises(Exception, memory.Read, 0, 8)
+        finally:
+            memory.Close()
+        # The direct reader may still hold on to it.
+        self.assertRaises(IOError, memory.Read, ctypes.addressof(data), 12)
+        memory.Close()
+
+    def test_Serialize(self):
+        class Field(JsDbgTypes.SFieldResult):
+            __slots__ = ()
+        fields = [JsDbgTypes.SFieldResult(0, 4, 0, 0, 'a_', 'int'),
+                  Field(4.0, 8, -1, 0, 'b_', 'Foo *')]
+        bases = [JsDbgTypes.SBaseTypeResult('m', 'Base', 0)]
+        constants = [JsDbgTypes.SConstantResult('kA', 1)]
+        frame = JsDbgTypes.SStackFrame(1, 2, 3)
+        symbol = JsDbgTypes.SNamedSymbol('m', 'x', JsDbgTypes.SSymbolResult('int', 16))
+        results = [
+            fields + bases + constants + fields,
+            [JsDbgTypes.STypeDescription('m', 'Foo', 12, False, fields, bases, []),
+             JsDbgTypes.STypeDescription('m', 'E', None, True, [], [], constants),
+             JsDbgTypes.STypeDescription('m', 'Empty', 0, False, [], [], [])],
+            [JsDbgTypes.SStackFrameSymbols(frame, [symbol, symbol]),
+             JsDbgTypes.SStackFrameSymbols(frame, [])],
+            [JsDbgTypes.SMemoryRangeResult('00', None),
+             JsDbgTypes.SMemoryRangeResult(None, 'Cannot access memory'),
+             JsDbgTypes.SNoResult(), JsDbgTypes.SPointerNode(16, '00')],
+            [1, 'a', [bases[0], 2], (3,), None],
+            [],
+            fields[0],
+            'text',
+            True,
+        ]
+        for result in results:
+            self.assertEqual(JsDbgTypes.Serialize(result), str(result))
+        self.assertEqual(JsDbgTypes.Serialize(fields), '[{0#4#0#0#a_#int}, {4#8#-1#0#b_#Foo *}]')
+        # Records, including subclasses that declare no slots of their own,
+        # have no __dict__.
+        self.assertFalse(hasattr(fields[1], '__dict__'))
+        self.assertFalse(hasattr(symbol, '__dict__'))
+
+    def test_PipeReader(self):
+        lines = []
+        (stdoutRead, stdoutWrite) = os.pipe()
+        (stderrRead, stderrWrite) = os.pipe()
+        stdout = os.fdopen(stdoutRead, 'rb')
+        stderr = os.fdopen(stderrRead, 'rb')
+        reader = JsDbgBase.PipeReader()
+        reader.chunkSize = 4
+        reader.Add(stdout, lambda line: lines.append(('out', line)))
+        reader.Add(stderr, lambda line: lines.append(('err', line)))
+        thread = threading.Thread(target=reader.Run)
+        thread.start()
+        os.write(stdoutWrite, b'Query(1)\nQuery(2)\nQue')
+        os.write(stderrWrite, b'oops\n')
+        os.close(stderrWrite)
+        os.write(stdoutWrite, b'ry(3)\nQuery(4)')
+        os.close(stdoutWrite)
+        # Run returns once both pipes are closed, without needing the process
+        # to exit.
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([line for (pipe, line) in lines if pipe == 'out'],
+            [b'Query(1)\n', b'Query(2)\n', b'Query(3)\n', b'Query(4)'])
+        self.assertEqual([line for (pipe, line) in lines if pipe == 'err'], [b'oops\n'])
+        stdout.close()
+        stderr.close()
+
+    def test_ResponseWriter(self):
+        class SlowStream(io.BytesIO):
+            def __init__(self):
+                io.BytesIO.__init__(self)
+                self.flushes = 0
+                self.blocked = threading.Event()
+                self.unblock = threading.Event()
+            def flush(self):
+                self.flushes += 1
+                self.blocked.set()
+                self.unblock.wait(10)
+
+        stream = SlowStream()
+        writer = JsDbgBase.ResponseWriter(stream)
+        writer.Write('1~a\n')
+        # While the stream is blocked, writes queue up and the writer doesn't
+        # block.
+        self.assertTrue(stream.blocked.wait(10))
+        writer.Write('%cont\n')
+        writer.Write('2~\u00e9\n')
+        self.assertEqual(writer.Depth(), 2)
+        stream.unblock.set()
+        writer.WaitUntilWritten()
+        # The queued writes were written in order and flushed together.
+        self.assertEqual(stream.getvalue().decode('utf-8'), '1~a\n%cont\n2~\u00e9\n')
+        self.assertEqual(stream.flushes, 2)
+        self.assertEqual((writer.Depth(), writer.maxDepth, writer.flushes), (0, 2, 2))
+
+        # Once the stream fails, everything is dropped instead of blocking.
+        stream.close()
+        writer.Write('3~b\n')
+        writer.WaitUntilWritten()
+        self.assertTrue(writer.closed)
+        writer.Write('4~c\n')
+        self.assertEqual(writer.Depth(), 0)
+
+    def test_ParseCall(self):
+        self.assertEqual(JsDbgBase.ParseCall('Foo()'), ('Foo', []))
+        self.assertEqual(
+            JsDbgBase.ParseCall('GetAllFields("chrome","blink::Node",True)'),
+            ('GetAllFields', ['chrome', 'blink::Node', True]))
+        self.assertEqual(
+            JsDbgBase.ParseCall(' ReadMemoryBytes(0x7fFF0010, 8) '),
+            ('ReadMemoryBytes', [0x7fff0010, 8]))
+        self.assertEqual(
+            JsDbgBase.ParseCall("F(-12, None, False, '', 'it\\'s', \"a\\\\b\\x41\\n\")"),
+            ('F', [-12, None, False, '', "it's", 'a\\bA\n']))
+        self.assertEqual(
+            JsDbgBase.ParseCall("DebuggerBatch([(1, 'A(\"x\")'), (2, 'B()'),], [], (3,))"),
+            ('DebuggerBatch', [[(1, 'A("x")'), (2, 'B()')], [], (3,)]))
+        # Strings are not interpreted, so they can contain anything.
+        self.assertEqual(
+            JsDbgBase.ParseCall("DebuggerQuery(1,'LookupConstant(\"m\",\"None\",\"a, b)\")')"),
+            ('DebuggerQuery', [1, 'LookupConstant("m","None","a, b)")']))
+
+    def test_ParseCallRejectsExpressions(self):
+        for request in [
+                'Foo', 'Foo(', 'Foo(1 2)', 'Foo(,)', 'Foo(1,,2)', 'Foo(1]',
+                'Foo(x)', 'Foo(1+2)', 'Foo(Bar())', 'Foo(1).bar', 'a.b()',
+                '__import__("os").system("true")', 'Foo(TrueX)', 'Foo("a)']:
+            self.assertRaises(ValueError, JsDbgBase.ParseCall, request)
+
+    def test_CommandTable(self):
+        commands = JsDbgBase.CommandTable()
+        @commands.Register
+        def Add(a, b):
+            return a + b
+        self.assertEqual(commands.Call('Add(1, 0x10)'), 17)
+        self.assertRaises(ValueError, commands.Call, 'Subtract(1, 2)')
+        self.assertRaises(ValueError, commands.Call, 'eval("1")')
+
+    def test_EncodeMemory(self):
+        data = bytearray(b'\x00\x2a\xff\x10')
+        self.assertEqual(JsDbgBase.EncodeMemory(data, 'hex'), '002aff10')
+        self.assertEqual(JsDbgBase.EncodeMemory(data, 'base64'), 'ACr/EA==')
+        self.assertEqual(JsDbgBase.DecodeMemory('002aff10', 'hex'), data)
+        self.assertEqual(JsDbgBase.DecodeMemory('ACr/EA==', 'base64'), data)
+        self.assertRaises(ValueError, JsDbgBase.EncodeMemory, data, 'raw')
+        self.assertRaises(ValueError, JsDbgBase.DecodeMemory, 'AA', 'raw')
+
+    def test_MemoryCache(self):
+        memory = FakeMemory()
+        cache = JsDbgBase.MemoryCache(memory.Read, pageSize=16, maxPages=3)
+        self.assertEqual(cache.Read(0x104, 4), bytes(bytearray([4, 5, 6, 7])))
+        self.assertEqual(cache.Read(0x108, 8), bytes(memory.data[8:16]))
+        self.assertEqual(memory.reads, [(0x100, 16)])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # Reads spanning pages only read the missing ones, in one go.
+        self.assertEqual(cache.Read(0x10c, 0x20), bytes(memory.data[12:44]))
+        self.assertEqual(memory.reads, [(0x100, 16), (0x110, 32)])
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+
+        # Writes update cached pages in place.
+        cache.Write(0x11e, b'\xaa\xbb\xcc')
+        self.assertEqual(cache.Read(0x11d, 5), b'\x1d\xaa\xbb\xcc\x21')
+
+        # Reading another page evicts the least recently used one.
+        self.assertEqual(cache.Read(0x130, 16), bytes(memory.data[48:64]))
+        self.assertEqual(list(cache.pages.keys()), [0x110, 0x120, 0x130])
+
+        # Unreadable pages fall back to reading exactly what was asked for.
+        cache.Clear()
+        memory.limit = 0x138
+        self.assertEqual(cache.Read(0x130, 8), bytes(memory.data[48:56]))
+        self.assertEqual(memory.reads[-2:], [(0x130, 16), (0x130, 8)])
+        self.assertRaises(Exception, cache.Read, 0x134, 8)
+        memory.limit = 0x140
+
+        cache.Read(0x110, 32)
+        cache.Invalidate(0x11f, 2)
+        self.assertEqual(list(cache.pages.keys()), [])
+        cache.Read(0x100, 4)
+        cache.Clear()
+        self.assertEqual(len(cache.pages), 0)
+
+        # Reads larger than the cache bypass it.
+        del memory.reads[:]
+        cache.Read(0x100, 64)
+        self.assertEqual(memory.reads, [(0x100, 64)])
+        self.assertEqual(len(cache.pages), 0)
+
+        # A page size of 0 turns the cache off.
+        cache.Configure(0, 3)
+        del memory.reads[:]
+        self.assertEqual(cache.Read(0x104, 4), bytes(bytearray([4, 5, 6, 7])))
+        cache.Write(0x104, b'\xaa')
+        cache.Invalidate(0x104, 1)
+        self.assertEqual(memory.reads, [(0x104, 4)])
+        self.assertEqual(len(cache.pages), 0)
+
+    def test_Prefetcher(self):
+        memory = FakeMemory()
+        # Pointers at 0x100 (to 0x128, in the heap), 0x108 (to 0x1000, not
+        # in the heap) and 0x128 (to 0x138, one level deeper).
+        memory.data[0:8] = struct.pack('<Q', 0x128)
+        memory.data[8:16] = struct.pack('<Q', 0x1000)
+        memory.data[0x28:0x30] = struct.pack('<Q', 0x138)
+        used = []
+        cache = JsDbgBase.MemoryCache(memory.Read, pageSize=16, maxPages=8,
+            prefetchUsedFunc=lambda page, size: used.append((page, size)))
+        prefetcher = JsDbgBase.Prefetcher(cache, memory.Read,
+            lambda: ('<Q', [(0x100, 0x140)]))
+        # Off by default.
+        self.assertFalse(prefetcher.Notice(0x100, cache.Read(0x100, 16)))
+
+        prefetcher.depth = 2
+        self.assertTrue(prefetcher.Notice(0x100, cache.Read(0x100, 16)))
+        while prefetcher.Run():
+            pass
+        self.assertEqual(memory.reads, [(0x100, 16), (0x120, 16), (0x130, 16)])
+        self.assertEqual(prefetcher.pagesRead, 2)
+        self.assertEqual(list(cache.pages.keys()), [0x100, 0x120, 0x130])
+
+        # Using prefetched pages counts as a prefetch hit, once.
+        self.assertEqual(cache.Read(0x128, 8), struct.pack('<Q', 0x138))
+        cache.Read(0x120, 4)
+        self.assertEqual((cache.prefetchHits, used), (1, [(0x120, 16)]))
+        cache.Invalidate(0x130, 1)
+        self.assertEqual(cache.prefetched, set())
+
+        # At most |budget| bytes are read until the next Clear.
+        cache.Clear()
+        prefetcher.Clear()
+        prefetcher.budget = 16
+        prefetcher.Notice(0x100, cache.Read(0x100, 16))
+        while prefetcher.Run():
+            pass
+        self.assertEqual(prefetcher.pagesRead, 3)
+        self.assertEqual(list(cache.pages.keys()), [0x100, 0x120])
+        self.assertFalse(prefetcher.Notice(0x120, cache.Read(0x120, 16)))
+
+    def test_MergeRanges(self):
+        self.assertEqual(JsDbgBase.MergeRanges([]), [])
+        self.assertEqual(
+            JsDbgBase.MergeRanges([(0x40, 8), (0x10, 8), (0x18, 4), (0x14, 2), (0x30, 8)]),
+            [(0x10, 0x1c, [1, 3, 2]), (0x30, 0x38, [4]), (0x40, 0x48, [0])])
+
+    def test_IntervalIndex(self):
+        index = JsDbgBase.IntervalIndex()
+        self.assertIsNone(index.Find(0x10))
+        index.Add(0x10, 0x20, 'a')
+        index.Add(0x40, 0x41, 'b')
+        self.assertEqual(index.Find(0x10), (0x10, 'a'))
+        self.assertEqual(index.Find(0x1f), (0x10, 'a'))
+        self.assertIsNone(index.Find(0x20))
+        self.assertIsNone(index.Find(0x41))
+        # Ranges grow as more of a symbol is seen...
+        index.Add(0x40, 0x48, 'b')
+        self.assertEqual(index.Find(0x47), (0x40, 'b'))
+        # ...but never into their neighbors.
+        index.Add(0x18, 0x50, 'c')
+        self.assertEqual(index.Find(0x17), (0x10, 'a'))
+        self.assertEqual(index.Find(0x30), (0x18, 'c'))
+        self.assertEqual(index.Find(0x40), (0x40, 'b'))
+        index.Clear()
+        self.assertIsNone(index.Find(0x40))
+
+    def test_BridgeStats(self):
+        stats = JsDbgBase.BridgeStats()
+        stats.RecordQueueTime(0.002, ['IsTypeEnum', 'IsTypeEnum'])
+        stats.RecordQueueTime(0.0004, ['IsTypeEnum', 'ReadMemoryBytes'])
+        stats.Record('IsTypeEnum', 0.00003, 10, False)
+        stats.Record('IsTypeEnum', 0.0002, 10, False)
+        stats.Record('IsTypeEnum', 0.003, 5, True)
+        stats.Record('ReadMemoryBytes', 2.0, 100, False)
+        isTypeEnum = stats.functions['IsTypeEnum']
+        self.assertEqual((isTypeEnum.calls, isTypeEnum.errors, isTypeEnum.responseBytes), (3, 1, 25))
+        # A batch's wait is only counted once.
+        self.assertAlmostEqual(isTypeEnum.queueTime, 0.0022)
+        self.assertAlmostEqual(stats.functions['ReadMemoryBytes'].queueTime, 0.0002)
+        self.assertEqual(stats.queueWait.calls, 2)
+        self.assertAlmostEqual(stats.queueWaitTime, 0.0024)
+        self.assertEqual(stats.queueWait.Percentile(0.5), 0.5)
+        self.assertEqual(stats.queueWait.Percentile(0.99), 2.5)
+        self.assertEqual(isTypeEnum.Percentile(0.5), 0.25)
+        self.assertEqual(isTypeEnum.Percentile(0.99), 5)
+        self.assertIsNone(stats.functions['ReadMemoryBytes'].Percentile(0.5))
+
+        lines = stats.Format().split('\n')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('IsTypeEnum'))
+        self.assertIn('>1000', lines[2])
+        self.assertIn('2 requests waited 2.40 ms', lines[3])
+        stats.Reset()
+        self.assertEqual(len(stats.Format().split('\n')), 1)
+
+    def test_Trace(self):
+        module = types.ModuleType('fake')
+        module.commands = JsDbgBase.CommandTable()
+        module.stats = JsDbgBase.BridgeStats()
+        @module.commands.Register
+        def Query(value):
+            return '%d~%s\n%d~\u00e9' % (value, value * 2, value)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'trace')
+            jsdbg = FakeJsDbg()
+            jsdbg.trace = JsDbgBase.TraceWriter(path)
+            jsdbg.trace.Event(JsDbgBase.timer(), '%stop')
+            for i in range(2):
+                request = JsDbgBase.JsDbg.JsDbgRequest(module, 'Query(%d)' % (i + 1), False, i + 1)
+                jsdbg.trace.Request(request.sequence, request.receivedTime, request.request)
+                jsdbg.pendingRequests.append(request)
+            JsDbgBase.JsDbg.JsDbgBatch(jsdbg)()
+            jsdbg.trace.Close()
+
+            self.assertTrue(JsDbgBase.IsTrace(path))
+            records = JsDbgBase.ReadTrace(path)
+            self.assertEqual([(r.kind, r.sequence, r.data) for r in records], [
+                ('e', 0, '%stop'), ('q', 1, 'Query(1)'), ('q', 2, 'Query(2)'),
+                ('r', 1, '1~2\n1~\u00e9'), ('r', 2, '2~4\n2~\u00e9')])
+            self.assertTrue(records[1].time <= records[2].time <= records[3].time)
+
+            # A truncated record at the end is ignored.
+            with open(path, 'rb+') as f:
+                f.truncate(os.path.getsize(path) - 2)
+            self.assertEqual(len(JsDbgBase.ReadTrace(path)), 4)
+
+            @module.commands.Register
+            def Query(value):
+                return '%d~%s' % (value, value * 2)
+            results = JsDbgBase.ReplayTrace(module, records)
+            self.assertEqual([(r[0], r[1], r[3]) for r in results], [
+                ('Query(1)', '1~2\n1~\u00e9', '1~2'), ('Query(2)', '2~4\n2~\u00e9', '2~4')])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_RequestFunctionName(self):
+        self.assertEqual(JsDbgBase.RequestFunctionName("DebuggerQuery(1,'IsTypeEnum(\"m\",\"t\")')"), 'IsTypeEnum')
+        self.assertEqual(JsDbgBase.RequestFunctionName("DebuggerBatch([(1,'F()'),(2,'G()')])"), 'F')
+        self.assertEqual(JsDbgBase.RequestFunctionName("DebuggerQuery(1,'1 + 1')"), '(invalid)')
 
 if __name__ == '__main__':
     unittest.main()
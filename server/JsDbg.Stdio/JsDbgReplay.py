@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# Tools for JsDbg traces, as recorded with "set jsdbg-trace-file" in GDB.
+#
+# Use "python JsDbgReplay.py show TRACE" to summarize the requests in a trace,
+# and "python JsDbgReplay.py serve TRACE" to run the JsDbg server against the
+# recorded responses, without a debugger.
+#
+# To run the requests in a trace through the bridge again, use "jsdbg-replay
+# TRACE" in GDB, or "python JsDbg_bench.py TRACE" to run them against the fake
+# GDB of the benchmarks.
+import argparse
+import collections
+import time
+
+import JsDbgBase
+
+
+def Percentile(sortedTimes, fraction):
+    return sortedTimes[min(len(sortedTimes) - 1, int(fraction * len(sortedTimes)))]
+
+
+def ResponseParts(response):
+    """Splits a response line into (tag, "~" or "!", result)."""
+    for (i, c) in enumerate(response):
+        if c == "~" or c == "!":
+            return (response[:i], c, response[i + 1:])
+    return (response, "!", "Malformed response")
+
+
+def Summarize(records):
+    """Returns per-function metrics for the requests in the trace |records|:
+    call counts, errors, time spent waiting for and running requests and
+    latency percentiles."""
+    requests = dict([(r.sequence, r) for r in records if r.kind == "q"])
+    functions = {}
+    for response in records:
+        if response.kind != "r" or response.sequence not in requests:
+            continue
+        request = requests[response.sequence]
+        f = functions.setdefault(JsDbgBase.RequestFunctionName(request.data),
+            {"errors": 0, "wait": 0.0, "times": []})
+        if ResponseParts(response.data)[1] == "!":
+            f["errors"] += 1
+        f["wait"] += response.time - request.time
+        f["times"].append(response.duration)
+
+    lines = ["%-28s %7s %6s %10s %10s %9s %9s %9s" % (
+        "Function", "Calls", "Errors", "Wait ms", "Exec ms", "p50 us",
+        "p90 us", "p99 us")]
+    for name in sorted(functions):
+        f = functions[name]
+        t = sorted(f["times"])
+        lines.append("%-28s %7d %6d %10.2f %10.2f %9.1f %9.1f %9.1f" % (
+            name, len(t), f["errors"], f["wait"] * 1000, sum(t) * 1000,
+            Percentile(t, 0.5) * 1000000, Percentile(t, 0.9) * 1000000,
+            Percentile(t, 0.99) * 1000000))
+    events = len([r for r in records if r.kind == "e"])
+    lines.append("%d events" % (events))
+    return "\n".join(lines)
+
+
+class RecordedResponses(object):
+    """The responses in a trace, by query.
+
+    Queries are looked up without their tags, since a new session of the
+    server numbers them differently. If the same query was answered several
+    times, the answers are given out in order and the last one is repeated.
+    """
+    def __init__(self, records):
+        self.answers = collections.defaultdict(collections.deque)
+        requests = dict([(r.sequence, r) for r in records if r.kind == "q"])
+        for response in records:
+            request = requests.get(response.sequence)
+            if response.kind != "r" or request is None:
+                continue
+            try:
+                (function, args) = JsDbgBase.ParseCall(request.data)
+            except ValueError:
+                continue
+            if function == "DebuggerQuery":
+                queries = [args]
+            elif function == "DebuggerBatch":
+                queries = args[0]
+            else:
+                continue
+            for ((_, query), line) in zip(queries, response.data.split("\n")):
+                (_, kind, result) = ResponseParts(line)
+                self.answers[query].append((kind, result, response.duration))
+
+    def Answer(self, query):
+        """Returns ("~" or "!", result, duration) for |query|."""
+        answers = self.answers.get(query)
+        if not answers:
+            return ("!", "Not in trace: %s" % (query), 0.0)
+        if len(answers) > 1:
+            return answers.popleft()
+        return answers[0]
+
+
+class ReplayModule(object):
+    """Stands in for the bridge module, answering from a trace."""
+    def __init__(self, records, timed):
+        self.responses = RecordedResponses(records)
+        self.timed = timed
+        self.commands = JsDbgBase.CommandTable()
+        self.stats = JsDbgBase.BridgeStats()
+        self.commands.Register(self.DebuggerQuery)
+        self.commands.Register(self.DebuggerBatch)
+
+    def DebuggerQuery(self, tag, query):
+        try:
+            (function, args) = JsDbgBase.ParseCall(query)
+        except ValueError:
+            function = None
+        if function == "ServerStarted":
+            # The URL is new, so there is nothing to replay.
+            print("JsDbg: replaying at %s" % (args[0]))
+            return "%d~None" % (tag)
+        (kind, result, duration) = self.responses.Answer(query)
+        if self.timed:
+            time.sleep(duration)
+        return "%d%s%s" % (tag, kind, result)
+
+    def DebuggerBatch(self, queries):
+        return "\n".join([self.DebuggerQuery(tag, query) for (tag, query) in queries])
+
+
+def Serve(records, timed, verbose):
+    """Runs the JsDbg server and answers its requests from |records| until it
+    exits. Events recorded before the first request are sent at startup."""
+    events = []
+    for record in records:
+        if record.kind == "q":
+            break
+        if record.kind == "e":
+            events.append(record.data[1:])
+    JsDbgBase.Serve(ReplayModule(records, timed), verbose, events)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows or serves JsDbg traces.")
+    parser.add_argument("action", choices=["show", "serve"],
+        help="show: summarize the requests in the trace; serve: run the JsDbg "
+            "server with the recorded responses")
+    parser.add_argument("trace", help="the trace file")
+    parser.add_argument("--timed", action="store_true",
+        help="when serving, take as long to answer as the recorded requests took")
+    parser.add_argument("--verbose", action="store_true",
+        help="when serving, show all requests and responses")
+    options = parser.parse_args()
+
+    records = JsDbgBase.ReadTrace(options.trace)
+    if options.action == "show":
+        print(Summarize(records))
+    else:
+        Serve(records, options.timed, options.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# Snapshots of a debugging session, as captured with "jsdbg-snapshot" in GDB.
+#
+# A snapshot holds the responses to the queries the server made while the
+# target was stopped (type information, call stacks, symbols and so on) and
+# the target memory those queries read. Use "python JsDbgSnapshot.py
+# SNAPSHOT" to run the JsDbg server against a snapshot, without a debugger;
+# memory requests are answered from the snapshot's memory, so extensions can
+# look at anything that was looked at when it was captured.
+#
+# The file format is:
+#   jsdbg-snapshot <version>\n
+#   <offset of the index, as 16 hex digits>\n
+#   memory regions, each at a file offset that is a multiple of pageSize
+#   the index, as JSON: {"pointerFormat": <struct format of a pointer>,
+#     "queries": {<query>: <"~result" or "!error">},
+#     "memory": [[<address>, <size>, <file offset>], ...]}
+# The file is memory-mapped, so memory is only read from it as needed.
+import argparse
+import json
+import mmap
+
+import JsDbgBase
+import JsDbgTypes
+
+snapshot_version = 1
+snapshot_header = "jsdbg-snapshot %d\n" % (snapshot_version)
+pageSize = 4096
+
+# The requests that are answered from the memory of the snapshot rather than
+# from recorded responses.
+memory_functions = ["ReadMemoryBytes", "ReadMemoryRanges", "FollowPointers",
+    "FollowPointerTree"]
+
+
+def WriteSnapshot(path, queries, regions, pointerFormat):
+    """Writes a snapshot with the responses |queries| (query -> "~result" or
+    "!error") and the memory |regions|, a list of non-overlapping (address,
+    bytes) pairs, to |path|."""
+    header = snapshot_header.encode("ascii")
+    position = len(header) + 17
+    memory = []
+    with open(path, "wb") as f:
+        f.write(header)
+        f.write(b"0" * 16 + b"\n")
+        for (address, data) in sorted(regions):
+            data = bytes(data)
+            padding = -position % pageSize
+            f.write(b"\0" * padding)
+            position += padding
+            memory.append([address, len(data), position])
+            f.write(data)
+            position += len(data)
+        index = {"pointerFormat": pointerFormat, "queries": queries,
+            "memory": memory}
+        f.write(json.dumps(index, sort_keys=True).encode("utf-8"))
+        f.seek(len(header))
+        f.write(("%016x" % (position)).encode("ascii"))
+
+
+class Snapshot(object):
+    """A snapshot file, opened for reading."""
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        header = self.file.readline().decode("ascii", "replace")
+        if header != snapshot_header:
+            self.file.close()
+            raise ValueError("%s is not a version %d JsDbg snapshot" % (
+                path, snapshot_version))
+        indexOffset = int(self.file.readline(), 16)
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        index = json.loads(self.data[indexOffset:].decode("utf-8"))
+        self.pointerFormat = str(index["pointerFormat"])
+        self.queries = index["queries"]
+        self.memory = JsDbgBase.IntervalIndex()
+        for (address, size, offset) in index["memory"]:
+            self.memory.Add(address, address + size, (offset, address + size))
+
+    def Read(self, address, size):
+        """Returns |size| bytes of memory at |address|, or raises if the
+        snapshot doesn't have all of them."""
+        region = self.memory.Find(address)
+        if region is not None:
+            (start, (offset, end)) = region
+            if address + size <= end:
+                offset += address - start
+                return self.data[offset:offset + size]
+        raise ValueError("Cannot access memory at address 0x%x" % (address))
+
+    def Close(self):
+        self.data.close()
+        self.file.close()
+
+
+class SnapshotModule(object):
+    """Stands in for the bridge module, answering from a Snapshot."""
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.commands = JsDbgBase.CommandTable()
+        self.stats = JsDbgBase.BridgeStats()
+        # Only these functions run; the answers to all other queries come
+        # from the snapshot.
+        self.functions = JsDbgBase.CommandTable()
+        for func in [self.ServerStarted, self.GetBridgeFeatures,
+                     self.ReadMemoryBytes, self.ReadMemoryRanges,
+                     self.FollowPointers, self.FollowPointerTree]:
+            self.functions.Register(func)
+        self.commands.Register(self.DebuggerQuery)
+        self.commands.Register(self.DebuggerBatch)
+
+    def DebuggerQuery(self, tag, query):
+        name = None
+        start = JsDbgBase.timer()
+        try:
+            (name, args) = JsDbgBase.ParseCall(query)
+            if name in self.functions.functions:
+                response = "%d~%s" % (tag, JsDbgTypes.Serialize(
+                    self.functions.Invoke(name, args)))
+            elif query in self.snapshot.queries:
+                response = "%d%s" % (tag, self.snapshot.queries[query])
+            else:
+                response = "%d!Not in snapshot: %s" % (tag, query)
+        except Exception as e:
+            response = "%d!%s" % (tag, str(e))
+        self.stats.Record(name or "(invalid)", JsDbgBase.timer() - start,
+            len(response), response[len(str(tag))] == "!")
+        return response
+
+    def DebuggerBatch(self, queries):
+        return "\n".join([self.DebuggerQuery(tag, query) for (tag, query) in queries])
+
+    def ServerStarted(self, url):
+        print("JsDbg: serving snapshot at %s" % (url))
+
+    def GetBridgeFeatures(self):
+        return " ".join(JsDbgBase.bridge_features)
+
+    def ReadMemoryBytes(self, pointer, size, encoding="hex"):
+        return JsDbgBase.EncodeMemory(self.snapshot.Read(pointer, size), encoding)
+
+    def ReadMemoryRanges(self, ranges, encoding="hex"):
+        return JsDbgBase.ReadMemoryRanges(self.snapshot.Read, ranges, encoding)
+
+    def FollowPointers(self, start, nextOffset, maxHops, readSize, encoding="hex"):
+        return JsDbgBase.FollowPointers(self.snapshot.Read,
+            self.snapshot.pointerFormat, start, nextOffset, maxHops, readSize,
+            encoding)
+
+    def FollowPointerTree(self, root, childOffsets, maxNodes, readSize, encoding="hex"):
+        return JsDbgBase.FollowPointerTree(self.snapshot.Read,
+            self.snapshot.pointerFormat, root, childOffsets, maxNodes, readSize,
+            encoding)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Runs the JsDbg server against a snapshot, without a debugger.")
+    parser.add_argument("snapshot", help="the snapshot file")
+    parser.add_argument("--verbose", action="store_true",
+        help="show all requests and responses")
+    options = parser.parse_args()
+
+    snapshot = Snapshot(options.snapshot)
+    print("JsDbg: %d queries and %d memory regions in %s" % (
+        len(snapshot.queries), len(snapshot.memory.starts), options.snapshot))
+    JsDbgBase.Serve(SnapshotModule(snapshot), options.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,43 @@
+import itertools
+import operator
+
+# Result records for the responses to the server. Each one serializes as
+# {field#field#...} through __repr__, so a list of them can be sent with str().
+#
+# Records are kept small with __slots__ (subclasses need "__slots__ = ()" to
+# stay that way). Records that serialize as their attributes in order have
+# a wireFormat and a wireFields getter for those attributes, which lets
+# Serialize format lists of them without calling __repr__ for each record.
+
+
+def FormatRecords(records):
+    """Returns ', '.join([repr(r) for r in records])."""
+    parts = []
+    for (cls, group) in itertools.groupby(records, type):
+        wireFormat = getattr(cls, 'wireFormat', None)
+        if wireFormat is None:
+            parts.append(', '.join(map(repr, group)))
+        else:
+            # Format the whole run at once.
+            values = tuple(itertools.chain.from_iterable(map(cls.wireFields, group)))
+            count = len(values) // cls.wireFieldCount
+            parts.append(', '.join([wireFormat] * count) % values)
+    return ', '.join(parts)
+
+
+def Serialize(result):
+    """Returns str(result), but faster for lists of records."""
+    if type(result) is list:
+        return '[' + FormatRecords(result) + ']'
+    return str(result)
+
+
 class SFieldResult(object):
+    __slots__ = ('offset', 'size', 'bitOffset', 'bitCount', 'fieldName', 'typeName')
+    wireFormat = '{%d#%d#%d#%d#%s#%s}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, offset, size, bitOffset, bitCount, fieldName, typeName):
         self.offset = offset
         self.size = size
@@ -8,69 +47,232 @@ class SFieldResult(object):
         self.typeName = typeName
 
     def __repr__(self):
-        return '{%d#%d#%d#%d#%s#%s}' % (self.offset, self.size, self.bitOffset, self.bitCount, self.fieldName, self.typeName)
+        return self.wireFormat % self.wireFields(self)
 
 class SBaseTypeResult(object):
+    __slots__ = ('module', 'typeName', 'offset')
+    wireFormat = '{%s#%s#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, module, typeName, offset):
         self.module = module
         self.typeName = typeName
         self.offset = offset
 
     def __repr__(self):
-        return '{%s#%s#%d}' % (self.module, self.typeName, self.offset)
+        return self.wireFormat % self.wireFields(self)
 
 class SSymbolResult(object):
+    __slots__ = ('type', 'pointer')
+    wireFormat = '{%s#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, type, pointer):
         self.type = type
         self.pointer = pointer
 
     def __repr__(self):
-        return '{%s#%d}' % (self.type, self.pointer)
+        return self.wireFormat % self.wireFields(self)
 
 class SStackFrame(object):
+    __slots__ = ('instructionAddress', 'stackAddress', 'frameAddress')
+    wireFormat = '{%d#%d#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, pc, sp, fp):
         self.instructionAddress = pc
         self.stackAddress = sp
         self.frameAddress = fp
 
     def __repr__(self):
-        return '{%d#%d#%d}' % (self.instructionAddress, self.stackAddress, self.frameAddress)
+        return self.wireFormat % self.wireFields(self)
+
+
+class SStackFrameSymbols(object):
+    # Serializes as the frame (with the number of symbols added) followed by
+    # the symbols, so that a list of these reads as one flat list of records.
+    __slots__ = ('stackFrame', 'symbols')
+
+    def __init__(self, stackFrame, symbols):
+        self.stackFrame = stackFrame
+        self.symbols = symbols
+
+    def __repr__(self):
+        header = '{%d#%d#%d#%d}' % (
+            self.stackFrame.instructionAddress, self.stackFrame.stackAddress,
+            self.stackFrame.frameAddress, len(self.symbols))
+        if not self.symbols:
+            return header
+        return header + ', ' + FormatRecords(self.symbols)
 
 
 class SNamedSymbol(object):
+    __slots__ = ('module', 'name', 'symbolResult')
+    wireFormat = '{%s#%s#%d#%s}'
+    wireFields = operator.attrgetter(
+        'module', 'name', 'symbolResult.pointer', 'symbolResult.type')
+    wireFieldCount = 4
+
     def __init__(self, module, name, symbolResult):
         self.module = module
         self.name = name
         self.symbolResult = symbolResult
 
     def __repr__(self):
-        return '{%s#%s#%d#%s}' % (
-            self.module, self.name, self.symbolResult.pointer,
-            self.symbolResult.type)
+        return self.wireFormat % self.wireFields(self)
 
 
 class SConstantResult(object):
+    __slots__ = ('name', 'value')
+    wireFormat = '{%s#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, name, value):
         self.name = name
         self.value = value
 
     def __repr__(self):
-        return '{%s#%d}' % (self.name, self.value)
+        return self.wireFormat % self.wireFields(self)
+
+
+class STypeDescription(object):
+    # Serializes as a {module#type#size#isEnum#fieldCount#baseCount#constantCount}
+    # header followed by the field, base type and constant records, so that a
+    # list of these reads as one flat list of records.
+    __slots__ = ('module', 'typeName', 'size', 'isEnum', 'fields', 'baseTypes',
+        'constants')
+
+    def __init__(self, module, typeName, size, isEnum, fields, baseTypes, constants):
+        self.module = module
+        self.typeName = typeName
+        self.size = size
+        self.isEnum = isEnum
+        self.fields = fields
+        self.baseTypes = baseTypes
+        self.constants = constants
+
+    def __repr__(self):
+        header = '{%s#%s#%d#%d#%d#%d#%d}' % (
+            self.module, self.typeName, self.size or 0, 1 if self.isEnum else 0,
+            len(self.fields), len(self.baseTypes), len(self.constants))
+        records = self.fields + self.baseTypes + self.constants
+        if not records:
+            return header
+        return header + ', ' + FormatRecords(records)
 
 
 class SModule(object):
+    __slots__ = ('name', 'baseAddress')
+    wireFormat = '{%s#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, name, baseAddress):
         self.name = name
         self.baseAddress = baseAddress
 
     def __repr__(self):
-        return '{%s#%d}' % (self.name, self.baseAddress)
+        return self.wireFormat % self.wireFields(self)
 
 class SSymbolNameAndDisplacement(object):
+    __slots__ = ('module', 'name', 'displacement')
+    wireFormat = '{%s#%s#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
     def __init__(self, module, name, displacement):
         self.module = module
         self.name = name
         self.displacement = displacement
 
     def __repr__(self):
-        return '{%s#%s#%d}' % (self.module, self.name, self.displacement)
+        return self.wireFormat % self.wireFields(self)
+
+class SMemoryRangeResult(object):
+    # Exactly one of data and error is set.
+    __slots__ = ('data', 'error')
+
+    def __init__(self, data, error):
+        self.data = data
+        self.error = error
+
+    def __repr__(self):
+        if self.error is not None:
+            return '{0#%s}' % (self.error)
+        return '{1#%s}' % (self.data)
+
+class SPointerNode(object):
+    __slots__ = ('pointer', 'data')
+    wireFormat = '{%d#%s}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
+    def __init__(self, pointer, data):
+        self.pointer = pointer
+        self.data = data
+
+    def __repr__(self):
+        return self.wireFormat % self.wireFields(self)
+
+class SFunctionStats(object):
+    # Times are in microseconds; the histogram counts are separated by /.
+    __slots__ = ('name', 'calls', 'errors', 'queueTime', 'executionTime',
+        'responseBytes', 'histogram')
+
+    def __init__(self, name, calls, errors, queueTime, executionTime, responseBytes, histogram):
+        self.name = name
+        self.calls = calls
+        self.errors = errors
+        self.queueTime = queueTime
+        self.executionTime = executionTime
+        self.responseBytes = responseBytes
+        self.histogram = histogram
+
+    def __repr__(self):
+        return '{%s#%d#%d#%d#%d#%d#%s}' % (
+            self.name, self.calls, self.errors, self.queueTime,
+            self.executionTime, self.responseBytes,
+            '/'.join([str(count) for count in self.histogram]))
+
+class SMemoryCacheStats(object):
+    __slots__ = ('hits', 'misses', 'pages', 'maxPages', 'pageSize')
+    wireFormat = '{%d#%d#%d#%d#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
+    def __init__(self, hits, misses, pages, maxPages, pageSize):
+        self.hits = hits
+        self.misses = misses
+        self.pages = pages
+        self.maxPages = maxPages
+        self.pageSize = pageSize
+
+    def __repr__(self):
+        return self.wireFormat % self.wireFields(self)
+
+class SPrefetchStats(object):
+    __slots__ = ('pagesRead', 'hits', 'failures', 'depth', 'budget')
+    wireFormat = '{%d#%d#%d#%d#%d}'
+    wireFields = operator.attrgetter(*__slots__)
+    wireFieldCount = len(__slots__)
+
+    def __init__(self, pagesRead, hits, failures, depth, budget):
+        self.pagesRead = pagesRead
+        self.hits = hits
+        self.failures = failures
+        self.depth = depth
+        self.budget = budget
+
+    def __repr__(self):
+        return self.wireFormat % self.wireFields(self)
+
+class SNoResult(object):
+    # Stands in for results that could not be found in lists of results.
+    __slots__ = ()
+
+    def __repr__(self):
+        return '{}'
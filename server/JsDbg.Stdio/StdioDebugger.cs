@@ -6,6 +6,14 @@ using System.Threading.Tasks;
 using JsDbg.Core;
 
 namespace JsDbg.Stdio {
+    // Thrown for queries that the python bridge did not run because the
+    // target resumed or switched threads after they were sent.
+    public class QueryCancelledException : DebuggerException {
+        public QueryCancelledException(string message)
+            : base(message) {
+        }
+    }
+
     class StdioDebugger : IDebugger {
 
         public StdioDebugger() {
@@ -35,6 +43,14 @@ namespace JsDbg.Stdio {
             t = QueryDebuggerPython("GetTargetThread()").ContinueWith((task) => {
                 this.targetThread = UInt32.Parse(task.Result);
             });
+            // Older versions of the python bridge do not know GetBridgeFeatures;
+            // treat that as "no optional features".
+            this.bridgeFeatures = QueryDebuggerPython("GetBridgeFeatures()").ContinueWith((task) => {
+                if (task.IsFaulted) {
+                    return new HashSet<string>();
+                }
+                return new HashSet<string>(task.Result.Split(' ', StringSplitOptions.RemoveEmptyEntries));
+            });
 
             while(true) {
                 // Pump messages from python back to any waiting handlers
@@ -73,12 +89,20 @@ namespace JsDbg.Stdio {
             // Now check for process/thread events
             string processChange = "%proc ";
             string threadChange = "%thread ";
+            string cancelled = "%cancelled ";
             if (ev.StartsWith(processChange)) {
                 this.targetProcess = UInt32.Parse(ev.Substring(processChange.Length));
                 NotifyDebuggerChange(DebuggerChangeEventArgs.DebuggerStatus.ChangingProcess);
             } else if (ev.StartsWith(threadChange)) {
                 this.targetThread = UInt32.Parse(ev.Substring(threadChange.Length));
                 NotifyDebuggerChange(DebuggerChangeEventArgs.DebuggerStatus.ChangingThread);
+            } else if (ev.StartsWith(cancelled)) {
+                // The bridge skipped queries that were sent before the last
+                // cont or process/thread change; they failed with
+                // QueryCancelledException.
+                uint count = UInt32.Parse(ev.Substring(cancelled.Length));
+                this.cancelledQueries += count;
+                NotifyDebuggerMessage(String.Format("Skipped {0} out-of-date queries ({1} so far)", count, this.cancelledQueries));
             }
         }
 
@@ -398,16 +422,11 @@ namespace JsDbg.Stdio {
 
             NotifyDebuggerMessage(String.Format("Reading {0} bytes at 0x{1:x}...", size, pointer));
 
-            string response = await this.QueryDebuggerPython(String.Format("ReadMemoryBytes(0x{0:x},{1})", pointer, size));
-            // Response will be hex encoding of the memory
-
-            if (response.Length != 2* size) {
-                throw new DebuggerException(String.Format("Unable to read memory; expected {0} but got {1} bytes", size, response.Length/2));
-            }
-
-            byte[] bytes = new byte[size];
-            for (int i = 0; i < size; ++i) {
-                bytes[i] = Convert.ToByte(response.Substring(i*2,2), 16);
+            byte[] bytes;
+            if (await this.HasBridgeFeature("ranges")) {
+                bytes = await this.ReadMemoryBytesBatched(pointer, size);
+            } else {
+                bytes = await this.ReadMemoryBytes(pointer, size);
             }
 
             T[] result = new T[count];
@@ -417,6 +436,100 @@ namespace JsDbg.Stdio {
             return result;
         }
 
+        private async Task<byte[]> ReadMemoryBytes(ulong pointer, int size) {
+            byte[] bytes;
+            if (await this.HasBridgeFeature("base64")) {
+                string response = await this.QueryDebuggerPython(String.Format("ReadMemoryBytes(0x{0:x},{1},\"base64\")", pointer, size));
+                // Response will be base64 encoding of the memory
+                bytes = Convert.FromBase64String(response);
+            } else {
+                string response = await this.QueryDebuggerPython(String.Format("ReadMemoryBytes(0x{0:x},{1})", pointer, size));
+                // Response will be hex encoding of the memory
+                bytes = DecodeHex(response);
+            }
+
+            if (bytes.Length != size) {
+                throw new DebuggerException(String.Format("Unable to read memory; expected {0} but got {1} bytes", size, bytes.Length));
+            }
+            return bytes;
+        }
+
+        private static byte[] DecodeHex(string hexString) {
+            byte[] bytes = new byte[hexString.Length / 2];
+            for (int i = 0; i < bytes.Length; ++i) {
+                bytes[i] = Convert.ToByte(hexString.Substring(i*2,2), 16);
+            }
+            return bytes;
+        }
+
+        private class PendingRead {
+            public ulong Pointer;
+            public int Size;
+            public TaskCompletionSource<byte[]> Completion = new TaskCompletionSource<byte[]>();
+        }
+
+        // Queues a read to be sent together with any other reads that are
+        // requested before the queue gets sent, as one ReadMemoryRanges query.
+        private Task<byte[]> ReadMemoryBytesBatched(ulong pointer, int size) {
+            PendingRead read = new PendingRead() { Pointer = pointer, Size = size };
+            bool isFirst;
+            lock (this.pendingReads) {
+                this.pendingReads.Add(read);
+                isFirst = this.pendingReads.Count == 1;
+            }
+            if (isFirst) {
+                Task t = Task.Run(() => this.SendPendingReads());
+            }
+            return read.Completion.Task;
+        }
+
+        private async Task SendPendingReads() {
+            List<PendingRead> reads;
+            lock (this.pendingReads) {
+                reads = new List<PendingRead>(this.pendingReads);
+                this.pendingReads.Clear();
+            }
+
+            try {
+                bool base64 = await this.HasBridgeFeature("base64");
+                StringBuilder query = new StringBuilder("ReadMemoryRanges([");
+                foreach (PendingRead read in reads) {
+                    query.AppendFormat("(0x{0:x},{1}),", read.Pointer, read.Size);
+                }
+                query.Append(base64 ? "],\"base64\")" : "])");
+
+                List<string> results = ParsePythonObjectArrayToStrings(await this.QueryDebuggerPython(query.ToString()));
+                if (results.Count != reads.Count) {
+                    throw new DebuggerException(String.Format("Unable to read memory; expected {0} results but got {1}", reads.Count, results.Count));
+                }
+
+                for (int i = 0; i < reads.Count; ++i) {
+                    PendingRead read = reads[i];
+                    // '{1#<data>}' on success or '{0#<error>}' on failure
+                    string[] properties = results[i].Split('#', 2);
+                    if (properties.Length != 2) {
+                        throw new DebuggerException(String.Format("Unable to read memory; unexpected result {0}", results[i]));
+                    }
+                    if (properties[0] != "1") {
+                        read.Completion.TrySetException(new DebuggerException(String.Format("Unable to read memory at 0x{0:x}: {1}", read.Pointer, properties[1])));
+                        continue;
+                    }
+                    byte[] bytes = base64 ? Convert.FromBase64String(properties[1]) : DecodeHex(properties[1]);
+                    if (bytes.Length != read.Size) {
+                        read.Completion.TrySetException(new DebuggerException(String.Format("Unable to read memory; expected {0} but got {1} bytes", read.Size, bytes.Length)));
+                    } else {
+                        read.Completion.TrySetResult(bytes);
+                    }
+                }
+            } catch (Exception ex) {
+                // Nothing waits for this task, so fail all the reads that are
+                // not done yet; otherwise their callers would wait forever.
+                foreach (PendingRead read in reads) {
+                    read.Completion.TrySetException(ex);
+                }
+            }
+        }
+
         public async Task<T> ReadMemory<T>(ulong pointer) where T : struct {
             T[] result = await this.ReadArray<T>(pointer, 1);
             return result[0];
@@ -430,9 +543,17 @@ namespace JsDbg.Stdio {
             Buffer.BlockCopy(from, 0, bytes, 0, size);
 
             // bytes is now a buffer of bytes we wish to write
-            string hexString = BitConverter.ToString(bytes).Replace("-", string.Empty);
+            if (await this.HasBridgeFeature("base64")) {
+                string base64String = Convert.ToBase64String(bytes);
+                await this.QueryDebuggerPython(String.Format("WriteMemoryBytes(0x{0:x},\"{1}\",\"base64\")", pointer, base64String));
+            } else {
+                string hexString = BitConverter.ToString(bytes).Replace("-", string.Empty);
+                await this.QueryDebuggerPython(String.Format("WriteMemoryBytes(0x{0:x},\"{1}\")", pointer, hexString));
+            }
+        }
 
-            string response = await this.QueryDebuggerPython(String.Format("WriteMemoryBytes(0x{0:x},\"{1}\")", pointer, hexString));
+        private async Task<bool> HasBridgeFeature(string feature) {
+            return (await this.bridgeFeatures).Contains(feature);
         }
 
         public List<uint> ParsePythonArrayToIntegers(string response) {
@@ -501,7 +622,12 @@ namespace JsDbg.Stdio {
                     responseCompletionSource.TrySetResult(e.Substring(tagString.Length).Trim());
                     this.OutputDataReceived -= outputHandler;
                 } else if (e != null && e.StartsWith(errString)) {
-                    responseCompletionSource.TrySetException(new DebuggerException(e.Substring(errString.Length)));
+                    string error = e.Substring(errString.Length);
+                    if (error.StartsWith(CancelledError)) {
+                        responseCompletionSource.TrySetException(new QueryCancelledException(error));
+                    } else {
+                        responseCompletionSource.TrySetException(new DebuggerException(error));
+                    }
                     this.OutputDataReceived -= outputHandler;
                 }
 
@@ -513,9 +639,18 @@ namespace JsDbg.Stdio {
             return response;
         }
 
+        // The start of the error for queries the bridge cancelled; see
+        // cancelled_error in JsDbgBase.py.
+        private const string CancelledError = "Cancelled:";
+        // The number of queries the bridge cancelled.
+        private uint cancelledQueries = 0;
         // Assume 64-bit until we get a response from the debugger
         private bool isPointer64Bit = true;
         private uint queryTag = 1;
+        // Reads waiting to be sent with ReadMemoryRanges.
+        private List<PendingRead> pendingReads = new List<PendingRead>();
+        // Optional features supported by the python bridge, see GetBridgeFeatures.
+        private Task<HashSet<string>> bridgeFeatures = Task.FromResult(new HashSet<string>());
         private DebuggerChangeEventArgs.DebuggerStatus debuggerStatus =
             DebuggerChangeEventArgs.DebuggerStatus.Break;
         private uint targetProcess = 0;